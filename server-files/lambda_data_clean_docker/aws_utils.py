@@ -1,10 +1,20 @@
+import io
 import os
 import boto3
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Objects above the threshold are transferred in parallel chunks (ranged GETs / multipart uploads)
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 8
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=CHUNK_SIZE, multipart_chunksize=CHUNK_SIZE,
+                                 max_concurrency=MAX_CONCURRENCY)
+
 def s3_client(config):
     try:
         # Get values from the config file
@@ -18,22 +28,157 @@ def s3_client(config):
         print(e)
     return s3
 
-def s3_get_obj(s3_client, config, key, local_fn):
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Binary file object that streams what is written to it into an S3 multipart upload.
+    Parts are uploaded in a thread pool as soon as CHUNK_SIZE bytes are buffered, so at most
+    MAX_CONCURRENCY parts are held in memory. Objects smaller than one part are sent with a
+    single put_object. The upload is aborted if the `with` block raises.
+    """
+
+    def __init__(self, s3_client, bucket_name, key):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self._pool = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= CHUNK_SIZE:
+            part = bytes(self._buffer[:CHUNK_SIZE])
+            del self._buffer[:CHUNK_SIZE]
+            self._upload_part(part)
+        return len(data)
+
+    def _upload_part(self, part):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self._upload_id = response['UploadId']
+            self._pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        # bound the number of parts in flight (and in memory)
+        if len(self._parts) >= MAX_CONCURRENCY:
+            self._parts[-MAX_CONCURRENCY].result()
+        part_number = len(self._parts) + 1
+        self._parts.append(self._pool.submit(
+            self.s3_client.upload_part, Bucket=self.bucket_name, Key=self.key,
+            UploadId=self._upload_id, PartNumber=part_number, Body=part))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                parts = [{'ETag': future.result()['ETag'], 'PartNumber': number}
+                         for number, future in enumerate(self._parts, start=1)]
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            if self._pool is not None:
+                self._pool.shutdown()
+            super().close()
+
+    def abort(self):
+        if self._upload_id is not None:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                  UploadId=self._upload_id)
+            self._upload_id = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            self._buffer = bytearray()
+            super().close()
+            return False
+        self.close()
+        return False
+
+def s3_writer(s3_client, config, key):
+    # file object for streaming writes, e.g. `with s3_writer(...) as f: df.to_parquet(f)`
+    return S3MultipartWriter(s3_client, config.get('s3', 'bucket_name'), key)
+
+def s3_stream(s3_client, config, key):
+    # object body as a stream, e.g. for pd.read_csv(..., chunksize=...)
+    bucket_name = config.get('s3', 'bucket_name')
+    return s3_client.get_object(Bucket=bucket_name, Key=key)['Body']
+
+def is_missing(err):
+    # S3 answers a HEAD (also the first request of a download) for a missing key with a 404,
+    # or with a 403 when the role has no s3:ListBucket on the bucket
+    return (isinstance(err, ClientError) and
+            err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound',
+                                              '403', 'AccessDenied'))
+
+def s3_etag(s3_client, config, key):
+    # ETag of an object without reading it; None if it does not exist
+    try:
+        bucket_name = config.get('s3', 'bucket_name')
+        return s3_client.head_object(Bucket=bucket_name, Key=key)['ETag']
+    except Exception as e:
+        if is_missing(e):
+            logger.info(f"File {key} not found in S3 (or not readable).")
+            return None
+        logger.error(f"Error reading the ETag of {key}: {e}")
+        return None
+
+def s3_get_obj(s3_client, config, key):
     try:
         # The bucket name and object (file) key
         bucket_name = config.get('s3', 'bucket_name')
+
+        # Read the object into memory; large objects are fetched with parallel ranged GETs
+        content = io.BytesIO()
+        s3_client.download_fileobj(Bucket=bucket_name, Key=key, Fileobj=content, Config=TRANSFER_CONFIG)
+        content.seek(0)
+        logger.info(f"File {key} retrieved.")
+
+    except Exception as e:
+        # a missing object is expected, e.g. the manifests before the first run
+        if is_missing(e):
+            logger.info(f"File {key} not found in S3 (or not readable).")
+            return None
+        # Handle other possible exceptions
+        logger.error(f"Error downloading {key}: {e}", exc_info=True)
+        return None
+    return content
+
+def s3_download(s3_client, config, key, local_fn):
+    # for consumers that need a real file (e.g. sqlite)
+    try:
+        bucket_name = config.get('s3', 'bucket_name')
         # store in /tmp so it is writable
         local_file_path = os.path.join('/tmp', local_fn)
-
-        # Get the object from S3
-        s3_client.download_file(Bucket=bucket_name, Key=key, Filename=local_file_path)
+        s3_client.download_file(Bucket=bucket_name, Key=key, Filename=local_file_path, Config=TRANSFER_CONFIG)
         logger.info(f"File {key} downloaded to {local_file_path}.")
-        # res = s3_client.get_object(Bucket=bucket_name,Key=key)
-        # logger.info(f"File {key} retrieved.")
-        # Read the object's content into a DataFrame
-
     except Exception as e:
-            # Handle other possible exceptions
+        # a missing object is expected, e.g. the geocode cache before the first save
+        if is_missing(e):
+            logger.info(f"File {key} not found in S3 (or not readable).")
+            return None
         logger.error(f"Error downloading {key}: {e}", exc_info=True)
         return None
     return local_file_path
@@ -43,10 +188,11 @@ def s3_upload(s3_client, config, key, content):
         # The bucket name and object (file) key
         bucket_name = config.get('s3', 'bucket_name')
 
-        # Get the object from S3
-        response = s3_client.put_object(Bucket=bucket_name, Key=key, Body=content)
+        # content is bytes or a binary file object, streamed as a multipart upload
+        fileobj = io.BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+        s3_client.upload_fileobj(Fileobj=fileobj, Bucket=bucket_name, Key=key, Config=TRANSFER_CONFIG)
         logger.info(f"File {key} uploaded to bucket {bucket_name}.")
     except Exception as e:
         logger.error(f"Error uploading {key}: {e}", exc_info=True)
         return None
-    return response
\ No newline at end of file
+    return key
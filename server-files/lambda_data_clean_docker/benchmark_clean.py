@@ -0,0 +1,106 @@
+"""
+Wall-clock benchmark of `clean_frame` against the row-wise cleaning it replaced, on the raw
+files of the dataset (about 110K listings with both files of the UCI dataset):
+
+    python benchmark_clean.py --raw raw_1.csv raw_2.csv
+
+Synthetic raw files of any size can be written with the pipeline benchmark's generator
+(`../pipeline_benchmark/synthetic_listings.py generate --rows 110000 --out raw_1.csv`).
+Both versions run the offline geocoding without the Nominatim fallback. It prints the
+cleaning time of each version (best of --repeat) and whether their outputs are equal.
+"""
+import argparse
+import json
+import time
+
+import pandas as pd
+import yaml
+
+import geolocate as gl
+import lambda_function as lf
+
+
+def row_wise_clean(df, dc_config):
+    """data_clean before the string transforms were vectorized, without the S3 upload."""
+    df = df.drop(columns=dc_config['dc']['drop_columns'])
+    df = df[~(df['latitude'].isna() & df['longitude'].isna())]
+    df = df[~df['price'].isna()]
+    for column in df.select_dtypes(include=['object', 'string']):
+        df[column] = df[column].apply(lambda x: x.lower() if isinstance(x, str) else x)
+    df.amenities = df.amenities.apply(lambda x: x.split(',') if pd.notna(x) else [])
+
+    geocode_config = dc_config['geocode']
+    df = gl.impute_nearest_location(df, geocode_config['n_neighbors'],
+                                    geocode_config['max_distance_km'])
+
+    df['square_feet_group'] = (df['square_feet'] // 100).astype(int)
+    sq_means = df.groupby('square_feet_group')[['bedrooms', 'bathrooms']].transform("mean")
+    df['bedrooms'].fillna(sq_means['bedrooms'], inplace=True)
+    df['bathrooms'].fillna(sq_means['bathrooms'], inplace=True)
+    bd_means = df.groupby('bedrooms')[['bathrooms']].transform("mean")
+    df['bathrooms'].fillna(round(bd_means['bathrooms'], 0), inplace=True)
+
+    df.loc[df['price_type'] == 'weekly', 'price'] = df['price'] * 4
+    df.loc[df['price_type'] == 'weekly', 'price_type'] = 'monthly'
+    df = df[df['price_type'] == 'monthly']
+    df['has_photo'] = df['has_photo'].replace('thumbnail', 'yes')
+
+    df['pets_allowed'].replace("cats,dogs,none", "none", inplace=True)
+    df.pets_allowed = df.pets_allowed.apply(lambda x: x.split(',') if pd.notna(x) else [])
+    df['cats_allowed'] = df['pets_allowed'].apply(lambda x: 'yes' if isinstance(x, list) and 'cats' in x else 'no')
+    df['dogs_allowed'] = df['pets_allowed'].apply(lambda x: 'yes' if isinstance(x, list) and 'dogs' in x else 'no')
+
+    df['n_amenities'] = df.amenities.apply(len)
+    df['price_per_sq_feet'] = df.price / df.square_feet
+    return df
+
+
+def same_output(clean, expected, dc_config):
+    # clean_frame stores the low-cardinality columns as categoricals
+    categorical = dc_config['dc']['categorical_columns']
+    clean = clean.assign(**{column: clean[column].astype(object) for column in categorical})
+    try:
+        pd.testing.assert_frame_equal(clean, expected)
+    except AssertionError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the cleaning time of clean_frame with the row-wise version"
+    )
+    parser.add_argument("--raw", nargs="+", required=True, help="Raw CSV files, as in S3")
+    parser.add_argument("--config", default="data_clean_config.yaml")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        dc_config = yaml.safe_load(f)
+    dc_config['geocode']['nominatim_fallback'] = False
+    # no geocode cache in S3 to load
+    gl.geocode_cache.loaded = True
+
+    raw = pd.concat([pd.read_csv(path, encoding='ISO-8859-1', sep=';', dtype=lf.RAW_DTYPES)
+                     for path in args.raw], ignore_index=True)
+
+    timings = {}
+    outputs = {}
+    for name, clean in (("row_wise", row_wise_clean),
+                        ("vectorized", lambda df, dc_config: lf.clean_frame(df, None, None,
+                                                                             dc_config))):
+        best = float("inf")
+        for _ in range(args.repeat):
+            df = raw.copy()
+            start = time.perf_counter()
+            outputs[name] = clean(df, dc_config)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+
+    print(json.dumps({
+        "rows": len(raw),
+        "row_wise_s": round(timings["row_wise"], 3),
+        "vectorized_s": round(timings["vectorized"], 3),
+        "speedup": round(timings["row_wise"] / timings["vectorized"], 2),
+        "same_output": same_output(outputs["vectorized"], outputs["row_wise"], dc_config),
+    }))
@@ -1,4 +1,9 @@
+import os
+import sqlite3
 from functools import lru_cache
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 
@@ -8,22 +13,120 @@ geolocator = Nominatim(user_agent="AWS-MLops-DC")
 # To avoid hitting the service too hard, use RateLimiter
 geocode = RateLimiter(geolocator.reverse, min_delay_seconds=1)
 
+class GeocodeCache:
+    """
+    Reverse geocoding results keyed by lat/lon rounded to `precision` decimals.
+    Entries are persisted in a SQLite file; only entries added since the last
+    load/save are written back. Failed lookups are not cached, so they are
+    retried by the next run instead of being stored forever.
+    """
+
+    def __init__(self, precision=4):
+        self.precision = precision
+        self.entries = {}
+        self.new_entries = {}
+        self.loaded = False
+
+    def key(self, latitude, longitude):
+        return round(float(latitude), self.precision), round(float(longitude), self.precision)
+
+    def get(self, latitude, longitude):
+        return self.entries.get(self.key(latitude, longitude))
+
+    def add(self, latitude, longitude, cityname, state):
+        key = self.key(latitude, longitude)
+        self.entries[key] = (cityname, state)
+        self.new_entries[key] = (cityname, state)
+
+    def load(self, path):
+        """Load all entries from a SQLite file. A missing file gives an empty cache."""
+        if path and os.path.exists(path):
+            conn = sqlite3.connect(path)
+            # files written before failed lookups were skipped may still hold them
+            rows = conn.execute("SELECT lat, lon, cityname, state FROM geocode "
+                                "WHERE cityname IS NOT NULL OR state IS NOT NULL").fetchall()
+            conn.close()
+            self.entries.update({(lat, lon): (city, state) for lat, lon, city, state in rows})
+        self.loaded = True
+
+    def save(self, path):
+        """Insert the new entries into the SQLite file at `path`, creating it if needed."""
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS geocode ("
+                         "lat REAL, lon REAL, cityname TEXT, state TEXT, PRIMARY KEY (lat, lon))")
+            conn.executemany("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)",
+                             [(lat, lon, city, state)
+                              for (lat, lon), (city, state) in self.new_entries.items()])
+        conn.close()
+        self.new_entries = {}
+
+geocode_cache = GeocodeCache()
+
 @lru_cache(maxsize=1024)
 def get_location(latitude, longitude):
     return geocode((latitude, longitude))
 
 def reverse_geocode(latitude, longitude):
+    cached = geocode_cache.get(latitude, longitude)
+    if cached is not None:
+        return cached
     try:
         location = get_location(latitude, longitude)
         if location:
             address = location.raw['address']
             cityname = address.get('county', address.get('city', ''))
             state = us_state_to_abbrev.get(address.get('state', ''), "")
-            return cityname, state
+        else:
+            return None, None
+        geocode_cache.add(latitude, longitude, cityname, state)
+        return cityname, state
     except Exception as e:
         print(f"Error geocoding {latitude}, {longitude}: {e}")
         return None, None
 
+EARTH_RADIUS_KM = 6371.0
+
+def impute_nearest_location(df, n_neighbors=5, max_distance_km=5.0):
+    """
+    Offline reverse geocoding: fill missing cityname/state with the most common
+    (cityname, state) among the nearest rows of the same frame that have them.
+    Neighbours further than `max_distance_km` are ignored, so rows without any
+    close neighbour keep their missing values.
+
+    Returns the frame with imputed values.
+    """
+    has_coords = df['latitude'].notna() & df['longitude'].notna()
+    has_location = df['cityname'].notna() & df['state'].notna()
+    known = df[has_coords & has_location]
+    missing = df[has_coords & ~has_location]
+    if known.empty or missing.empty:
+        return df
+
+    # haversine BallTree over the rows with known location
+    tree = BallTree(np.radians(known[['latitude', 'longitude']].to_numpy(dtype=float)),
+                    metric='haversine')
+    n_neighbors = min(n_neighbors, len(known))
+    dist, idx = tree.query(np.radians(missing[['latitude', 'longitude']].to_numpy(dtype=float)),
+                           k=n_neighbors)
+
+    # majority vote over (cityname, state) pairs of the neighbours in range;
+    # ties go to the closest neighbour since query results are sorted by distance
+    pair_codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([known['cityname'], known['state']]))
+    codes = pair_codes[idx]
+    in_range = dist * EARTH_RADIUS_KM <= max_distance_km
+    votes = ((codes[:, :, None] == codes[:, None, :]) & in_range[:, None, :]).sum(axis=2)
+    votes[~in_range] = -1
+    best = codes[np.arange(len(codes)), votes.argmax(axis=1)]
+    found = in_range.any(axis=1)
+
+    imputed = pairs[best[found]]
+    rows = missing.index[found]
+    df.loc[rows, 'cityname'] = df.loc[rows, 'cityname'].fillna(
+        pd.Series(imputed.get_level_values(0), index=rows))
+    df.loc[rows, 'state'] = df.loc[rows, 'state'].fillna(
+        pd.Series(imputed.get_level_values(1), index=rows))
+    return df
+
 us_state_to_abbrev = {
     "Alabama": "AL",
     "Alaska": "AK",
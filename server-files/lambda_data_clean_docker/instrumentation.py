@@ -0,0 +1,158 @@
+"""
+Lightweight stage-level instrumentation shared by the Lambdas (each image has a copy of this
+file, like aws_utils.py; lambda_train_docker/tests/test_instrumentation.py checks that the
+copies stay identical).
+
+A run collects spans, one per stage of an invocation (download, parse, fit, upload, ...).
+Each span records wall time, CPU time, the peak RSS of the process at the end of the stage
+and how much it grew during the stage, and the bytes the stage read and wrote (set by the
+caller). Spans are printed as CloudWatch embedded metric format (EMF) JSON lines, which
+CloudWatch turns into metrics, and the whole run can be saved as timings.json.
+
+    run = instrumentation.start_run("train_model")
+    with instrumentation.span("download") as stage:
+        data = read(...)
+        stage.bytes_in += len(data)
+    run.save(results_dir / "timings.json")
+"""
+import json
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+NAMESPACE = "AWS-MLOps"
+
+# Unit of each metric in the EMF lines
+METRIC_UNITS = {"WallTime": "Milliseconds", "CpuTime": "Milliseconds", "PeakRss": "Megabytes",
+                "RssGrowth": "Megabytes", "BytesIn": "Bytes", "BytesOut": "Bytes"}
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process so far, in MB. Read from VmHWM on Linux: ru_maxrss
+    survives fork/exec, so a process started by a larger one would report its parent's peak.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Span:
+    """One timed stage. bytes_in and bytes_out are filled in by the caller."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+        self.peak_rss_mb = 0.0
+        self.rss_growth_mb = 0.0
+        self.error = None
+
+    def to_dict(self) -> Dict:
+        return {"stage": self.name, "wall_ms": round(self.wall_ms, 3),
+                "cpu_ms": round(self.cpu_ms, 3), "peak_rss_mb": round(self.peak_rss_mb, 1),
+                "rss_growth_mb": round(self.rss_growth_mb, 1), "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out, "error": self.error}
+
+
+class Run:
+    """The spans of one invocation of a Lambda function."""
+
+    def __init__(self, function: str, run_id: Optional[str] = None, emit: bool = True):
+        self.function = function
+        # Sorts by start time; the suffix keeps concurrent invocations apart
+        self.run_id = run_id or time.strftime("%Y%m%dT%H%M%SZ-", time.gmtime()) + uuid.uuid4().hex[:8]
+        self.emit = emit
+        self.started_at = time.time()
+        self.spans: List[Span] = []
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        """Time the enclosed block as stage `name`. The span is kept even if the block raises."""
+        stage = Span(name)
+        rss_start = peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield stage
+        except BaseException as err:
+            stage.error = type(err).__name__
+            raise
+        finally:
+            stage.wall_ms = (time.perf_counter() - wall_start) * 1e3
+            stage.cpu_ms = (time.process_time() - cpu_start) * 1e3
+            stage.peak_rss_mb = peak_rss_mb()
+            stage.rss_growth_mb = stage.peak_rss_mb - rss_start
+            self.spans.append(stage)
+            if self.emit:
+                print(json.dumps(self.emf(stage)), flush=True)
+
+    def emf(self, stage: Span) -> Dict:
+        """The CloudWatch embedded metric format record of a span."""
+        values = {"WallTime": stage.wall_ms, "CpuTime": stage.cpu_ms,
+                  "PeakRss": stage.peak_rss_mb, "RssGrowth": stage.rss_growth_mb,
+                  "BytesIn": stage.bytes_in, "BytesOut": stage.bytes_out}
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Function", "Stage"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in METRIC_UNITS.items()],
+                }],
+            },
+            "Function": self.function,
+            "Stage": stage.name,
+            "RunId": self.run_id,
+            "Error": stage.error,
+            **{name: round(value, 3) for name, value in values.items()},
+        }
+
+    def summary(self) -> Dict:
+        """The run and its spans as a JSON-serializable dict (the content of timings.json)."""
+        return {"function": self.function, "run_id": self.run_id,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+                "total_wall_ms": round((time.time() - self.started_at) * 1e3, 3),
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+                "spans": [stage.to_dict() for stage in self.spans]}
+
+    def to_json(self) -> bytes:
+        return json.dumps(self.summary(), indent=2).encode("utf-8")
+
+    def save(self, path: Union[Path, str]) -> None:
+        """Write the run summary to a timings.json file."""
+        with open(path, "wb") as file:
+            file.write(self.to_json())
+
+
+# The run of the current invocation, used by the module-level span()
+_current_run: Optional[Run] = None
+
+
+def start_run(function: str, run_id: Optional[str] = None, emit: bool = True) -> Run:
+    """Start the run of a new invocation and make it the current one."""
+    global _current_run
+    _current_run = Run(function, run_id, emit)
+    return _current_run
+
+
+def current_run() -> Run:
+    """The current run. Outside an invocation (local scripts), a silent "local" run is started."""
+    if _current_run is None:
+        return start_run("local", emit=False)
+    return _current_run
+
+
+def span(name: str):
+    """Time a stage of the current run, see `Run.span`."""
+    return current_run().span(name)
@@ -1,9 +1,15 @@
 import os
+import hashlib
+import time
+from contextlib import nullcontext
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import geolocate as gl
 import aws_utils as au
+import instrumentation as instr
 import configparser
-from io import BytesIO, StringIO
 import logging
 import json
 import random
@@ -14,6 +20,10 @@ import traceback
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# dtypes that do not depend on which rows a file (or chunk) has, e.g. on a chunk without nulls
+RAW_DTYPES = {'id': 'int64', 'address': str, 'bathrooms': float, 'bedrooms': float,
+              'price': float}
+
 def apply_reverse_geocode(row):
     try:
         if pd.isnull(row['cityname']) or pd.isnull(row['state']):
@@ -23,101 +33,325 @@ def apply_reverse_geocode(row):
         logger.error(f"Error in reverse geocoding: {e}", exc_info=True)
         return row
 
+def load_geocode_cache(s3, config, dc_config):
+    # loaded once per container; warm invocations reuse the in-memory cache
+    if gl.geocode_cache.loaded:
+        return
+    cache_config = dc_config['geocode_cache']
+    gl.geocode_cache.precision = cache_config['precision']
+    fn = au.s3_download(s3, config, cache_config['key'], cache_config['download_name'])
+    gl.geocode_cache.load(fn)
+    logger.info(f"Loaded {len(gl.geocode_cache.entries)} geocode cache entries.")
+
+def save_geocode_cache(s3, config, dc_config):
+    if not gl.geocode_cache.new_entries:
+        return
+    cache_config = dc_config['geocode_cache']
+    n_new = len(gl.geocode_cache.new_entries)
+    # merge into the latest stored copy so entries from other runs are kept
+    fn = au.s3_download(s3, config, cache_config['key'], cache_config['download_name'])
+    fn = fn or os.path.join('/tmp', cache_config['download_name'])
+    gl.geocode_cache.save(fn)
+    with open(fn, 'rb') as f:
+        au.s3_upload(s3, config, cache_config['key'], f)
+    logger.info(f"Saved {n_new} new geocode cache entries.")
+
+def map_unique(series, func, missing=np.nan):
+    # apply a vectorized .str transform to the distinct values only and broadcast it back
+    # with the factorize codes; cleaning columns have few distinct values compared to rows
+    codes, uniques = pd.factorize(series)
+    values = np.empty(len(uniques) + 1, dtype=object)
+    values[:-1] = func(pd.Series(uniques, dtype=object)).to_numpy()
+    # code -1 (missing value) picks the last slot
+    values[-1] = missing
+    return pd.Series(values[codes], index=series.index)
+
+def split_to_list(series):
+    # split comma separated str into lists of str, missing values become empty lists.
+    # Non-str values (e.g. a column read as numbers) are cast first, so no row ends up NaN.
+    # rows with the same value share the same (never mutated) list
+    return map_unique(series, lambda s: s.astype(str).str.split(','), missing=[])
+
+def hash_split(df, train_fraction):
+    # split by a 64-bit hash of the listing id, ordered by the hash in place of a shuffle.
+    # A listing's split and position depend on its id only, so listings stay in their split
+    # when new ones are ingested, and the data can be split one chunk at a time
+    hashes = pd.util.hash_pandas_object(df['id'], index=False).to_numpy()
+    order = np.argsort(hashes)
+    df = df.iloc[order]
+    is_train = (hashes[order] >> np.uint64(11)) < np.uint64(train_fraction * 2**53)
+    return df[is_train], df[~is_train]
+
 def train_test_split(s3, config, dc_config):
         ### LOAD DATA ###
-        fn1 = au.s3_get_obj(s3, config, dc_config['s3']['raw_data'], dc_config['s3']['raw_download_name'])
-        fn2 = au.s3_get_obj(s3, config, dc_config['s3']['raw_data2'], dc_config['s3']['raw2_download_name'])
+        # read straight from S3 into memory, no /tmp copy
+        with instr.span("download") as stage:
+            fn1 = au.s3_get_obj(s3, config, dc_config['s3']['raw_data'])
+            fn2 = au.s3_get_obj(s3, config, dc_config['s3']['raw_data2'])
+            stage.bytes_in = fn1.getbuffer().nbytes + fn2.getbuffer().nbytes
         logger.info("Retrieved raw data...")
 
-        df = pd.read_csv(fn1, encoding='ISO-8859-1', sep=';', dtype={'address': str})
-        df2 = pd.read_csv(fn2, encoding='ISO-8859-1', sep=';', dtype={'address': str})
-        # df = pd.read_csv(StringIO(fn1['Body'].read().decode('ISO-8859-1')), sep=';', dtype={'address': str})
-        # df2 = pd.read_csv(StringIO(fn2['Body'].read().decode('ISO-8859-1')), sep=';',dtype={'address': str})
-        # merge 2 datasets
-        df = pd.concat([df, df2], ignore_index=True, axis=0)
-        df = df.sample(frac=1, random_state=42).reset_index(drop=True)
+        with instr.span("parse"):
+            df = pd.read_csv(fn1, encoding='ISO-8859-1', sep=';', dtype=RAW_DTYPES)
+            df2 = pd.read_csv(fn2, encoding='ISO-8859-1', sep=';', dtype=RAW_DTYPES)
+            # merge 2 datasets
+            df = pd.concat([df, df2], ignore_index=True, axis=0)
         logger.info("Columns in the dataframe: %s", df.columns.tolist())
 
-        split_idx = int(len(df) * 0.8)
-        train_set = df[:split_idx]
-        test_set = df[split_idx:]
+        with instr.span("split"):
+            split_config = dc_config['split']
+            if split_config['method'] == 'hash':
+                train_set, test_set = hash_split(df.reset_index(drop=True),
+                                                 split_config['train_fraction'])
+            else:
+                df = df.sample(frac=1, random_state=42).reset_index(drop=True)
+                split_idx = int(len(df) * split_config['train_fraction'])
+                train_set = df[:split_idx]
+                test_set = df[split_idx:]
         
         return train_set, test_set
 
-def data_clean(df, s3, config, dc_config, subset='train'):
+def drop_unusable(df):
+    # drop rows with no long, lat & no price (response var)
+    df = df[~(df['latitude'].isna() & df['longitude'].isna())]
+    return df[~df['price'].isna()]
+
+def impute_rooms(df, sq_means=None, bd_means=None):
+    # impute with average bed/bath in sq_feet groups; the means are taken from df unless given
+    if sq_means is None:
+        sq_means = df.groupby('square_feet_group')[['bedrooms', 'bathrooms']].mean()
+    df['bedrooms'].fillna(df['square_feet_group'].map(sq_means['bedrooms']), inplace=True)
+    df['bathrooms'].fillna(df['square_feet_group'].map(sq_means['bathrooms']), inplace=True)
+    # remaining bathrooms - impute with average bedroom
+    if bd_means is None:
+        bd_means = df.groupby('bedrooms')['bathrooms'].mean()
+    df['bathrooms'].fillna(round(df['bedrooms'].map(bd_means), 0), inplace=True)
+
+def clean_frame(df, s3, config, dc_config, subset='train', means=None):
         ### DATA CLEANING ###
         # drop unncessary columns
         logger.info("Starting data cleaning...")
-        df = df.drop(columns=dc_config['dc']['drop_columns'])
+        load_geocode_cache(s3, config, dc_config)
+        with instr.span(f"clean_{subset}"):
+            df = df.drop(columns=dc_config['dc']['drop_columns'])
+            df = drop_unusable(df)
 
-        # drop rows with no long, lat & no price (response var)
-        df = df[~(df['latitude'].isna() & df['longitude'].isna())]
-        df= df[~df['price'].isna()]
-
-        # make all str lowercase
-        for column in df.select_dtypes(include=['object', 'string']):
-            df[column] = df[column].apply(lambda x: x.lower() if isinstance(x, str) else x)
-
-        # split str to list of amenities
-        df.amenities = df.amenities.apply(lambda x: x.split(',') if pd.notna(x) else [])
-        logger.info("Finished data cleaning...")
+            # make all str lowercase (non-str values are kept as they are)
+            for column in df.select_dtypes(include=['object', 'string']):
+                df[column] = map_unique(df[column], lambda s: s.str.lower().fillna(s))
+            logger.info("Finished data cleaning...")
 
         ### IMPUTE DATA ###
         ## IMPUTE cityname & state ##
-        # rows where 'cityname' or 'state' is null
-        rows_to_geocode = df[df['cityname'].isnull() | df['state'].isnull()]
-        # apply the reverse_geocode function to the filtered df
-        geocoded_rows = rows_to_geocode.apply(apply_reverse_geocode, axis=1)
-        # update DataFrame with the geocoded information
-        df.update(geocoded_rows)
+        with instr.span(f"geocode_{subset}"):
+            geocode_config = dc_config['geocode']
+            if geocode_config['mode'] == 'offline':
+                # impute from nearby listings, only rows without close neighbours go online
+                df = gl.impute_nearest_location(df, geocode_config['n_neighbors'],
+                                                geocode_config['max_distance_km'])
+                logger.info("Finished offline reverse geocoding...")
+            if geocode_config['mode'] == 'nominatim' or geocode_config['nominatim_fallback']:
+                # rows where 'cityname' or 'state' is null
+                rows_to_geocode = df[df['cityname'].isnull() | df['state'].isnull()]
+                # apply the reverse_geocode function to the filtered df
+                geocoded_rows = rows_to_geocode.apply(apply_reverse_geocode, axis=1)
+                # update DataFrame with the geocoded information
+                df.update(geocoded_rows)
+                save_geocode_cache(s3, config, dc_config)
 
         ## IMPUTE bedroom & bathroom ##
-        df['square_feet_group'] = (df['square_feet'] // 100).astype(int)
-        # impute with average bed/bath in sq_feet groups
-        sq_means = df.groupby('square_feet_group')[['bedrooms', 'bathrooms']].transform("mean")
-        df['bedrooms'].fillna(sq_means['bedrooms'], inplace=True)
-        df['bathrooms'].fillna(sq_means['bathrooms'], inplace=True)
-        # remaining bathrooms - impute with average bedroom
-        bd_means = df.groupby('bedrooms')[['bathrooms']].transform("mean")
-        df['bathrooms'].fillna(round(bd_means['bathrooms'],0), inplace=True)
-
-        ## Standardize rent price to monthly rent
-        df.loc[df['price_type'] == 'weekly', 'price'] = df['price'] * 4
-        df.loc[df['price_type'] == 'weekly', 'price_type'] = 'monthly'
-        df = df[df['price_type'] == 'monthly']
-
-        # Change has_photo to binary
-        df['has_photo'] = df['has_photo'].replace('thumbnail', 'yes')
-
-        ## IMPUTE pets_allowed ##
-        # df['pets_allowed'] = df['pets_allowed'].fillna("None")
-        df['pets_allowed'].replace("cats,dogs,none", "none", inplace=True)
-        df.pets_allowed = df.pets_allowed.apply(lambda x: x.split(',') if pd.notna(x) else [])
-        df['cats_allowed'] = df['pets_allowed'].apply(lambda x: 'yes' if isinstance(x, list) and 'cats' in x else 'no')
-        df['dogs_allowed'] = df['pets_allowed'].apply(lambda x: 'yes' if isinstance(x, list) and 'dogs' in x else 'no')
-        logger.info("Finished imputing data...")
-        ############### FEATURE ENGINEERING ##################
-
-        # convert to number of amenities
-        df['n_amenities'] = df.amenities.apply(len)
-        # drop amentities list
-        # df = df.drop(columns=['amenities'])
-
-        df['price_per_sq_feet'] = df.price / df.square_feet
-        logger.info("Finished feature engieering...")
+        with instr.span(f"impute_{subset}"):
+            df['square_feet_group'] = (df['square_feet'] // 100).astype(int)
+            # chunks get the means of the whole split, see room_means()
+            impute_rooms(df, *(means or ()))
+
+            ## Standardize rent price to monthly rent
+            df.loc[df['price_type'] == 'weekly', 'price'] = df['price'] * 4
+            df.loc[df['price_type'] == 'weekly', 'price_type'] = 'monthly'
+            df = df[df['price_type'] == 'monthly']
+
+            # Change has_photo to binary
+            df['has_photo'] = df['has_photo'].replace('thumbnail', 'yes')
+
+            ## IMPUTE pets_allowed ##
+            # df['pets_allowed'] = df['pets_allowed'].fillna("None")
+            pets = df['pets_allowed'].replace("cats,dogs,none", "none")
+            df['pets_allowed'] = split_to_list(pets)
+            # wrap in commas so only whole items match
+            pets = ',' + pets.fillna('') + ','
+            df['cats_allowed'] = map_unique(pets, lambda s: s.str.contains(',cats,', regex=False)
+                                                           .map({True: 'yes', False: 'no'}))
+            df['dogs_allowed'] = map_unique(pets, lambda s: s.str.contains(',dogs,', regex=False)
+                                                           .map({True: 'yes', False: 'no'}))
+            logger.info("Finished imputing data...")
+            ############### FEATURE ENGINEERING ##################
+
+            # convert to number of amenities and split str to list of amenities
+            df['n_amenities'] = map_unique(df.amenities, lambda s: s.astype(str).str.count(',') + 1,
+                                           missing=0).astype('int64')
+            df['amenities'] = split_to_list(df.amenities)
+            # drop amentities list
+            # df = df.drop(columns=['amenities'])
+
+            df['price_per_sq_feet'] = df.price / df.square_feet
+
+            # low-cardinality str columns as categoricals
+            for column in dc_config['dc']['categorical_columns']:
+                df[column] = df[column].astype('category')
+            logger.info("Finished feature engieering...")
+
+        return df
+
+def data_clean(df, s3, config, dc_config, subset='train'):
+        df = clean_frame(df, s3, config, dc_config, subset)
 
         ############### SAVE DATA TO S3 ###############
-        csv_buffer = BytesIO()
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
-        _ = au.s3_upload(s3, config, dc_config['s3'][subset]['clean_data'], csv_buffer.getvalue())
+        output_config = dc_config['output']
+        clean_key = f"{dc_config['s3'][subset]['clean_data']}.{output_config['format']}"
+        # streamed to S3 as a multipart upload while it is written
+        with instr.span(f"upload_{subset}") as stage, au.s3_writer(s3, config, clean_key) as f:
+            if output_config['format'] == 'parquet':
+                # keeps dtypes: categoricals and the amenities/pets_allowed lists
+                df.to_parquet(f, index=False, compression=output_config['compression'])
+            else:
+                df.to_csv(f, index=False, mode='wb')
+            stage.bytes_out = f.tell()
+        logger.info(f"File {clean_key} uploaded.")
 
         return {
                 'statusCode': 200,
                 'body': json.dumps('Data cleaning and upload completed successfully.')
                 }
 
+def read_raw_chunks(s3, config, dc_config, chunk_rows, columns=None, span_name=None):
+    # stream both raw files from S3, chunk_rows rows at a time
+    for key in (dc_config['s3']['raw_data'], dc_config['s3']['raw_data2']):
+        with pd.read_csv(au.s3_stream(s3, config, key), encoding='ISO-8859-1', sep=';',
+                         dtype=RAW_DTYPES, usecols=columns, chunksize=chunk_rows) as reader:
+            while True:
+                with instr.span(span_name) if span_name else nullcontext():
+                    chunk = next(reader, None)
+                if chunk is None:
+                    break
+                yield chunk
+
+def room_means(s3, config, dc_config):
+    # first pass for the chunked mode: the bed/bath means of impute_rooms() per split, summed
+    # over the chunks. The bathrooms by bedrooms are averaged over the listings with both known
+    sums = {subset: [None, None] for subset in ('train', 'test')}
+    columns = ['id', 'latitude', 'longitude', 'price', 'square_feet', 'bedrooms', 'bathrooms']
+    for chunk in read_raw_chunks(s3, config, dc_config, dc_config['chunked']['chunk_rows'], columns):
+        splits = hash_split(chunk, dc_config['split']['train_fraction'])
+        for subset, df in zip(('train', 'test'), splits):
+            df = drop_unusable(df)
+            sq = df.groupby(df['square_feet'] // 100)[['bedrooms', 'bathrooms']].agg(['sum', 'count'])
+            bd = df.groupby('bedrooms')['bathrooms'].agg(['sum', 'count'])
+            totals = sums[subset]
+            sums[subset] = [part if total is None else total.add(part, fill_value=0)
+                            for total, part in zip(totals, (sq, bd))]
+    means = {}
+    for subset, (sq, bd) in sums.items():
+        sq_means = pd.DataFrame({column: sq[column]['sum'] / sq[column]['count']
+                                 for column in ('bedrooms', 'bathrooms')})
+        means[subset] = (sq_means, bd['sum'] / bd['count'])
+    return means
+
+def arrow_schema(table):
+    # schema every chunk is cast to: columns that are all null in the first chunk are strings
+    # (as are list items), categoricals get int32 codes whatever their number of categories
+    fields = []
+    for field in table.schema:
+        dtype = field.type
+        if pa.types.is_null(dtype):
+            dtype = pa.string()
+        elif pa.types.is_list(dtype) and pa.types.is_null(dtype.value_type):
+            dtype = pa.list_(pa.string())
+        elif pa.types.is_dictionary(dtype):
+            dtype = pa.dictionary(pa.int32(), pa.string())
+        fields.append(field.with_type(dtype))
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+class CleanDataWriter:
+    """
+    Appends cleaned chunks to the clean data file of a split, streamed to S3 as a multipart
+    upload. With parquet every chunk is a row group of the same file, so readers of the
+    clean data do not change. The upload is aborted if the `with` block raises.
+    """
+
+    def __init__(self, s3, config, key, output_config):
+        self.file = au.s3_writer(s3, config, key)
+        self.output_config = output_config
+        self.parquet = None
+        self.rows = 0
+
+    def write(self, df):
+        # returns the number of bytes the chunk added to the file
+        start = self.file.tell()
+        if self.output_config['format'] == 'parquet':
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet is None:
+                self.parquet = pq.ParquetWriter(self.file, arrow_schema(table),
+                                                compression=self.output_config['compression'])
+            self.parquet.write_table(table.cast(self.parquet.schema))
+        else:
+            df.to_csv(self.file, index=False, header=self.rows == 0, mode='wb')
+        self.rows += len(df)
+        return self.file.tell() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # the parquet writer does not close the file; the upload is completed or aborted here
+        if self.parquet is not None:
+            self.parquet.close()
+        return self.file.__exit__(exc_type, exc, tb)
 
+def chunked_clean(s3, config, dc_config):
+    # out-of-core mode: stream the raw files, split each chunk by id hash, clean it with the
+    # bed/bath means of the whole split and append it to the clean data of the split
+    with instr.span("room_means"):
+        means = room_means(s3, config, dc_config)
+    logger.info("Computed bed/bath means of the splits...")
+
+    output_config = dc_config['output']
+    keys = {subset: f"{dc_config['s3'][subset]['clean_data']}.{output_config['format']}"
+            for subset in ('train', 'test')}
+    with CleanDataWriter(s3, config, keys['train'], output_config) as train_writer, \
+            CleanDataWriter(s3, config, keys['test'], output_config) as test_writer:
+        writers = {'train': train_writer, 'test': test_writer}
+        for chunk in read_raw_chunks(s3, config, dc_config, dc_config['chunked']['chunk_rows'],
+                                     span_name='parse'):
+            splits = hash_split(chunk, dc_config['split']['train_fraction'])
+            for subset, df in zip(('train', 'test'), splits):
+                df = clean_frame(df, s3, config, dc_config, subset, means[subset])
+                with instr.span(f"upload_{subset}") as stage:
+                    stage.bytes_out = writers[subset].write(df)
+    for subset, writer in writers.items():
+        logger.info(f"File {keys[subset]} uploaded ({writer.rows} rows).")
+
+def read_json(s3, config, key):
+    content = au.s3_get_obj(s3, config, key)
+    return json.load(content) if content is not None else None
+
+def clean_inputs(s3, config, dc_config):
+    # what the clean data is made from: per raw file its sha256 from the ingestion manifest and
+    # its S3 ETag (which changes if the file is replaced some other way), and this config
+    manifest = read_json(s3, config, dc_config['s3']['raw_manifest']) or {}
+    raw_files = {}
+    for key in (dc_config['s3']['raw_data'], dc_config['s3']['raw_data2']):
+        sha256 = manifest.get('files', {}).get(key, {}).get('sha256')
+        raw_files[key] = [sha256, au.s3_etag(s3, config, key)]
+    with open('data_clean_config.yaml', 'rb') as file:
+        config_sha256 = hashlib.sha256(file.read()).hexdigest()
+    return {'raw_files': raw_files, 'config_sha256': config_sha256}
+
+def is_up_to_date(s3, config, dc_config, inputs):
+    # the clean data in S3 was made from the same inputs; unknown inputs never are
+    if any(None in values for values in inputs['raw_files'].values()):
+        return False
+    last = read_json(s3, config, dc_config['s3']['clean_manifest'])
+    return last is not None and last['inputs'] == inputs
 
 def lambda_handler(event, context):
     try:
@@ -129,18 +363,47 @@ def lambda_handler(event, context):
 
         with open('data_clean_config.yaml', 'r') as file:
             dc_config = yaml.safe_load(file)
+        run = instr.start_run("data_clean", getattr(context, 'aws_request_id', None))
 
         ## connect to s3
         s3 = au.s3_client(config)
         logger.info("Connected to s3...")
 
-        # Split data
-        train, test = train_test_split(s3, config, dc_config)
+        with instr.span("check_inputs"):
+            inputs = clean_inputs(s3, config, dc_config)
+            skip = (dc_config['incremental']['skip_unchanged'] and
+                    is_up_to_date(s3, config, dc_config, inputs))
+        if skip:
+            logger.info("Raw data and config unchanged since the last run, skipping cleaning")
+            au.s3_upload(s3, config, f"{dc_config['timings']['key_prefix']}/{run.run_id}.json",
+                         run.to_json())
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Raw data unchanged, cleaning skipped.')
+            }
+
+        if dc_config['chunked']['enabled']:
+            # data larger than the Lambda memory
+            chunked_clean(s3, config, dc_config)
+            logger.info("Finished cleaning train and test in chunks")
+        else:
+            # Split data
+            train, test = train_test_split(s3, config, dc_config)
+
+            data_clean(train, s3, config, dc_config, 'train')
+            logger.info("Finished cleaning train")
+            data_clean(test, s3, config, dc_config, 'test')
+            logger.info("Finished cleaning test")
+
+        # the inputs of the clean data now in S3, for the next run
+        manifest = {'inputs': inputs, 'run_id': run.run_id,
+                    'cleaned_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        au.s3_upload(s3, config, dc_config['s3']['clean_manifest'],
+                     json.dumps(manifest, indent=2).encode('utf-8'))
 
-        data_clean(train, s3, config, dc_config, 'train')
-        logger.info("Finished cleaning train")
-        data_clean(test, s3, config, dc_config, 'test')
-        logger.info("Finished cleaning test")
+        # stage timings of the run, next to the other runs of the stage
+        au.s3_upload(s3, config, f"{dc_config['timings']['key_prefix']}/{run.run_id}.json",
+                     run.to_json())
 
     except Exception as e:
         # Log the exception
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The Lambda's modules are imported from its task root (the Lambda folder)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
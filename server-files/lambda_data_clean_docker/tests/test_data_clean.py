@@ -0,0 +1,115 @@
+import configparser
+import logging
+from pathlib import Path
+
+import pandas as pd
+import pytest
+import yaml
+from botocore.exceptions import ClientError
+
+import aws_utils as au
+import geolocate as gl
+import lambda_function as lf
+from benchmark_clean import row_wise_clean
+
+LAMBDA_DIR = Path(__file__).resolve().parents[1]
+FIXTURE = Path(__file__).parent / "fixtures" / "raw_listings.csv"
+
+
+@pytest.fixture
+def dc_config():
+    with open(LAMBDA_DIR / "data_clean_config.yaml") as file:
+        dc_config = yaml.safe_load(file)
+    # no Nominatim calls and no geocode cache in S3
+    dc_config["geocode"]["nominatim_fallback"] = False
+    return dc_config
+
+
+@pytest.fixture
+def raw():
+    return pd.read_csv(FIXTURE, encoding="ISO-8859-1", sep=";", dtype=lf.RAW_DTYPES)
+
+
+def test_clean_frame_matches_row_wise_clean(raw, dc_config, monkeypatch):
+    monkeypatch.setattr(gl.geocode_cache, "loaded", True)
+
+    clean = lf.clean_frame(raw.copy(), None, None, dc_config)
+    expected = row_wise_clean(raw.copy(), dc_config)
+
+    # the vectorized version stores the low-cardinality columns as categoricals
+    categorical = dc_config['dc']['categorical_columns']
+    assert all(isinstance(clean[column].dtype, pd.CategoricalDtype) for column in categorical)
+    clean[categorical] = clean[categorical].astype(object)
+    pd.testing.assert_frame_equal(clean, expected)
+    # the fixture covers the edge cases of the transforms
+    assert ['none'] in expected['pets_allowed'].tolist()
+    assert (expected['n_amenities'] == 0).any()
+    assert (expected['price_type'] == 'monthly').all() and len(expected) < len(raw)
+
+
+
+class MissingObjects:
+    """
+    S3 client whose bucket is empty, like the bucket before the first run. Without
+    s3:ListBucket, S3 answers a missing key with 403 instead of 404.
+    """
+
+    def __init__(self, code="404"):
+        self.code = code
+
+    def _not_found(self, operation):
+        return ClientError({"Error": {"Code": self.code, "Message": "Not Found"}}, operation)
+
+    def head_object(self, **kwargs):
+        raise self._not_found("HeadObject")
+
+    def download_fileobj(self, **kwargs):
+        raise self._not_found("HeadObject")
+
+    def download_file(self, **kwargs):
+        raise self._not_found("HeadObject")
+
+
+@pytest.mark.parametrize("code", ["404", "NoSuchKey", "403", "AccessDenied"])
+def test_missing_objects_are_logged_without_traceback(caplog, code):
+    config = configparser.ConfigParser()
+    config.read_dict({"s3": {"bucket_name": "bucket"}})
+    s3 = MissingObjects(code)
+
+    with caplog.at_level(logging.INFO):
+        assert au.s3_etag(s3, config, "data/raw/raw_1.csv") is None
+        assert au.s3_get_obj(s3, config, "data/clean/manifest.json") is None
+        assert au.s3_download(s3, config, "data/geocode/geocode_cache.sqlite",
+                              "geocode_cache.sqlite") is None
+
+    assert [record.levelno for record in caplog.records] == [logging.INFO] * 3
+    assert not any(record.exc_info for record in caplog.records)
+
+
+def test_failed_reverse_geocode_is_not_cached(tmp_path, monkeypatch):
+    cache = gl.GeocodeCache()
+    monkeypatch.setattr(gl, "geocode_cache", cache)
+    monkeypatch.setattr(gl, "get_location", lambda latitude, longitude: None)
+    assert gl.reverse_geocode(40.0, -75.0) == (None, None)
+    assert cache.entries == {} and cache.new_entries == {}
+
+    class Location:
+        raw = {"address": {"county": "Bucks County", "state": "Pennsylvania"}}
+
+    monkeypatch.setattr(gl, "get_location", lambda latitude, longitude: Location())
+    assert gl.reverse_geocode(40.0, -75.0) == ("Bucks County", "PA")
+    assert cache.get(40.0, -75.0) == ("Bucks County", "PA")
+
+    # failed lookups persisted by older versions are ignored when loading
+    cache.add(41.0, -76.0, None, None)
+    path = tmp_path / "geocode_cache.sqlite"
+    cache.save(path)
+    reloaded = gl.GeocodeCache()
+    reloaded.load(path)
+    assert reloaded.entries == {(40.0, -75.0): ("Bucks County", "PA")}
+
+
+def test_split_to_list_casts_non_str_values():
+    amenities = pd.Series(["gym,pool", 5, None, 2.5, "gym,pool"], dtype=object)
+    assert lf.split_to_list(amenities).tolist() == [["gym", "pool"], ["5"], [], ["2.5"],
+                                                    ["gym", "pool"]]
@@ -0,0 +1,88 @@
+"""
+Latency benchmark of the NumPy forest engine (`prediction_utils.CompactForest`) against
+sklearn's RandomForestRegressor.predict, on the artifacts of one training run.
+
+    python benchmark_prediction.py --model tmo.pkl --forest tmo.npz
+
+Rows are drawn around the split thresholds of each feature so that the benchmark walks
+the trees as deep as real listings do. For each batch size it checks that both engines
+return the same predictions and prints the median and p95 latency of each one.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+import prediction_utils as pu
+
+
+def sample_rows(forest: pu.CompactForest, n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Draw rows whose feature values are split thresholds of the forest plus a small jitter.
+
+    Args:
+        forest: The exported forest.
+        n_rows: Number of rows to draw.
+        seed: Random seed.
+
+    Returns:
+        DataFrame with the model features, in the model's column order.
+    """
+    rng = np.random.default_rng(seed)
+    split = forest.feature >= 0
+    columns = {}
+    for idx, name in enumerate(forest.feature_names_in_.tolist()):
+        thresholds = forest.threshold[split & (forest.feature == idx)]
+        if thresholds.size == 0:
+            thresholds = np.zeros(1)
+        columns[name] = rng.choice(thresholds, n_rows) + rng.normal(0, 0.5, n_rows)
+    return pd.DataFrame(columns)
+
+
+def time_calls(func, repeats: int) -> dict:
+    """Median and p95 wall time of `repeats` calls to func, in milliseconds."""
+    func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1e3)
+    return {"p50_ms": round(float(np.median(times)), 3),
+            "p95_ms": round(float(np.percentile(times, 95)), 3)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the latency of sklearn and the NumPy forest engine"
+    )
+    parser.add_argument("--model", required=True, help="Path to the pickled model (tmo.pkl)")
+    parser.add_argument("--forest", required=True,
+                        help="Path to the exported forest (tmo.npz or tmo.forest.joblib)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    model = pu.load_model(args.model)
+    if args.forest.endswith(".npz"):
+        forest = pu.load_forest(args.forest)
+    else:
+        forest = pu.load_forest_mmap(args.forest)
+
+    report = []
+    for batch_size in args.batch_sizes:
+        X = sample_rows(forest, batch_size, seed=batch_size)
+        max_abs_diff = float(np.max(np.abs(model.predict(X) - forest.predict(X))))
+        # Fewer repeats for large batches, which take long enough to time reliably
+        repeats = max(3, args.repeats * 100 // max(batch_size, 100))
+        report.append({
+            "batch_size": batch_size,
+            "max_abs_diff": max_abs_diff,
+            "sklearn": time_calls(lambda: model.predict(X), repeats),
+            "numpy_engine": time_calls(lambda: forest.predict(X), repeats),
+        })
+        print(json.dumps(report[-1]))
+
+    if any(row["max_abs_diff"] > 1e-9 for row in report):
+        raise SystemExit("Predictions of the NumPy engine differ from sklearn")
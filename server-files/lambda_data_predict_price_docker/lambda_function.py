@@ -1,48 +1,180 @@
 import os
 import json
 import boto3
-import joblib
 import logging
 import yaml
 import pandas as pd 
 import numpy as np
 import prediction_utils as pu
+import instrumentation as instr
 from configparser import ConfigParser
 
 # Set logger
 logger = logging.getLogger(__name__)
 
-def input_type_checker(input_dict):
-  mapper = {
-      "bathrooms": int,
-      "bedrooms": int,
-      "amenities": lambda x: [str(item) for item in x],
-      "has_photos": str,
-      "dogs_allowed": str,
-      "cats_allowed": str,
-      "fee": str,
-      "square_feet": int,
-      "address": str,
-      "cityname": str,
-      "state": str,
-      "zipcode": int
-    }
-   # Iterate over the items in the input dictionary
-  for key, value in input_dict.items():
-      # Cast to the type specified in mapper if the key is in the mapper
-      if key in mapper:
-          try:
-            input_dict[key] = mapper[key](value)
-            if isinstance(input_dict[key], str):
-                    input_dict[key] = input_dict[key].lower()
-          except ValueError as e:
-              raise ValueError(f"Invalid type for {key}: {e}")
-  return input_dict
-   
+# Expected type of each listing field
+mapper = {
+    "bathrooms": int,
+    "bedrooms": int,
+    "amenities": list,
+    "has_photo": str,
+    "dogs_allowed": str,
+    "cats_allowed": str,
+    "fee": str,
+    "square_feet": int,
+    "address": str,
+    "cityname": str,
+    "state": str,
+    "zipcode": int
+  }
+
+
+def validate_listings(df, required=()):
+  """
+  Coerces a frame of listings to the types in `mapper`, column by column.
+  Integer fields are cast with pd.to_numeric, string fields are lowercased with
+  the vectorized .str accessor and amenities must be a list, whose items are
+  cast to str.
+
+  Returns the coerced frame, a boolean mask with True for invalid rows and an
+  array with the error message of each row ('' for valid rows).
+  """
+  df = df.copy()
+  error_mask = np.zeros(len(df), dtype=bool)
+  messages = np.full(len(df), '', dtype=object)
+
+  def flag(mask, message):
+    mask = np.asarray(mask, dtype=bool)
+    messages[mask] = messages[mask] + message
+    error_mask[mask] = True
+
+  # Required fields must be present and not null
+  for field in required:
+    if field not in df:
+      flag(np.ones(len(df), dtype=bool), f"Missing field {field}; ")
+    else:
+      flag(df[field].isna(), f"Missing field {field}; ")
+
+  for field, field_type in mapper.items():
+    if field not in df:
+      continue
+    col = df[field]
+    present = col.notna().to_numpy()
+
+    if field_type is int:
+      values = pd.to_numeric(col, errors='coerce')
+      flag(present & values.isna().to_numpy(), f"Invalid type for {field}; ")
+      df[field] = np.trunc(values)
+    elif field_type is str:
+      # object first: a categorical column (e.g. Parquet from the clean stage) takes no new values
+      col = col.astype(object)
+      df[field] = col.where(~present, col.astype(str).str.lower())
+    elif field_type is list:
+      is_list = present & col.map(pd.api.types.is_list_like).to_numpy(dtype=bool)
+      flag(present & ~is_list, f"Invalid type for {field}: expected a list; ")
+      values = col.to_numpy(dtype=object, copy=True)
+      for idx in np.flatnonzero(is_list):
+        values[idx] = [str(item) for item in values[idx]]
+      df[field] = values
+
+  return df, error_mask, messages
+
+
+def validate_listing(listing, required=()):
+  """
+  Single-listing version of validate_listings that coerces the dict itself,
+  without building a DataFrame. Used by the fused pipeline's one-row path.
+
+  Returns the coerced listing and its error message ('' for a valid listing).
+  """
+  if not isinstance(listing, dict):
+    return listing, "Listing must be a JSON object"
+  listing = dict(listing)
+  messages = []
+
+  def missing(value):
+    return value is None or (not pd.api.types.is_list_like(value) and pd.isna(value))
+
+  for field in required:
+    if missing(listing.get(field)):
+      messages.append(f"Missing field {field}")
+
+  for field, field_type in mapper.items():
+    value = listing.get(field)
+    if missing(value):
+      continue
+
+    if field_type is int:
+      try:
+        listing[field] = np.trunc(float(value))
+      except (TypeError, ValueError):
+        messages.append(f"Invalid type for {field}")
+    elif field_type is str:
+      listing[field] = str(value).lower()
+    elif field_type is list:
+      if pd.api.types.is_list_like(value):
+        listing[field] = [str(item) for item in value]
+      else:
+        messages.append(f"Invalid type for {field}: expected a list")
+
+  return listing, "; ".join(messages)
+
+
+def predict_batch(listings, model, encoder, sklearn_model=None):
+  """
+  Predicts the price of many listings with one validation pass, one encoder
+  transform and one model predict. Rows that fail validation get an error
+  instead of a prediction, so a bad row does not fail the whole batch.
+  If given, the sklearn model of the same version predicts instead of the
+  NumPy engine of `model` (faster on large batches); the features are still
+  built by `model`.
+
+  Returns a list with one result per listing, in input order.
+  """
+  if isinstance(listings, pd.DataFrame):
+    df = listings.reset_index(drop=True)
+    not_dict = np.zeros(len(df), dtype=bool)
+  else:
+    not_dict = np.array([not isinstance(listing, dict) for listing in listings], dtype=bool)
+    df = pd.DataFrame([{} if bad else listing for listing, bad in zip(listings, not_dict)])
+
+  df, error_mask, messages = validate_listings(df, pu.required_fields(model, encoder))
+  messages[not_dict] = "Listing must be a JSON object"
+  error_mask |= not_dict
+
+  pred_prices = np.full(len(df), np.nan)
+  if not error_mask.all():
+    features = pu.make_features(df[~error_mask], model, encoder)
+    if sklearn_model is None:
+      pred_prices[~error_mask] = np.round(model.predict(features), 2)
+    else:
+      if isinstance(features, np.ndarray):
+        features = pd.DataFrame(features, columns=model.feature_names_in_)
+      pred_prices[~error_mask] = np.round(sklearn_model.predict(features), 2)
+
+  return [{"index": idx, "error": messages[idx].rstrip('; ')} if error_mask[idx]
+          else {"index": idx, "pred_price": float(pred_prices[idx])}
+          for idx in range(len(df))]
+
+
+# Model and encoder kept in memory across warm invocations of the same container
+artifact_cache = None
+
+
+def get_artifact_cache(inf_config):
+  """
+  Returns the module-level artifact cache, creating it on the first (cold) invocation.
+  """
+  global artifact_cache
+  if artifact_cache is None:
+    artifact_cache = pu.ArtifactCache(ttl_seconds=inf_config.get('cache_ttl_seconds', 300))
+  return artifact_cache
+
 
 def lambda_handler(event, context):
   try:
     print("**STARTED**")
+    instr.start_run("predict_price", getattr(context, "aws_request_id", None))
     
     # ----------------------------------------------------------------
     # setup AWS S3 access based on config file:
@@ -50,9 +182,10 @@ def lambda_handler(event, context):
     config_file = 'config.ini' 
     s3_profile = 'aws-mlops-s3readonly'
     
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    boto3.setup_default_session(profile_name=s3_profile)
-    print("Setting up boto3")
+    if artifact_cache is None:
+      os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+      boto3.setup_default_session(profile_name=s3_profile)
+      print("Setting up boto3")
     
     configur = ConfigParser()
     configur.read(config_file)
@@ -61,31 +194,44 @@ def lambda_handler(event, context):
        inf_config = yaml.safe_load(file)
     bucketname = configur.get('s3', 'bucket_name')
     print("loaded config file")
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    print("Connected to S3")
 
     # ----------------------------------------------------------------
-    # extract tmo file 
+    # Get model and encoder (from memory on warm invocations)
     # ----------------------------------------------------------------
-    # Get model dictionary.
-    model_dict = pu.get_model_dict(bucketname, "modeling_artifacts/")
-
+    with instr.span("load_model"):
+      model, encoder = get_artifact_cache(inf_config).get(bucketname, inf_config)
+    print("Loaded model and encoder")
 
     # ----------------------------------------------------------------
-    # Download tmo file from S3 to local filesystem:
+    # Batch mode: list of listings or S3 key to a JSONL/Parquet file
     # ----------------------------------------------------------------
+    if isinstance(event, list) or (isinstance(event, dict) and
+                                   ("listings" in event or "listings_s3_key" in event)):
+      if isinstance(event, list):
+        listings = event
+      elif "listings" in event:
+        listings = event["listings"]
+      else:
+        with instr.span("download_listings"):
+          s3_client = boto3.client('s3')
+          listings = pu.read_listings(s3_client, bucketname, event["listings_s3_key"])
+      print(f"Batch prediction for {len(listings)} listings")
 
-    # Download file from s3
-    logger.info("**Downloading model pikle file from S3**")
-    bucket.download_file(model_dict["tmo_key"], inf_config['model_save_path'])
-    print("Downloaded model pkl file")
-    
-    # load pickle file
-    model = pu.load_model(inf_config['model_save_path'])
-    print("Loaded model pkl file")
-  
+      # sklearn is faster than the NumPy engine above a few hundred rows
+      sklearn_model = None
+      if len(listings) >= inf_config.get('sklearn_min_batch_rows', float('inf')):
+        with instr.span("load_sklearn_model"):
+          sklearn_model = get_artifact_cache(inf_config).sklearn_model(bucketname, model)
+
+      with instr.span("predict_batch"):
+        results = predict_batch(listings, model, encoder, sklearn_model)
+      n_errors = sum("error" in result for result in results)
+      print(f"**BATCH PREDICTION DONE, {n_errors} rows with errors**")
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"predictions": results, "n_errors": n_errors})
+      }
 
     # ----------------------------------------------------------------
     # Extract input data from event
@@ -93,48 +239,20 @@ def lambda_handler(event, context):
     if not event:
         # Raise error if input data does not exist
         raise ValueError("No input data provided for prediction.")
-    else:
-      # Get input data from event and convert to pandas df
-      input_data_dict = input_type_checker(event)
-      df = pd.DataFrame([input_data_dict])
-      print("Prediction input valid")
-
 
-    # ----------------------------------------------------------------
-    # Cleand and get features 
-    # ----------------------------------------------------------------    
-
-
-    # Download the file
-    bucket.download_file(inf_config['encoder_s3_key'], inf_config['encoder_save_path'])
-    encoder = joblib.load(inf_config['encoder_save_path'])
-    print("Loaded encoder")
-
-    # Transform the categorical data
-    encoded_data = encoder.transform(df[encoder.feature_names_in_.tolist()])
-
-    # Convert the encoded data to DataFrame
-    encoded_df = pd.DataFrame(encoded_data, columns=encoder.get_feature_names_out())
-
-    # Merge the encoded categorical data with the numerical data
-    df = pd.concat([df, encoded_df], axis=1)
-
-    df['n_amenities'] = df.amenities.apply(len)
-    print("Created new features")
-
-    # ----------------------------------------------------------------
-    # Make prediction
-    # ----------------------------------------------------------------
-    # Get prediction for selected features
-
-    if hasattr(model, 'feature_names_in_'):
-      features = model.feature_names_in_.tolist()
-    try:
-        pred_price = round(model.predict(df[features])[0],2)
-    except ValueError as err:
-        logger.warning("Error with the feature shape or values. Setting predicted class and" +
-                        " probability to NA. Error: %s", err)
-        return np.nan
+    with instr.span("predict"):
+      if isinstance(model, pu.InferencePipeline):
+          # Fused pipeline: the listing fills one feature vector, no DataFrame
+          listing, error = validate_listing(event, model.required_fields)
+          if error:
+              raise ValueError(error)
+          pred_price = float(np.round(model.predict(model.vector(listing)), 2)[0])
+      else:
+          # Single listing goes through the same validation and feature path as a batch
+          result = predict_batch([event], model, encoder)[0]
+          if "error" in result:
+              raise ValueError(result["error"])
+          pred_price = result["pred_price"]
 
     
     print("**PREDICTION DONE, returning results**")
@@ -157,20 +275,22 @@ def lambda_handler(event, context):
       'statusCode': 400,
       'body': json.dumps(str(err))
     }
-event = {
-  "bathrooms": 2,
-  "bedrooms": 2,
-  "amenities": [
-    "Gym"
-  ],
-  "has_photo": "Yes",
-  "dogs_allowed": "Yes",
-  "cats_allowed": "no",
-  "fee": "Yes",
-  "square_feet": 500,
-  "address": "test address",
-  "cityname": "Evanston",
-  "state": "IL",
-  "zipcode": 60201
-}
-lambda_handler(event,None)
\ No newline at end of file
+
+if __name__ == "__main__":
+  event = {
+    "bathrooms": 2,
+    "bedrooms": 2,
+    "amenities": [
+      "Gym"
+    ],
+    "has_photo": "Yes",
+    "dogs_allowed": "Yes",
+    "cats_allowed": "no",
+    "fee": "Yes",
+    "square_feet": 500,
+    "address": "test address",
+    "cityname": "Evanston",
+    "state": "IL",
+    "zipcode": 60201
+  }
+  lambda_handler(event,None)
@@ -2,90 +2,534 @@
 This module provides auxiliary functions to predict price of an apartment.
 """
 import boto3
+import io
+import joblib
+import json
 import pickle
 from pathlib import Path
 import logging
-import sys
+import threading
+import time
 import typing
 import pandas as pd
 import numpy as np
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 
 # Set logger
 logger = logging.getLogger(__name__)
 
-def get_model_dict(bucket_name: str, artifacts_prefix: str) -> dict:
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024, max_concurrency=8)
+
+def get_manifest(bucket_name: str, manifest_key: str, s3_client=None,
+                 etag: str = None) -> typing.Optional[typing.Tuple[dict, str]]:
     """
-    Retrieves the trained model from an AWS S3 bucket and creates a dictionary with
-    the model name, key, and local path.
+    Read the manifest of the current model version written by the training Lambda. The
+    manifest holds the S3 keys of the model files and the encoder, the feature list, the
+    metrics and the content hashes of the version.
 
     Args:
-        bucket_name (str): The name of the S3 bucket where the model files are stored.
-        artifacts_prefix (str): The prefix of the S3 keys that identifies the model files.
-        local_folder (Path): The local path where the model files will be stored after download.
+        bucket_name (str): The name of the S3 bucket where the artifacts are stored.
+        manifest_key (str): The S3 key of the current manifest.
+        s3_client: Optional boto3 S3 client to reuse. A new one is created if not given.
+        etag (str): ETag of a manifest already read. If it is still current, S3 answers
+                    304 Not Modified without sending the object.
 
     Returns:
-        model_dict (dict): A dictionary containing the model name, S3 key, and local path.
+        Tuple with the manifest and its ETag, or None if the manifest did not change.
     """
-    s3_client = boto3.client('s3')
-    
-    try:
-        # List all objects within the specified bucket and prefix
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=artifacts_prefix)
-        if 'Contents' not in response:
-            logger.error(f"Bucket {bucket_name} with prefix {artifacts_prefix} has no files.")
-            sys.exit(1)
+    if s3_client is None:
+        s3_client = boto3.client('s3')
 
-        # Filter out the .pkl files
-        model_files = [obj for obj in response['Contents'] if obj['Key'].endswith('.pkl')]
-
-        if not model_files:
-            logger.error(f"Bucket {bucket_name} with prefix {artifacts_prefix} has no .pkl files.")
-            sys.exit(1)
+    request = {'Bucket': bucket_name, 'Key': manifest_key}
+    if etag is not None:
+        request['IfNoneMatch'] = etag
+    try:
+        response = s3_client.get_object(**request)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None
+        logger.error(f"Encountered an error reading the model manifest {manifest_key}: {e}")
+        raise
 
-        # Sort the models by last modified date in descending order
-        model_files.sort(key=lambda obj: obj['LastModified'], reverse=True)
+    manifest = json.loads(response['Body'].read())
+    return manifest, response['ETag']
 
-        # Select the most recent model file
-        latest_model = model_files[0]
 
-        # Create the model dictionary
-        model_dict = {
-            'model_name': latest_model['Key'].split('/')[-1],
-            'tmo_key': latest_model['Key']
-        }
+def read_s3_object(s3_client, bucket_name: str, key: str) -> io.BytesIO:
+    """
+    Read an S3 object straight into memory, without a copy in /tmp. Objects larger than
+    8MB are fetched with parallel ranged GETs.
 
-        return model_dict
-    
-    except ClientError as e:
-        logger.error(f"Encountered an error accessing S3: {e}")
-        sys.exit(1)
+    Args:
+        s3_client: boto3 S3 client.
+        bucket_name (str): The name of the S3 bucket.
+        key (str): The key of the object to read.
 
+    Returns:
+        io.BytesIO with the object content, positioned at the start.
+    """
+    content = io.BytesIO()
+    s3_client.download_fileobj(Bucket=bucket_name, Key=key, Fileobj=content, Config=TRANSFER_CONFIG)
+    content.seek(0)
+    return content
 
 
-def load_model(model_file: str) -> typing.Any:
+def load_model(model_file: typing.Union[str, typing.BinaryIO]) -> typing.Any:
     """
-    Download a model file from an AWS S3 bucket and load it into memory using pickle.
+    Load a pickled model into memory.
 
     Args:
-        bucket_name (str): The name of the S3 bucket where the model file is stored.
-        model_key (str): The key in the S3 bucket that identifies the model file.
-        model_file (str): The local path where the downloaded model file will be stored.
+        model_file: The local path of the model file, or a binary file object with its content.
 
     Returns:
         The deserialized model object, as returned by pickle.load.
     """
     # load pickle file
     try:
-        model = pickle.load(open(model_file,'rb'))
+        if isinstance(model_file, str):
+            with open(model_file, 'rb') as file:
+                model = pickle.load(file)
+        else:
+            model = pickle.load(model_file)
     except FileNotFoundError:
         logger.error("Model %s not found. Application can't continue.", model_file)
-        sys.exit(1)
+        raise
     except pickle.UnpicklingError:
         logger.error("There was a problem unpickling the file. Application can't continue")
-        sys.exit(1)
+        raise
     else:
-        logger.info("Model %s loaded into memory.", model_file)
+        logger.info("Model loaded into memory.")
     # Function output
     return model
+
+
+class CompactForest:
+    """
+    Random forest regressor rebuilt from the flat node arrays exported at training time
+    (`train_model.export_forest`). Predicts directly from the arrays, without sklearn.
+    Leaf nodes (children_left == -1) hold their prediction in `threshold`.
+    """
+
+    def __init__(self, arrays: typing.Mapping[str, np.ndarray]):
+        self.tree_starts = arrays['tree_starts']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.children_left = arrays['children_left']
+        self.children_right = arrays['children_right']
+        self.feature_names_in_ = arrays['feature_names']
+        self.n_features_in_ = len(self.feature_names_in_)
+        # Depth-first built trees store the left child right after its parent
+        self.left_child_next = bool(arrays.get('left_child_next', False))
+
+    def _as_array(self, X) -> np.ndarray:
+        # sklearn trees compare float32 features against float64 thresholds
+        if isinstance(X, pd.DataFrame):
+            X = X[self.feature_names_in_.tolist()]
+        return np.asarray(X, dtype=np.float32).reshape(-1, self.n_features_in_)
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Average of the tree predictions for each row of X. All trees are walked together:
+        every (row, tree) pair holds its current node in one flat array, and each step moves
+        all pairs still on a split node one level down with a few vectorized gathers, so the
+        number of NumPy calls grows with the tree depth, not with the number of trees or rows.
+
+        Args:
+            X: DataFrame with the model features or 2D array in `feature_names_in_` order.
+
+        Returns:
+            Array with one prediction per row, equal to RandomForestRegressor.predict.
+        """
+        X = self._as_array(X)
+        n_rows, n_trees = len(X), len(self.tree_starts)
+
+        # Current node and offset of the row in the flattened X for each (row, tree) pair
+        current = np.tile(self.tree_starts.astype(np.intp), n_rows)
+        offsets = np.repeat(np.arange(n_rows) * self.n_features_in_, n_trees)
+        leaf = np.empty_like(current)
+        X_flat = X.ravel()
+
+        active = np.arange(current.size)
+        while active.size:
+            feature = self.feature[current]
+            internal = feature >= 0
+            if not internal.all():
+                # Pairs that reached a leaf (feature -2) leave the walk
+                leaf[active[~internal]] = current[~internal]
+                active, current = active[internal], current[internal]
+                feature, offsets = feature[internal], offsets[internal]
+            go_left = X_flat[offsets + feature] <= self.threshold[current]
+            left = current + 1 if self.left_child_next else self.children_left[current]
+            current = np.where(go_left, left, self.children_right[current])
+
+        # Sum tree by tree, in estimator order, to add up exactly like sklearn
+        leaf_values = self.threshold[leaf].reshape(n_rows, n_trees)
+        total = np.zeros(n_rows)
+        for tree in range(n_trees):
+            total += leaf_values[:, tree]
+        return total / n_trees
+
+
+def load_forest(model_file: typing.Union[str, typing.BinaryIO]) -> CompactForest:
+    """
+    Load a model saved as flat node arrays in a .npz file.
+
+    Args:
+        model_file: The local path of the .npz file, or a binary file object with its content.
+
+    Returns:
+        CompactForest with the same predictions as the original RandomForestRegressor.
+    """
+    with np.load(model_file, allow_pickle=False) as arrays:
+        model = CompactForest({name: arrays[name] for name in arrays.files})
+    logger.info("Model arrays loaded into memory (%d trees).", len(model.tree_starts))
+    return model
+
+
+def load_forest_mmap(model_path: str) -> CompactForest:
+    """
+    Load a model saved as flat node arrays in an uncompressed joblib file, memory-mapping
+    the arrays read-only. The node arrays stay file-backed and are paged in lazily, so they
+    do not count against the Python heap.
+
+    Args:
+        model_path (str): The local path of the .forest.joblib file.
+
+    Returns:
+        CompactForest with the same predictions as the original RandomForestRegressor.
+    """
+    model = CompactForest(joblib.load(model_path, mmap_mode='r'))
+    logger.info("Model arrays memory-mapped from %s (%d trees).", model_path, len(model.tree_starts))
+    return model
+
+
+class InferencePipeline:
+    """
+    One-hot encoder and random forest fused into one artifact at training time
+    (`train_model.export_pipeline`). The feature vector is filled straight from the raw
+    listing fields with precomputed column indices and category -> column lookup tables,
+    so no encoder, DataFrame concat or column selection by name is needed.
+    """
+
+    def __init__(self, arrays: typing.Mapping[str, typing.Any]):
+        self.forest = CompactForest(arrays)
+        self.feature_names_in_ = self.forest.feature_names_in_
+        self.n_features_in_ = self.forest.n_features_in_
+        self.numeric = list(zip(arrays['numeric_fields'].tolist(),
+                                arrays['numeric_columns'].tolist()))
+        self.categorical = list(zip(arrays['categorical_fields'].tolist(),
+                                    arrays['category_columns']))
+        self.amenities_column = int(arrays['amenities_column'])
+        self.required_fields = [field for field, _ in self.categorical + self.numeric]
+        if self.amenities_column >= 0:
+            self.required_fields.append('amenities')
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Build the feature matrix of a frame of validated listings.
+
+        Args:
+            df: Pandas DataFrame with one validated listing per row.
+
+        Returns:
+            float32 array of shape (len(df), n_features_in_), in the model's column order.
+        """
+        X = np.zeros((len(df), self.n_features_in_), dtype=np.float32)
+        for field, column in self.numeric:
+            X[:, column] = df[field].to_numpy(dtype=np.float32)
+        rows = np.arange(len(df))
+        for field, lookup in self.categorical:
+            # Unknown categories stay all zeros, as with handle_unknown='ignore'
+            columns = df[field].map(lookup).to_numpy(dtype=np.float64)
+            known = ~np.isnan(columns)
+            X[rows[known], columns[known].astype(np.int64)] = 1
+        if self.amenities_column >= 0:
+            X[:, self.amenities_column] = df['amenities'].str.len().to_numpy(dtype=np.float32)
+        return X
+
+    def vector(self, listing: typing.Mapping[str, typing.Any]) -> np.ndarray:
+        """
+        Build the feature vector of a single validated listing, without a DataFrame.
+
+        Args:
+            listing: Dictionary with the validated listing fields.
+
+        Returns:
+            float32 array of shape (1, n_features_in_), in the model's column order.
+        """
+        x = np.zeros((1, self.n_features_in_), dtype=np.float32)
+        for field, column in self.numeric:
+            x[0, column] = listing[field]
+        for field, lookup in self.categorical:
+            column = lookup.get(listing[field])
+            if column is not None:
+                x[0, column] = 1
+        if self.amenities_column >= 0:
+            x[0, self.amenities_column] = len(listing['amenities'])
+        return x
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Predict from feature vectors built by `transform` or `vector`."""
+        return self.forest.predict(X)
+
+
+def load_pipeline(model_path: str) -> InferencePipeline:
+    """
+    Load the fused encoder + forest artifact saved as an uncompressed joblib file,
+    memory-mapping its node arrays read-only.
+
+    Args:
+        model_path (str): The local path of the .pipeline.joblib file.
+
+    Returns:
+        InferencePipeline with the same predictions as the encoder and the original
+        RandomForestRegressor.
+    """
+    model = InferencePipeline(joblib.load(model_path, mmap_mode='r'))
+    logger.info("Inference pipeline memory-mapped from %s (%d trees).", model_path,
+                len(model.forest.tree_starts))
+    return model
+
+
+# Model file extension for each model_format in inference_config.yaml
+MODEL_SUFFIXES = {'pickle': '.pkl', 'npz': '.npz', 'mmap': '.forest.joblib',
+                  'pipeline': '.pipeline.joblib'}
+
+# Formats loaded from a local file in mmap_dir instead of from memory
+MMAP_LOADERS = {'mmap': load_forest_mmap, 'pipeline': load_pipeline}
+
+
+class CachedArtifacts(typing.NamedTuple):
+    """Model and encoder loaded into memory together with the manifest they came from."""
+    version: str
+    etag: str
+    model: typing.Any
+    encoder: typing.Any
+    # Pickled sklearn model of the same version, loaded on the first large batch
+    sklearn_key: typing.Optional[str] = None
+    sklearn_model: typing.Any = None
+
+
+class ArtifactCache:
+    """
+    Keeps the trained model and the encoder in memory between warm Lambda invocations.
+
+    The cached artifacts are keyed by the model version of the manifest they were loaded from.
+    The manifest is only checked again once `ttl_seconds` have passed since the last check,
+    with a conditional GET that costs no transfer while the version is unchanged; within the
+    TTL a lookup does no S3 I/O and no unpickling. When a new version is published, it is
+    downloaded and loaded completely before replacing the cached one, so callers always
+    see a consistent (model, encoder) pair.
+    """
+
+    def __init__(self, ttl_seconds: float = 300):
+        self.ttl_seconds = ttl_seconds
+        self._entry = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._s3_client = None
+
+    def get(self, bucket_name: str, inf_config: dict) -> typing.Tuple[typing.Any, typing.Any]:
+        """
+        Return the current (model, encoder) pair, refreshing it from S3 if the TTL expired
+        and a new model version was published.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket where the artifacts are stored.
+            inf_config (dict): Inference configuration with the manifest key and local paths.
+
+        Returns:
+            Tuple with the deserialized model and encoder.
+        """
+        entry = self._entry
+        if entry is not None and not self._expired():
+            return entry.model, entry.encoder
+
+        with self._lock:
+            # Another thread may have refreshed the entry while we waited for the lock
+            entry = self._entry
+            if entry is not None and not self._expired():
+                return entry.model, entry.encoder
+
+            if self._s3_client is None:
+                self._s3_client = boto3.client('s3')
+
+            current = get_manifest(bucket_name, inf_config['manifest_key'],
+                                   s3_client=self._s3_client,
+                                   etag=entry.etag if entry is not None else None)
+            if current is None:
+                logger.info("Cached model version %s is up to date.", entry.version)
+            else:
+                manifest, etag = current
+                if entry is None or entry.version != manifest['version']:
+                    entry = self._load(bucket_name, manifest, etag, inf_config)
+                else:
+                    entry = entry._replace(etag=etag)
+                # Swap in the new pair with a single assignment
+                self._entry = entry
+
+            self._checked_at = time.monotonic()
+            return entry.model, entry.encoder
+
+    def _load(self, bucket_name: str, manifest: dict, etag: str,
+              inf_config: dict) -> CachedArtifacts:
+        model_format = inf_config.get('model_format', 'pickle')
+        if model_format not in manifest['models']:
+            raise ValueError(f"Model version {manifest['version']} has no {model_format} model")
+
+        model_key = manifest['models'][model_format]
+        logger.info("Loading model version %s (%s) into the artifact cache.",
+                    manifest['version'], model_key)
+        if model_format in MMAP_LOADERS:
+            model = self._load_mmap(bucket_name, manifest, model_key, model_format, inf_config)
+        else:
+            model_file = read_s3_object(self._s3_client, bucket_name, model_key)
+            if model_format == 'npz':
+                model = load_forest(model_file)
+            else:
+                model = load_model(model_file)
+
+        # The fused pipeline carries its own category lookup tables, and a model without
+        # categorical features is published without an encoder
+        encoder = None
+        if model_format != 'pipeline':
+            if manifest.get('encoder_key') is not None:
+                encoder = joblib.load(read_s3_object(self._s3_client, bucket_name,
+                                                     manifest['encoder_key']))
+            else:
+                logger.info("Model version %s has no encoder.", manifest['version'])
+        sklearn_key = manifest['models'].get('pickle') if model_format != 'pickle' else None
+        return CachedArtifacts(manifest['version'], etag, model, encoder, sklearn_key)
+
+    def sklearn_model(self, bucket_name: str, model: typing.Any) -> typing.Any:
+        """
+        Return the pickled sklearn RandomForestRegressor of the same version as `model`, a
+        model returned by `get`. The NumPy engine is faster on small batches and sklearn on
+        large ones (see sklearn_min_batch_rows in inference_config.yaml). It is downloaded on
+        the first call only, so single-listing invocations never load it.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket where the artifacts are stored.
+            model: The model returned by `get`.
+
+        Returns:
+            The sklearn model, or None if the version has no pickle model, `model` is already
+            the sklearn model or the cache moved to another version since `get`.
+        """
+        entry = self._entry
+        if entry is None or entry.model is not model or entry.sklearn_key is None:
+            return None
+        if entry.sklearn_model is None:
+            with self._lock:
+                entry = self._entry
+                if entry.model is not model:
+                    return None
+                if entry.sklearn_model is None:
+                    logger.info("Loading the sklearn model of version %s (%s).", entry.version,
+                                entry.sklearn_key)
+                    entry = entry._replace(sklearn_model=load_model(
+                        read_s3_object(self._s3_client, bucket_name, entry.sklearn_key)))
+                    self._entry = entry
+        return entry.sklearn_model
+
+    def _load_mmap(self, bucket_name: str, manifest: dict, model_key: str, model_format: str,
+                   inf_config: dict) -> typing.Any:
+        # A memory-mapped file must not be overwritten while in use, so each version gets its
+        # own local file and the previous one is removed (its mapping stays valid until released).
+        suffix = MODEL_SUFFIXES[model_format]
+        model_path = Path(inf_config['mmap_dir']) / f"tmo-{manifest['version']}{suffix}"
+        self._s3_client.download_file(bucket_name, model_key, str(model_path),
+                                      Config=TRANSFER_CONFIG)
+        model = MMAP_LOADERS[model_format](str(model_path))
+        for old_path in Path(inf_config['mmap_dir']).glob(f"tmo-*{suffix}"):
+            if old_path != model_path:
+                old_path.unlink()
+        return model
+
+    def _expired(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.ttl_seconds
+
+
+def required_fields(model: typing.Any, encoder: typing.Any) -> typing.List[str]:
+    """
+    Raw listing fields needed to build the model features.
+
+    Args:
+        model: The trained model, with `feature_names_in_`.
+        encoder: The fitted One-Hot Encoder, with `feature_names_in_` (None for a pipeline or
+                 a model without categorical features).
+
+    Returns:
+        List with the encoder input columns plus the model features that are used as is.
+    """
+    if isinstance(model, InferencePipeline):
+        return list(model.required_fields)
+    encoded = {'n_amenities'}
+    fields = []
+    if encoder is not None:
+        encoded |= set(encoder.get_feature_names_out())
+        fields = encoder.feature_names_in_.tolist()
+    fields += [feat for feat in model.feature_names_in_ if feat not in encoded]
+    if 'n_amenities' in model.feature_names_in_:
+        fields.append('amenities')
+    return fields
+
+
+def make_features(df: pd.DataFrame, model: typing.Any, encoder: typing.Any) -> pd.DataFrame:
+    """
+    One-hot encode the categorical fields and create the engineered features for a frame of
+    listings. The encoder runs once over the whole frame.
+
+    Args:
+        df: Pandas DataFrame with one validated listing per row.
+        model: The trained model, with `feature_names_in_`.
+        encoder: The fitted One-Hot Encoder (None for a pipeline or a model without
+                 categorical features).
+
+    Returns:
+        Pandas DataFrame with the model features, in the model's column order (a float32
+        array when the model is a fused InferencePipeline, which needs no encoder).
+    """
+    if isinstance(model, InferencePipeline):
+        return model.transform(df)
+
+    df = df.reset_index(drop=True)
+
+    if encoder is not None:
+        # Transform the categorical data
+        encoded_data = encoder.transform(df[encoder.feature_names_in_.tolist()])
+
+        # Convert the encoded data to DataFrame
+        encoded_df = pd.DataFrame(encoded_data, columns=encoder.get_feature_names_out())
+
+        # Merge the encoded categorical data with the numerical data
+        df = pd.concat([df, encoded_df], axis=1)
+
+    if 'amenities' in df:
+        df['n_amenities'] = df.amenities.str.len()
+
+    return df[model.feature_names_in_.tolist()]
+
+
+def read_listings(s3_client, bucket_name: str, key: str) -> pd.DataFrame:
+    """
+    Read a batch of listings stored in S3 as JSON lines (.jsonl) or Parquet (.parquet).
+
+    Args:
+        s3_client: boto3 S3 client.
+        bucket_name (str): The name of the S3 bucket where the listings are stored.
+        key (str): S3 key of the listings file.
+
+    Returns:
+        Pandas DataFrame with one listing per row, in file order.
+    """
+    body = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    if key.endswith('.parquet'):
+        return pd.read_parquet(io.BytesIO(body))
+    if key.endswith('.jsonl') or key.endswith('.json'):
+        return pd.read_json(io.BytesIO(body), lines=key.endswith('.jsonl'), orient='records',
+                            dtype=False)
+    raise ValueError(f"Unsupported listings file format for {key}. Use .jsonl or .parquet")
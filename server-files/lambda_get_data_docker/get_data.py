@@ -1,37 +1,129 @@
+import hashlib
 import io
+import json
 import os
+import shutil
+import tempfile
+import time
 import zipfile
 from configparser import ConfigParser
 import py7zr
 import requests
 import boto3
+from botocore.exceptions import ClientError
+import instrumentation as instr
+
+RAW_PREFIX = "data/raw/"
+# Source and sha256 of each raw file of the last ingestion, read by the clean stage
+MANIFEST_KEY = RAW_PREFIX + "manifest.json"
+
+def sha256_of(path, block_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(bucket):
+    # manifest of the last ingestion, None before the first one
+    try:
+        return json.loads(bucket.Object(MANIFEST_KEY).get()["Body"].read())
+    except ClientError as e:
+        # without s3:ListBucket a missing key is answered with AccessDenied instead of NoSuchKey
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404", "AccessDenied", "403"):
+            return None
+        raise
+
+def save_manifest(bucket, source, files, changed, run):
+    manifest = {"source": source, "files": files, "changed": changed,
+                "checked_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "run_id": run.run_id}
+    bucket.put_object(Key=MANIFEST_KEY, Body=json.dumps(manifest, indent=2).encode("utf-8"))
 
 def lambda_handler(event, context):
 # def lambda_handler():
     # source_url = "https://archive.ics.uci.edu/static/public/555/apartment+for+rent+classified.zip"
     source_url = event["source_url"]
+    # incremental: only fetch and upload what changed since the last ingestion
+    incremental = event.get("incremental", True)
+    run = instr.start_run("get_data")
 
     try:
+        #
+        # setup AWS S3 access based on config file:
+        #
+        config_file = 'config/config.ini'
+        s3_profile = 'aws-mlops-s3readwrite'
+
+        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+        boto3.setup_default_session(profile_name=s3_profile)
+
+        configur = ConfigParser()
+        configur.read(config_file)
+        bucketname = configur.get('s3', 'bucket_name')
+        print(f"The bucketname is {bucketname}.")
+
+        s3 = boto3.resource('s3')
+        bucket = s3.Bucket(bucketname)
+
+        manifest = load_manifest(bucket) if incremental else None
+        last_source = (manifest or {}).get("source", {})
+        last_files = (manifest or {}).get("files", {})
+
         print("Begin downloading the files...")
-        # Download the file from the internet
-        r = requests.get(source_url)
-        z = zipfile.ZipFile(io.BytesIO(r.content))
-        zipfile_path = "/tmp/"
-        z.extractall(zipfile_path)
+        # Download the file from the internet, unless it is the same as last time
+        headers = {}
+        if last_source.get("url") == source_url:
+            if last_source.get("etag"):
+                headers["If-None-Match"] = last_source["etag"]
+            if last_source.get("last_modified"):
+                headers["If-Modified-Since"] = last_source["last_modified"]
+        with instr.span("download") as stage:
+            r = requests.get(source_url, headers=headers)
+            stage.bytes_in = len(r.content)
+        if r.status_code == 304:
+            print("Source not modified since the last ingestion.")
+            save_manifest(bucket, last_source, last_files, [], run)
+            bucket.put_object(Key=f"timings/get_data/{run.run_id}.json", Body=run.to_json())
+            return {
+                'statusCode': 200,
+                'body': 'Source not modified, no files uploaded.'
+            }
+        r.raise_for_status()
+
+        source = {"url": source_url, "etag": r.headers.get("ETag"),
+                  "last_modified": r.headers.get("Last-Modified"),
+                  "sha256": hashlib.sha256(r.content).hexdigest()}
+        # servers without ETag/Last-Modified: compare the content
+        if last_source.get("sha256") == source["sha256"]:
+            print("Source content unchanged since the last ingestion.")
+            save_manifest(bucket, source, last_files, [], run)
+            bucket.put_object(Key=f"timings/get_data/{run.run_id}.json", Body=run.to_json())
+            return {
+                'statusCode': 200,
+                'body': 'Source unchanged, no files uploaded.'
+            }
+
+        with instr.span("extract"):
+            z = zipfile.ZipFile(io.BytesIO(r.content))
+            # fresh folder under /tmp: a warm container keeps the files of earlier runs
+            zipfile_path = tempfile.mkdtemp() + "/"
+            z.extractall(zipfile_path)
 
         zip_files = os.listdir(zipfile_path)
         print(zip_files)
         print("Downloaded files successfully.")
 
         # Unzip the file
-        for zip_file in zip_files:
-            print(f"Unzipping file {zip_file}.\n")
-            try:
-                with py7zr.SevenZipFile(zipfile_path + zip_file, mode='r') as archive:
-                    # Extract all the contents to the specified directory
-                    archive.extract(zipfile_path)
-            except Exception as err:
-                print(f"An error has occured during unzipping the file: {err}.")
+        with instr.span("unzip"):
+            for zip_file in zip_files:
+                print(f"Unzipping file {zip_file}.\n")
+                try:
+                    with py7zr.SevenZipFile(zipfile_path + zip_file, mode='r') as archive:
+                        # Extract all the contents to the specified directory
+                        archive.extract(zipfile_path)
+                except Exception as err:
+                    print(f"An error has occured during unzipping the file: {err}.")
 
         data_files = [file for file in os.listdir(zipfile_path) if file.endswith(".csv")]
         print(data_files)
@@ -43,31 +135,35 @@ def lambda_handler(event, context):
         data_files = [file for file in os.listdir(zipfile_path) if file.endswith(".csv")]
         print(data_files)
 
-        #
-        # setup AWS S3 access based on config file:
-        #
-        config_file = 'config/config.ini'
-        s3_profile = 'aws-mlops-s3readwrite'
-
-        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-        boto3.setup_default_session(profile_name=s3_profile)
-        
-        configur = ConfigParser()
-        configur.read(config_file)
-        bucketname = configur.get('s3', 'bucket_name')
-        print(f"The bucketname is {bucketname}.")
-        
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(bucketname)
+        # Only new or changed files are uploaded
+        with instr.span("hash"):
+            files = {RAW_PREFIX + file: {"sha256": sha256_of(zipfile_path + file),
+                                         "bytes": os.path.getsize(zipfile_path + file)}
+                     for file in data_files}
+        changed = [key for key, file in files.items()
+                   if last_files.get(key, {}).get("sha256") != file["sha256"]]
+        for key in files:
+            if key not in changed:
+                files[key]["updated_at"] = last_files[key].get("updated_at")
+        print(f"Changed files: {changed}")
 
         # Uploading the zipfiles to s3
-        for file in data_files:
-            bucket.upload_file(zipfile_path +  file, "data/raw/" + file)
+        with instr.span("upload") as stage:
+            for key in changed:
+                bucket.upload_file(zipfile_path + key[len(RAW_PREFIX):], key)
+                files[key]["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+                stage.bytes_out += files[key]["bytes"]
         print(f"Uploaded files to s3 bucket {bucketname} successfully.")
+        shutil.rmtree(zipfile_path, ignore_errors=True)
+        # after the uploads, so the manifest never lists a file that is not in S3
+        save_manifest(bucket, source, files, changed, run)
+
+        # Stage timings of the run
+        bucket.put_object(Key=f"timings/get_data/{run.run_id}.json", Body=run.to_json())
 
         return {
             'statusCode': 200,
-            'body': 'Files downloaded and uploaded to S3 successfully.'
+            'body': f'Files downloaded, {len(changed)} of {len(files)} uploaded to S3 successfully.'
         }
 
     except Exception as e:
@@ -0,0 +1,88 @@
+"""
+Memory and fit time benchmark of the dense and sparse feature paths of `train_model`, on the
+clean train/test data and the features of one model config.
+
+    python benchmark_features.py --config ../../config/model-config-prod01.yaml \
+        --train data_cleaned_train.parquet --test data_cleaned_test.parquet \
+        --extra-features cityname state
+
+Each path runs in a fresh process, which builds the features with `make_features` and fits a
+single forest. It prints the feature build time, the fit time, the peak RSS added on top of the
+loaded data, the size of the feature matrices and the R^2 on the test set.
+"""
+import argparse
+import json
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import yaml
+from sklearn.ensemble import RandomForestRegressor
+
+import src.train_model as tm
+
+
+def matrix_mb(x) -> float:
+    """Memory held by a feature DataFrame or sparse matrix, in MB."""
+    if scipy.sparse.issparse(x):
+        return (x.data.nbytes + x.indices.nbytes + x.indptr.nbytes) / 2**20
+    return x.memory_usage(index=False).sum() / 2**20
+
+
+def run(sparse: bool, args: argparse.Namespace, target_var: str, features: list) -> dict:
+    """Build the features and fit one forest; runs in its own process."""
+    columns = features + [target_var]
+    train = tm.read_data(args.train, columns)
+    test = tm.read_data(args.test, columns)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    _, x_train, x_test, y_train, y_test = tm.make_features(train, test, target_var, features,
+                                                           sparse)
+    build_s = time.perf_counter() - start
+
+    forest = RandomForestRegressor(n_estimators=args.n_estimators, max_depth=args.max_depth,
+                                   random_state=0, n_jobs=-1)
+    start = time.perf_counter()
+    forest.fit(x_train, np.ravel(y_train))
+    fit_s = time.perf_counter() - start
+
+    return {
+        "sparse": sparse,
+        "n_features": x_train.shape[1],
+        "features_mb": round(matrix_mb(x_train) + matrix_mb(x_test), 1),
+        "build_s": round(build_s, 2),
+        "fit_s": round(fit_s, 2),
+        "peak_rss_added_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss -
+                                    base_rss) / 1024, 1),
+        "test_r2": round(float(forest.score(x_test, np.ravel(y_test))), 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare memory and fit time of the dense and sparse feature paths"
+    )
+    parser.add_argument("--config", required=True, help="Path to the model config file")
+    parser.add_argument("--train", required=True, help="Path to the clean train data")
+    parser.add_argument("--test", required=True, help="Path to the clean test data")
+    parser.add_argument("--extra-features", nargs="*", default=[],
+                        help="Features added to the config's initial_features, e.g. cityname")
+    parser.add_argument("--n-estimators", type=int, default=20)
+    parser.add_argument("--max-depth", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        train_config = yaml.load(f, Loader=yaml.FullLoader)["train_model"]
+    features = train_config["initial_features"] + args.extra_features
+
+    for sparse in (False, True):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                report = pool.submit(run, sparse, args, train_config["target_var"],
+                                     features).result()
+            except MemoryError as err:
+                report = {"sparse": sparse, "error": str(err)}
+        print(json.dumps(report))
@@ -0,0 +1,63 @@
+"""
+Wall-clock benchmark of the hyperparameter search strategies of `train_model` (grid, random
+and halving), on the clean train/test data and the grid of one model config.
+
+    python benchmark_search.py --config ../../config/model-config-prod01.yaml \
+        --train data_cleaned_train.parquet --test data_cleaned_test.parquet
+
+For each strategy it prints the wall time of `train_model`, the number of forest fits, the
+best parameters, the best cv score and the R^2 of the refitted best model on the test set.
+"""
+import argparse
+import json
+import time
+
+import yaml
+
+import src.train_model as tm
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the wall time and best score of the hyperparameter search strategies"
+    )
+    parser.add_argument("--config", required=True, help="Path to the model config file")
+    parser.add_argument("--train", required=True, help="Path to the clean train data")
+    parser.add_argument("--test", required=True, help="Path to the clean test data")
+    parser.add_argument("--strategies", nargs="+", default=list(tm.SEARCH_STRATEGIES))
+    parser.add_argument("--resource", default="n_samples",
+                        help="Budget of the halving search: n_samples or n_estimators")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        train_config = yaml.load(f, Loader=yaml.FullLoader)["train_model"]
+    target_var = train_config["target_var"]
+    columns = train_config["initial_features"] + [target_var]
+    train = tm.read_data(args.train, columns)
+    test = tm.read_data(args.test, columns)
+
+    for strategy in args.strategies:
+        search = dict(train_config.get("search") or {}, strategy=strategy)
+        if strategy == "halving":
+            search["resource"] = args.resource
+        start = time.perf_counter()
+        _, tmo, _, test_encoded, cv_results = tm.train_model(
+            train.copy(), test.copy(), target_var, list(train_config["initial_features"]),
+            train_config["rf_params"], train_config.get("k_cv", 5), search
+        )
+        wall_s = time.perf_counter() - start
+        n_fits = len(cv_results) * train_config.get("k_cv", 5)
+        # The halving search picks its best candidate among those of the last iteration
+        if "iter" in cv_results:
+            cv_results = cv_results[cv_results["iter"] == cv_results["iter"].max()]
+        best = cv_results["mean_test_score"].idxmax()
+        print(json.dumps({
+            "strategy": strategy,
+            "resource": search.get("resource") if strategy == "halving" else None,
+            "wall_s": round(wall_s, 2),
+            "n_fits": n_fits,
+            "best_params": cv_results.loc[best, "params"],
+            "best_cv_score": round(float(cv_results.loc[best, "mean_test_score"]), 4),
+            "test_r2": round(float(tmo.score(test_encoded.drop(columns=target_var),
+                                             test_encoded[target_var])), 4),
+        }))
@@ -1,6 +1,9 @@
+import io
 import json
 import boto3
 import os
+import shutil
+import tempfile
 
 import logging
 import yaml
@@ -11,6 +14,8 @@ import src.train_model as tm
 import src.score_model as sm
 import src.evaluate_performance as ep
 import src.aws_utils as au
+import src.model_registry as mr
+import src.instrumentation as instr
 
 from configparser import ConfigParser
 
@@ -21,6 +26,7 @@ logger.setLevel(logging.INFO)
 def lambda_handler(event, context):
   try:
     logger.info("**STARTED**")
+    run = instr.start_run("train_model")
     
     #
     # setup AWS S3 access based on config file:
@@ -37,10 +43,6 @@ def lambda_handler(event, context):
     configur.read(config_file)
     bucketname = configur.get('s3', 'bucket_name')
     
-    logger.info("Setting S3 client with boto3.")
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-
     logger.info("Finish setting up AWS S3 access.")
 
     #
@@ -66,89 +68,146 @@ def lambda_handler(event, context):
     modelConfigKey = "config/" + modelConfigKey
 
     # ----------------------------------------------------------------
-    # download model config file from S3 to local filesystem:
+    # read model config file from S3:
     # ----------------------------------------------------------------
-    # Set local name for model config file
-    modelConfig_filename = "/tmp/model-config.yaml"
-
-    # Download file from s3
-    logger.info("**Downloading model config file from S3**")
-    bucket.download_file(modelConfigKey, modelConfig_filename)
+    logger.info("**Reading model config file from S3**")
+    with instr.span("download_config") as stage:
+      modelConfig_file = au.read_s3_object(bucketname, modelConfigKey)
+      stage.bytes_in = modelConfig_file.getbuffer().nbytes
     
     # Read model config file 
-    with open(modelConfig_filename, "r") as f:
-        try:
-           model_config = yaml.load(f, Loader = yaml.FullLoader)
-        except yaml.error.YAMLError as e:
-            logger.error("Error while loading model configuration from %s", modelConfig_filename)
-        else:
-            logger.info("Model configuration file loaded from %s", modelConfig_filename)
+    try:
+        model_config = yaml.load(modelConfig_file, Loader = yaml.FullLoader)
+    except yaml.error.YAMLError as e:
+        logger.error("Error while loading model configuration from %s", modelConfigKey)
+    else:
+        logger.info("Model configuration file loaded from %s", modelConfigKey)
+
 
+    # Only the model features and the target are read from the clean data
+    train_config = model_config["train_model"]
+    columns = train_config["initial_features"] + [train_config["target_var"]]
 
     # ----------------------------------------------------------------
-    # Download train data csv file from S3 bucket
+    # Distributed cv: the planner splits the grid into shards for the
+    # Map state of the pipeline, which runs them as cv_shard workers
+    # ----------------------------------------------------------------
+    mode = event.get("mode", "train")
+    logger.info("Train Lambda mode: %s", mode)
+    run.function = f"train_model.{mode}" if mode != "train" else "train_model"
+    search = train_config.get("search") or {}
+
+    if mode == "plan":
+      distributed = search.get("strategy") == "distributed"
+      shards = []
+      if distributed:
+        shards = tm.plan_shards(train_config["rf_params"], train_config.get("k_cv", 5),
+                                search.get("n_shards", 4))
+      logger.info("**PLANNING DONE, %d cv shards**", len(shards))
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"distributed": distributed, "shards": shards})
+      }
+
+    # ----------------------------------------------------------------
+    # Read train data file from S3 bucket
     # ----------------------------------------------------------------
-    train_filename = "/tmp/data_cleaned_train.csv"
-    
-    # Download train file from s3
-    logger.info("**Downloading train data from S3**")
     cleanKey = model_config.get("run_config")["clean_train_key"]
+    
+    # Read train file from s3 straight into memory
+    logger.info("**Reading train data from S3**")
     logger.info("Clean train key: %s", cleanKey)
-    bucket.download_file(cleanKey, train_filename)
-    logger.info("**Clean train data downloaded from S3 to %s **", train_filename)
-
-    # Read clean data 
-    logger.info("Reading clean train data into pandas dataframe")
-    train = pd.read_csv(train_filename)
-    logger.info("Clean data read into pandas dataframe")
+    with instr.span("download_train") as stage:
+      train_file = au.read_s3_object(bucketname, cleanKey)
+      stage.bytes_in = train_file.getbuffer().nbytes
+    with instr.span("parse_train") as stage:
+      train = tm.read_data(train_file, columns, Path(cleanKey).suffix.lstrip("."))
+      stage.bytes_in = train_file.getbuffer().nbytes
+    del train_file
+    logger.info("Clean train data read into pandas dataframe")
     
+    if mode == "cv_shard":
+      shard = event["shard"]
+      logger.info("** Running cv shard %s (%d tasks) **", shard["shard"], len(shard["tasks"]))
+      with instr.span("encode"):
+        # cross-validation on train only: the test split is not needed
+        _, x_train, _, y_train, _ = tm.make_features(train, None, train_config["target_var"],
+                                                     train_config["initial_features"],
+                                                     train_config.get("sparse", False))
+      with instr.span("fit"):
+        results = tm.run_shard(shard, x_train, y_train)
+      logger.info("**CV SHARD DONE, returning results**")
+      return {
+        'statusCode': 200,
+        'body': json.dumps({"shard": shard["shard"], "results": results})
+      }
+
     # ----------------------------------------------------------------
-    # Download train data csv file from S3 bucket
+    # Read test data file from S3 bucket
     # ----------------------------------------------------------------
-    test_filename = "/tmp/data_cleaned_test.csv"
-
-    # Download test file from s3
-    logger.info("**Downloading test data from S3**")
     testKey = model_config.get("run_config")["clean_test_key"]
+
+    # Read test file from s3 straight into memory
+    logger.info("**Reading test data from S3**")
     logger.info("Clean test key: %s", testKey)
-    bucket.download_file(testKey, test_filename)
-    logger.info("**Clean test data downloaded from S3 to %s **", test_filename)
-    
-    # Read clean data 
-    logger.info("Reading clean test data into pandas dataframe")
-    test = pd.read_csv(test_filename)
-    logger.info("Clean data read into pandas dataframe")
+    with instr.span("download_test") as stage:
+      test_file = au.read_s3_object(bucketname, testKey)
+      stage.bytes_in = test_file.getbuffer().nbytes
+    with instr.span("parse_test") as stage:
+      test = tm.read_data(test_file, columns, Path(testKey).suffix.lstrip("."))
+      stage.bytes_in = test_file.getbuffer().nbytes
+    del test_file
+    logger.info("Clean test data read into pandas dataframe")
 
     # ----------------------------------------------------------------
     # Train model, predict and evaluate
     # ----------------------------------------------------------------
-    # Convert results folder to a Path
+    # Fresh results folder for each invocation: a warm container keeps /tmp, and every file
+    # in the folder is published with the new version
     logger.info("Creating results folder")
-    au.create_folder_in_tmp('results')
-    logger.info("Folder results created")
-    results_dir = Path("/tmp/results/") 
+    results_dir = Path(tempfile.mkdtemp(prefix="results-"))
+    logger.info("Folder %s created", results_dir)
 
     # Split data into train/test set and train model based on config; save each to disk
     logger.info("** Starting model training **")
-    encoder, tmo, train, test, cv_result = tm.train_model(train, test,  **model_config["train_model"])
+    # With a distributed search, the cv results come from the Map state's workers
+    shard_results = None
+    if event.get("shardResults"):
+      shard_results = [result for shard in event["shardResults"] for result in shard["results"]]
+    encoder, tmo, train, test, cv_result = tm.train_model(train, test,  **model_config["train_model"],
+                                                          shard_results=shard_results)
     logger.info("** Finished model training **")
     
     logger.info("** Saving training data to local folder **")
-    tm.save_data(train, test, cv_result, results_dir)
-    logger.info("** Saved training data to local folder %s **", results_dir)
+    with instr.span("save_artifacts"):
+      tm.save_data(train, test, cv_result, results_dir,
+                   model_config["run_config"].get("artifact_format", "csv"))
+      logger.info("** Saved training data to local folder %s **", results_dir)
 
-    logger.info("** Saving tmo to local folder **")
-    tm.save_model(tmo, results_dir / "tmo.pkl")
-    logger.info("** Saved tmo to local folder %s **", results_dir)
+      logger.info("** Saving tmo to local folder **")
+      model_formats = model_config["run_config"].get("model_formats",
+                                                     ["pickle", "npz", "mmap", "pipeline"])
+      if "pickle" in model_formats:
+        tm.save_model(tmo, results_dir / "tmo.pkl")
+      if "npz" in model_formats:
+        tm.save_model_arrays(tmo, results_dir / "tmo.npz")
+      if "mmap" in model_formats:
+        tm.save_model_mmap(tmo, results_dir / "tmo.forest.joblib")
+      if "pipeline" in model_formats:
+        tm.save_pipeline(tmo, encoder, results_dir / "tmo.pipeline.joblib")
+      logger.info("** Saved tmo to local folder %s **", results_dir)
 
-    logger.info("** Saving encoder to local folder **")
-    tm.save_encoder(encoder, results_dir / "encoder.joblib")
-    logger.info("** Saved tmo to local folder %s **", results_dir)
+      # Models without categorical features have no encoder, and the manifest no encoder_key
+      if encoder is not None:
+        logger.info("** Saving encoder to local folder **")
+        tm.save_encoder(encoder, results_dir / "encoder.joblib")
+        logger.info("** Saved tmo to local folder %s **", results_dir)
 
 
     # Score model on test set; save scores to disk
     logger.info("** Sarting model scoring **")
-    scores = sm.score_model(test, tmo, **model_config["score_model"])
+    with instr.span("score"):
+      scores = sm.score_model(test, tmo, **model_config["score_model"])
     logger.info("** Finished model scoring **")
 
     logger.info("** Saving scores to local folder **")
@@ -158,7 +217,9 @@ def lambda_handler(event, context):
 
     # Evaluate model performance metrics; save metrics to disk
     logger.info("** Sarting model evaluation **")
-    metrics = ep.evaluate_performance(scores)
+    with instr.span("evaluate"):
+      metrics = ep.evaluate_performance(scores)
+    metrics["peak_rss_mb"] = instr.peak_rss_mb()
     logger.info("** Finished model evaluation **")
     
     ep.save_metrics(metrics, results_dir / "metrics.yaml")
@@ -168,10 +229,27 @@ def lambda_handler(event, context):
     # Upload artifacts to S3 folder
     # ----------------------------------------------------------------
     
-    # Upload artifacts
+    # Upload artifacts as a new model version; its manifest is written last
     logger.info("** Uploading artifacts to S3 **")
-    s3_uris = au.upload_artifacts(results_dir, model_config.get("aws"))
-    logger.info("** Artifacts uploaded to S3 bucket. **")
+    with instr.span("upload_artifacts") as stage:
+      manifest = mr.publish_artifacts(results_dir, model_config.get("aws"),
+                                      tmo.feature_names_in_.tolist(), train_config["target_var"],
+                                      metrics, modelConfigKey)
+      # Unchanged files keep the key of an earlier version and are not uploaded again
+      version_folder = f"{model_config['aws']['prefix']}/{manifest['version']}/"
+      stage.bytes_out = sum(file["bytes"] for file in manifest["files"].values()
+                            if file["key"].startswith(version_folder))
+    s3_uris = [f"s3://{model_config['aws']['bucket_name']}/{file['key']}"
+               for file in manifest["files"].values()]
+    logger.info("** Artifacts uploaded to S3 bucket, model version %s. **", manifest["version"])
+
+    # Stage timings of the run, stored next to the version's artifacts. Uploaded from memory
+    # once the version is published, so they are never part of the results folder.
+    run.run_id = manifest["version"]
+    s3_uris.append(au.upload_fileobj(io.BytesIO(run.to_json()), model_config["aws"]["bucket_name"],
+                                     f"{model_config['aws']['prefix']}/{manifest['version']}/timings.json"))
+    logger.info("** Stage timings uploaded to %s **", s3_uris[-1])
+    shutil.rmtree(results_dir, ignore_errors=True)
     
     
     # ----------------------------------------------------------------
@@ -180,7 +258,7 @@ def lambda_handler(event, context):
     
     logger.info("**TRAINING DONE, returning results**")
 
-    output = {"s3_uris": s3_uris}
+    output = {"s3_uris": s3_uris, "model_version": manifest["version"]}
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
@@ -193,6 +271,10 @@ def lambda_handler(event, context):
   except Exception as err:
     print("**ERROR**")
     print(str(err))
+    # The plan and cv_shard steps of the pipeline read the body as JSON: fail the invocation,
+    # so the state machine's Catch routes the error instead of passing the body on
+    if isinstance(event, dict) and event.get("mode", "train") != "train":
+      raise
     
     return {
       'statusCode': 400,
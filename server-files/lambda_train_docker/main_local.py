@@ -4,13 +4,13 @@ import argparse
 import datetime
 import logging.config
 from pathlib import Path
-import pandas as pd
 
 import yaml
 
-import evaluate_performance as ep
-import score_model as sm
-import train_model as tm
+import src.evaluate_performance as ep
+import src.instrumentation as instr
+import src.score_model as sm
+import src.train_model as tm
 
 # set up logger config for some file 
 logging.config.fileConfig("../../config/logging/local.conf")
@@ -26,8 +26,11 @@ if __name__ == "__main__":
     )
     # Add configuration file. 
     parser.add_argument(
-        "--config", default="../../config/model-config.yaml", help="Path to configuration file"
+        "--config", default="../../config/model-config-prod01.yaml", help="Path to configuration file"
     )
+    # Local clean data files, default to the run_config clean keys
+    parser.add_argument("--train", help="Path to the clean train data")
+    parser.add_argument("--test", help="Path to the clean test data")
     # Parse command line arguments
     args = parser.parse_args()
 
@@ -53,30 +56,43 @@ if __name__ == "__main__":
     with (artifacts / "config.yaml").open("w") as f:
         yaml.dump(config, f)
 
-    # Read toy data
-    data = pd.read_csv(run_config["clean_data_key"])
-    logging.info("Data loaded from file %s", run_config["clean_data_key"])
+    # Stage timings of the run, saved to timings.json (the Lambda uploads the same file)
+    run = instr.start_run("train_model.local", emit=False)
 
-    # Split data into train/test set and train model based on config; save each to disk
+    # Read the clean train and test data (local files), only the model columns
+    train_config = config["train_model"]
+    columns = train_config["initial_features"] + [train_config["target_var"]]
+    with instr.span("parse_train"):
+        train = tm.read_data(args.train or run_config["clean_train_key"], columns)
+    with instr.span("parse_test"):
+        test = tm.read_data(args.test or run_config["clean_test_key"], columns)
+    logging.info("Train and test data loaded")
+
+    # Train model based on config; save each to disk
     logging.info("Starting model training")
-    # Split data into train/test set and train model based on config; save each to disk
-    tmo, train, test, cv_result = tm.train_model(data,  **config["train_model"])
+    encoder, tmo, train, test, cv_result = tm.train_model(train, test, **train_config)
     logging.info("Finish model training.")
-    tm.save_data(train, test, cv_result, artifacts)
-    logging.info("Train, test, cv_results saved to folder %s.", artifacts)
-    tm.save_model(tmo, artifacts/"tmo.pkl")
-    logging.info("Model saved to folder %s.", artifacts)
+    with instr.span("save_artifacts"):
+        tm.save_data(train, test, cv_result, artifacts, run_config.get("artifact_format", "csv"))
+        logging.info("Train, test, cv_results saved to folder %s.", artifacts)
+        tm.save_model(tmo, artifacts/"tmo.pkl")
+        if encoder is not None:
+            tm.save_encoder(encoder, artifacts/"encoder.joblib")
+        logging.info("Model saved to folder %s.", artifacts)
 
     # Score model on test set; save scores to disk
     logging.info("Starting model scring")
-    scores = sm.score_model(test, tmo, **config["score_model"])
+    with instr.span("score"):
+        scores = sm.score_model(test, tmo, **config["score_model"])
     logging.info("finished model scoring")
     sm.save_scores(scores, artifacts/"scores.csv")
     logging.info("Scoring saved to folder")
 
     # Evaluate model performance metrics; save metrics to disk
     logging.info("Starting evaluation of model.")
-    metrics = ep.evaluate_performance(scores)
+    with instr.span("evaluate"):
+        metrics = ep.evaluate_performance(scores)
     logging.info("Model evaluation finished.")
     ep.save_metrics(metrics, artifacts/"metrics.yaml")
-    logging.info("Model evaluation saved to folder")
\ No newline at end of file
+    logging.info("Model evaluation saved to folder")
+    run.save(artifacts/"timings.json")
\ No newline at end of file
@@ -2,31 +2,144 @@
 This module provides functions for uploading the generated artifacts to an S3 bucket. 
 If allowed by the user, the process will create the S3 bucket if it doesn't exist.  
 """
+import hashlib
+import io
 import logging
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from typing import List, Union, Dict
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import BotoCoreError, ClientError
 
 # Set logger
 logger = logging.getLogger(__name__)
 
+# Objects above the threshold are transferred in parallel chunks (ranged GETs / multipart uploads)
+CHUNK_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=CHUNK_SIZE, multipart_chunksize=CHUNK_SIZE,
+                                 max_concurrency=8)
 
-def upload_artifacts(local_dir: Union[Path, str], aws_config: Dict[str, str]) -> List[str]:
+
+def read_s3_object(bucket_name: str, key: str) -> io.BytesIO:
     """
-    Uploads all files in a local directory to an S3 bucket, handling any errors encountered
-    during the upload process.
+    Reads an S3 object straight into memory, without a copy in /tmp. Objects larger than
+    CHUNK_SIZE are fetched with parallel ranged GETs.
+
+    Args:
+    - bucket_name (str): The name of the S3 bucket.
+    - key (str): The key of the object to read.
+
+    Returns:
+    - content (io.BytesIO): The object content, positioned at the start.
+    """
+    s3 = boto3.client('s3')
+    content = io.BytesIO()
+    try:
+        s3.download_fileobj(Bucket=bucket_name, Key=key, Fileobj=content, Config=TRANSFER_CONFIG)
+    except (ClientError, BotoCoreError) as e:
+        logger.error("Failed to read %s from S3. Error: %s", key, e)
+        raise Exception(f"Failed to read {key} from S3") from e
+    content.seek(0)
+    logger.info("Read %s from S3 (%d bytes).", key, content.getbuffer().nbytes)
+    return content
+
+
+def upload_fileobj(fileobj, bucket_name: str, key: str, s3_client=None,
+                   transfer_config: TransferConfig = TRANSFER_CONFIG,
+                   metadata: Dict[str, str] = None) -> str:
+    """
+    Streams a binary file object to S3 as a multipart upload (a single PUT for small objects).
+
+    Args:
+    - fileobj: Binary file object to upload, read in multipart_chunksize parts.
+    - bucket_name (str): The name of the S3 bucket.
+    - key (str): The key of the uploaded object.
+    - s3_client: Optional boto3 S3 client to reuse. A new one is created if not given.
+    - transfer_config (TransferConfig): Multipart chunk size and concurrency of the upload.
+    - metadata (dict): Optional user metadata stored with the object.
+
+    Returns:
+    - s3_uri (str): The S3 URI of the uploaded object.
+    """
+    s3 = s3_client or boto3.client('s3')
+    extra_args = {"Metadata": metadata} if metadata else None
+    s3.upload_fileobj(Fileobj=fileobj, Bucket=bucket_name, Key=key, Config=transfer_config,
+                      ExtraArgs=extra_args)
+    return f"s3://{bucket_name}/{key}"
+
+
+def file_sha256(file_path: Path) -> str:
+    """
+    Computes the SHA-256 hex digest of a file, reading it in CHUNK_SIZE blocks.
+
+    Args:
+    - file_path (Path): The file to hash.
+
+    Returns:
+    - digest (str): The hex digest of the file content.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(CHUNK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _upload_artifact(s3, file_path: Path, bucket_name: str, s3_key: str,
+                     transfer_config: TransferConfig, previous: Dict = None) -> Dict:
+    """
+    Uploads one artifact unless its content hash matches the previous version of the file
+    (`previous`, with its 'key' and 'sha256' from the last manifest). Returns the upload stats
+    of the file, with the key that holds its content.
+    """
+    digest = file_sha256(file_path)
+    size = file_path.stat().st_size
+    stats = {"name": file_path.name, "key": s3_key, "sha256": digest, "bytes": size,
+             "seconds": 0.0, "skipped": True}
+
+    # Reuse the object of the previous version when the content did not change
+    if previous is not None and previous.get("sha256") == digest:
+        logger.info("File %s unchanged (sha256 %s), reusing %s.", file_path.name, digest[:12],
+                    previous["key"])
+        stats["key"] = previous["key"]
+        return stats
+
+    start = time.perf_counter()
+    with open(file_path, "rb") as file:
+        upload_fileobj(file, bucket_name, s3_key, s3_client=s3, transfer_config=transfer_config,
+                       metadata={"sha256": digest})
+    seconds = time.perf_counter() - start
+    logger.info("File %s uploaded: %.2f MB in %.2f s (%.2f MB/s).", s3_key, size / 1e6, seconds,
+                size / 1e6 / seconds if seconds else float("inf"))
+    stats.update(seconds=seconds, skipped=False)
+    return stats
+
+
+def upload_files(local_dir: Union[Path, str], aws_config: Dict[str, str], s3_folder: str = None,
+                 previous_files: Dict[str, Dict] = None) -> List[Dict]:
+    """
+    Uploads all files in a local directory to an S3 folder. Files are uploaded concurrently,
+    each one as a multipart upload, and files whose content hash matches their entry in
+    `previous_files` are skipped.
 
     Args:
     - local_dir (Path or str): The local directory containing the files to upload.
     - aws_config (dict): A dictionary containing AWS configuration such as 'bucket_name' and 'prefix'.
+                         An optional 'upload' entry sets 'max_workers' (files uploaded at once),
+                         'multipart_chunksize_mb' and 'max_concurrency' (parts per file).
+    - s3_folder (str): The S3 folder to upload to. Defaults to aws_config['prefix'].
+    - previous_files (dict): Optional file name -> {'key', 'sha256'} of a previous upload.
+                             Unchanged files are not uploaded again and keep their previous key.
 
     Returns:
-    - s3_uris (list): A list of S3 URIs for the uploaded files. In case of an error, the list will
-                      contain the URIs of the files that were successfully uploaded before the error occurred.
+    - stats (list): One dictionary per file with its 'name', 'key', 'sha256', 'bytes',
+                    upload 'seconds' and whether it was 'skipped'.
     """
     # --- Get files to upload ---
     # Ensure local_dir is a Path object
@@ -39,42 +152,64 @@ def upload_artifacts(local_dir: Union[Path, str], aws_config: Dict[str, str]) ->
     # --- Set S3 configuration ---
     logger.info("Setting S3 configuration.")
     
-    # S3 client
+    # S3 client, shared by the upload threads
     s3 = boto3.client('s3')
     
-    # The S3 URIs that will be returned
-    s3_uris = []
-    
     # S3 bucket and folder details from aws_config
     logger.debug("Getting AWS configuration")
     bucket_name = aws_config['bucket_name']
     logger.debug("    bucket_name: %s", bucket_name)
         
-    s3_folder = aws_config['prefix']
+    s3_folder = s3_folder or aws_config['prefix']
     logger.debug("    folder: %s", s3_folder)
+
+    upload_config = aws_config.get('upload', {})
+    chunk_size = upload_config.get('multipart_chunksize_mb', 16) * 1024 * 1024
+    transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=upload_config.get('max_concurrency', 10))
+    max_workers = upload_config.get('max_workers', 4)
+    previous_files = previous_files or {}
     logger.info("Finish setting S3 configuration.")
         
 
-    # --- Iterate over the files and upload each one ---
-    for file_path in files_to_upload:
-        # Define the S3 key (i.e., 's3_folder/filename')
-        s3_key = f"{s3_folder}/{file_path.name}"
-        logger.debug("s3_key: %s", s3_key)
-        
-        # Upload the file & add URI to list
+    # --- Upload the files concurrently ---
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {file_path: pool.submit(_upload_artifact, s3, file_path, bucket_name,
+                                          f"{s3_folder}/{file_path.name}", transfer_config,
+                                          previous_files.get(file_path.name))
+                   for file_path in files_to_upload}
+
+    stats = []
+    for file_path, future in futures.items():
         try:
-            s3.upload_file(Filename=str(file_path), Bucket=bucket_name, Key=s3_key)
-        except (ClientError, BotoCoreError) as e:
+            stats.append(future.result())
+        except (ClientError, BotoCoreError, S3UploadFailedError) as e:
             logger.error("Failed to upload %s to S3. Error: %s", file_path, e)
             raise Exception(f"Failed to upload {file_path} to S3") from e
-        else:
-            s3_uri = f"s3://{bucket_name}/{s3_key}"
-            logger.info("File %s uploaded. S3 URI: %s", s3_key, s3_uri)
-        
-        s3_uris.append(s3_uri)
 
-    logger.info("Finished uploading files to S3")
-        
+    seconds = time.perf_counter() - start
+    uploaded = [stat for stat in stats if not stat["skipped"]]
+    total_mb = sum(stat["bytes"] for stat in uploaded) / 1e6
+    logger.info("Finished uploading files to S3: %d uploaded (%.2f MB in %.2f s), %d unchanged.",
+                len(uploaded), total_mb, seconds, len(stats) - len(uploaded))
+    return stats
+
+
+def upload_artifacts(local_dir: Union[Path, str], aws_config: Dict[str, str]) -> List[str]:
+    """
+    Uploads all files in a local directory to an S3 bucket, handling any errors encountered
+    during the upload process. See `upload_files`.
+
+    Args:
+    - local_dir (Path or str): The local directory containing the files to upload.
+    - aws_config (dict): A dictionary containing AWS configuration such as 'bucket_name' and 'prefix'.
+
+    Returns:
+    - s3_uris (list): A list of S3 URIs for the uploaded files, skipped files included.
+    """
+    stats = upload_files(local_dir, aws_config)
+    s3_uris = [f"s3://{aws_config['bucket_name']}/{stat['key']}" for stat in stats]
     return s3_uris
 
 
@@ -0,0 +1,155 @@
+"""
+This module publishes the trained artifacts as a model version. Each version is uploaded to
+its own S3 folder and described by a manifest (model and encoder keys, feature list, metrics
+and content hashes). The manifest is written last, so the predictor only sees a version once
+all of its artifacts are in S3.
+
+S3 layout under the artifacts prefix:
+    <prefix>/<version>/...               artifacts of the version
+    <prefix>/manifests/<version>.json    manifest of every published version
+    <prefix>/manifest.json               manifest of the current version
+"""
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import boto3
+from botocore.exceptions import ClientError
+
+import src.aws_utils as au
+
+# Set logger
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+# Local file name of each model format
+MODEL_FILES = {"pickle": "tmo.pkl", "npz": "tmo.npz", "mmap": "tmo.forest.joblib",
+               "pipeline": "tmo.pipeline.joblib"}
+ENCODER_FILE = "encoder.joblib"
+
+
+def new_version() -> str:
+    """
+    Returns a new model version id: the UTC time of the run, which sorts in publish order.
+    """
+    return time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+
+
+def read_manifest(bucket_name: str, prefix: str, s3_client=None) -> Optional[Dict]:
+    """
+    Reads the manifest of the current model version.
+
+    Args:
+    - bucket_name (str): The name of the S3 bucket.
+    - prefix (str): The artifacts prefix, e.g. 'modeling_artifacts'.
+    - s3_client: Optional boto3 S3 client to reuse. A new one is created if not given.
+
+    Returns:
+    - manifest (dict): The current manifest, or None if no version was published yet.
+    """
+    s3 = s3_client or boto3.client("s3")
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=f"{prefix}/{MANIFEST_NAME}")
+    except ClientError as e:
+        # without s3:ListBucket a missing key is answered with AccessDenied instead of NoSuchKey
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404", "AccessDenied", "403"):
+            logger.info("No manifest found under %s, publishing the first version.", prefix)
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def build_manifest(version: str, artifacts: List[Dict], features: List[str], target: str,
+                   metrics: Dict[str, float], model_config_key: str = None) -> Dict:
+    """
+    Builds the manifest of a model version from the upload stats of its artifacts.
+
+    Args:
+    - version (str): The model version id.
+    - artifacts (list): Upload stats of the artifacts, as returned by `aws_utils.upload_files`.
+    - features (list): The model features, in the column order the model expects.
+    - target (str): The name of the target variable.
+    - metrics (dict): The evaluation metrics of the model on the test set.
+    - model_config_key (str): Optional S3 key of the model config the version was trained with.
+
+    Returns:
+    - manifest (dict): The manifest of the version.
+    """
+    files = {stat["name"]: {"key": stat["key"], "sha256": stat["sha256"], "bytes": stat["bytes"]}
+             for stat in artifacts}
+    manifest = {
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "model_config_key": model_config_key,
+        "models": {model_format: files[name]["key"]
+                   for model_format, name in MODEL_FILES.items() if name in files},
+        "encoder_key": files[ENCODER_FILE]["key"] if ENCODER_FILE in files else None,
+        "features": list(features),
+        "target": target,
+        "metrics": {name: float(value) for name, value in metrics.items()},
+        "files": files,
+    }
+    return manifest
+
+
+def write_manifest(manifest: Dict, bucket_name: str, prefix: str, s3_client=None) -> str:
+    """
+    Writes the manifest of a version and then makes it the current one. Each put_object
+    replaces the whole object at once, so readers see either the old or the new manifest.
+
+    Args:
+    - manifest (dict): The manifest to write.
+    - bucket_name (str): The name of the S3 bucket.
+    - prefix (str): The artifacts prefix, e.g. 'modeling_artifacts'.
+    - s3_client: Optional boto3 S3 client to reuse. A new one is created if not given.
+
+    Returns:
+    - s3_uri (str): The S3 URI of the current manifest.
+    """
+    s3 = s3_client or boto3.client("s3")
+    body = json.dumps(manifest, indent=2).encode("utf-8")
+    for key in (f"{prefix}/manifests/{manifest['version']}.json", f"{prefix}/{MANIFEST_NAME}"):
+        s3.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType="application/json")
+        logger.info("Manifest of version %s written to %s.", manifest["version"], key)
+    return f"s3://{bucket_name}/{prefix}/{MANIFEST_NAME}"
+
+
+def publish_artifacts(local_dir: Union[Path, str], aws_config: Dict, features: List[str],
+                      target: str, metrics: Dict[str, float],
+                      model_config_key: str = None) -> Dict:
+    """
+    Uploads the artifacts of a training run as a new model version and publishes its manifest.
+    Artifacts whose content did not change since the current version are not uploaded again;
+    the new manifest points to the existing objects.
+
+    Args:
+    - local_dir (Path or str): The local directory containing the artifacts.
+    - aws_config (dict): AWS configuration with 'bucket_name', 'prefix' and optional 'upload'.
+    - features (list): The model features, in the column order the model expects.
+    - target (str): The name of the target variable.
+    - metrics (dict): The evaluation metrics of the model on the test set.
+    - model_config_key (str): Optional S3 key of the model config the version was trained with.
+
+    Returns:
+    - manifest (dict): The manifest of the published version.
+    """
+    bucket_name = aws_config["bucket_name"]
+    prefix = aws_config["prefix"]
+    s3 = boto3.client("s3")
+
+    previous = read_manifest(bucket_name, prefix, s3_client=s3)
+    version = new_version()
+    if previous is not None and previous["version"] == version:
+        raise Exception(f"Model version {version} is already published")
+
+    logger.info("Publishing model version %s.", version)
+    artifacts = au.upload_files(local_dir, aws_config, f"{prefix}/{version}",
+                                previous["files"] if previous else None)
+
+    # The manifest goes last: the version becomes visible only after all its artifacts
+    manifest = build_manifest(version, artifacts, features, target, metrics, model_config_key)
+    write_manifest(manifest, bucket_name, prefix, s3_client=s3)
+    return manifest
@@ -2,167 +2,532 @@
 This module provides functions for training a Random Forest Classifier, saving the train and 
 test data and saving a pickled trained model. 
 """
+import json
 import logging
 import typing
 import sys
+import time
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from joblib import dump
+from joblib import Parallel, delayed, dump
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse
 
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import (GridSearchCV, HalvingGridSearchCV, ParameterGrid,
+                                     RandomizedSearchCV, check_cv)
+from sklearn.utils import _safe_indexing
 from sklearn.preprocessing import OneHotEncoder
 
+import src.instrumentation as instr
+
 # Set logger
 logger = logging.getLogger(__name__)
 
-def train_model(train: pd.DataFrame, test:pd.DataFrame, target_var: str, initial_features: typing.List[str],
-                rf_params: dict, k_cv: int = 5) -> typing.Tuple[
-                    RandomForestRegressor, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+# Cells densified at once when writing a frame with sparse columns to Parquet
+SPARSE_WRITE_CELLS = 4_000_000
+
+SEARCH_STRATEGIES = ("grid", "random", "halving", "warm_start", "distributed")
+
+
+def _grow_forest(params: dict, n_estimators: typing.List[int], X, y, train_idx: np.ndarray,
+                 test_idx: np.ndarray) -> typing.List[typing.Tuple[float, float, float]]:
+    """
+    Grow one warm-started forest on a cv fold and score it at each tree count.
+
+    Returns:
+        (fit time, score time, test score) for each value of n_estimators, in increasing order.
+        The fit time is cumulative: the time it took to grow the forest up to that size.
+    """
+    X_train, y_train = _safe_indexing(X, train_idx), y[train_idx]
+    X_test, y_test = _safe_indexing(X, test_idx), y[test_idx]
+    forest = RandomForestRegressor(warm_start=True, **params)
+    fit_time = 0.0
+    results = []
+    for n_trees in n_estimators:
+        start = time.perf_counter()
+        forest.set_params(n_estimators=n_trees).fit(X_train, y_train)
+        fit_time += time.perf_counter() - start
+        start = time.perf_counter()
+        score = forest.score(X_test, y_test)
+        results.append((fit_time, time.perf_counter() - start, score))
+    return results
+
+
+def plan_tasks(rf_params: dict, k_cv: int) -> typing.List[dict]:
     """
-    Train a random forest classifier using the specified input features.
+    Split the cv of the rf_params grid into independent tasks, one per combination of the
+    parameters other than n_estimators and per fold. Each task grows one forest through all
+    the n_estimators values.
+
+    Returns:
+        List of JSON-serializable tasks with keys params, n_estimators and fold.
+    """
+    if "n_estimators" not in rf_params:
+        raise ValueError("The warm_start and distributed searches need n_estimators values " +
+                         "in rf_params")
+    n_estimators = sorted(rf_params["n_estimators"])
+    other_params = ParameterGrid({key: values for key, values in rf_params.items()
+                                  if key != "n_estimators"})
+    return [{"params": params, "n_estimators": n_estimators, "fold": fold}
+            for params in other_params for fold in range(k_cv)]
+
+
+def plan_shards(rf_params: dict, k_cv: int, n_shards: int) -> typing.List[dict]:
+    """
+    Deal the cv tasks of the rf_params grid (`plan_tasks`) round-robin into at most n_shards
+    shards, one per worker invocation.
+
+    Returns:
+        List of shards, each a dict with its index (shard), k_cv and its tasks.
+    """
+    tasks = plan_tasks(rf_params, k_cv)
+    n_shards = max(1, min(n_shards, len(tasks)))
+    return [{"shard": shard, "k_cv": k_cv, "tasks": tasks[shard::n_shards]}
+            for shard in range(n_shards)]
+
+
+def _run_task(task: dict, X, y, folds: list) -> dict:
+    """Run one cv task on its fold; the result has one value per n_estimators."""
+    train_idx, test_idx = folds[task["fold"]]
+    grown = _grow_forest(task["params"], task["n_estimators"], X, y, train_idx, test_idx)
+    fit_time, score_time, test_score = (list(values) for values in zip(*grown))
+    return dict(task, fit_time=fit_time, score_time=score_time, test_score=test_score)
+
+
+def run_shard(shard: dict, X, y, n_jobs: int = -1) -> typing.List[dict]:
+    """
+    Worker side of the distributed search: run the cv tasks of one shard on the training data.
+    Every worker must get the same X, y (same rows in the same order) for the folds to match.
 
     Args:
-        data: The pandas DataFrame containing the features to use for training the model.
+        shard: One shard of `plan_shards`.
+        X: Training features.
+        y: Training target.
+        n_jobs: Tasks run in parallel. Defaults to -1 (all cores).
+
+    Returns:
+        One JSON-serializable result per task: the task plus its fit_time, score_time and
+        test_score at each n_estimators.
+    """
+    y = np.ravel(y)
+    folds = list(check_cv(shard["k_cv"]).split(X, y))
+    return Parallel(n_jobs=n_jobs)(delayed(_run_task)(task, X, y, folds)
+                                   for task in shard["tasks"])
+
+
+def _task_key(params: dict, fold: int) -> str:
+    return json.dumps([params, fold], sort_keys=True)
+
+
+class WarmStartForestSearch:
+    """
+    Grid search over rf_params that grows the forests instead of refitting them. For each
+    combination of the other parameters (e.g. max_depth) and each fold, one forest is grown
+    with warm_start=True up to the largest n_estimators and scored at every requested tree
+    count, so the smaller forests are prefixes of the larger one and are never fitted on
+    their own.
+
+    Exposes the attributes of GridSearchCV that train_model reads (cv_results_ with the same
+    columns and candidate order, best_params_, best_score_, best_estimator_).
+    """
+
+    def __init__(self, param_grid: dict, cv: int = 5, n_jobs: int = -1):
+        plan_tasks(param_grid, cv)
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+
+    def _run(self, X, y) -> typing.List[dict]:
+        """Run all the cv tasks and return their results."""
+        return run_shard(plan_shards(self.param_grid, self.cv, 1)[0], X, y, self.n_jobs)
+
+    def fit(self, X, y) -> "WarmStartForestSearch":
+        """Run the search on X, y and refit the best parameters on all of it."""
+        y = np.ravel(y)
+        results = {_task_key(result["params"], result["fold"]): result
+                   for result in self._run(X, y)}
+
+        # Collect (fit time, score time, score) per candidate and fold
+        candidates = list(ParameterGrid(self.param_grid))
+        rows = np.empty((len(candidates), self.cv, 3))
+        for idx, params in enumerate(candidates):
+            other_params = {key: value for key, value in params.items() if key != "n_estimators"}
+            for fold in range(self.cv):
+                result = results.get(_task_key(other_params, fold))
+                if result is None:
+                    raise ValueError(f"Missing cv results for {other_params} on fold {fold}")
+                step = result["n_estimators"].index(params["n_estimators"])
+                rows[idx, fold] = (result["fit_time"][step], result["score_time"][step],
+                                   result["test_score"][step])
+
+        # Same candidate order and columns as GridSearchCV
+        cv_results = {
+            "mean_fit_time": rows[:, :, 0].mean(axis=1),
+            "std_fit_time": rows[:, :, 0].std(axis=1),
+            "mean_score_time": rows[:, :, 1].mean(axis=1),
+            "std_score_time": rows[:, :, 1].std(axis=1),
+        }
+        for key in sorted(self.param_grid):
+            cv_results[f"param_{key}"] = np.ma.MaskedArray([params[key] for params in candidates],
+                                                           dtype=object)
+        cv_results["params"] = candidates
+        for fold in range(self.cv):
+            cv_results[f"split{fold}_test_score"] = rows[:, fold, 2]
+        cv_results["mean_test_score"] = rows[:, :, 2].mean(axis=1)
+        cv_results["std_test_score"] = rows[:, :, 2].std(axis=1)
+        # Rank 1 is the best score; ties share the lowest rank
+        scores = cv_results["mean_test_score"]
+        cv_results["rank_test_score"] = np.array([1 + np.sum(scores > score) for score in scores],
+                                                 dtype=np.int32)
+        self.cv_results_ = cv_results
+
+        self.best_index_ = int(np.argmax(scores))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = float(scores[self.best_index_])
+        self.best_estimator_ = RandomForestRegressor(**self.best_params_).fit(X, y)
+        return self
+
+
+class DistributedForestSearch(WarmStartForestSearch):
+    """
+    Reducer of the distributed search: the warm_start search, with its cv tasks split into
+    shards (`plan_shards`) and run by separate workers (`run_shard`). In the Step Functions
+    pipeline the workers are invocations of the train Lambda in a Map state, and their results
+    are handed over as shard_results. Without shard_results, the shards are run locally by a
+    process pool standing in for the Map state.
+    """
+
+    def __init__(self, param_grid: dict, cv: int = 5, n_shards: int = 4,
+                 shard_results: typing.Optional[typing.List[dict]] = None,
+                 max_workers: typing.Optional[int] = None):
+        super().__init__(param_grid, cv, n_jobs=1)
+        self.n_shards = n_shards
+        self.shard_results = shard_results
+        self.max_workers = max_workers
+
+    def _run(self, X, y) -> typing.List[dict]:
+        if self.shard_results is not None:
+            logger.info("Reducing %d cv task results from the workers.", len(self.shard_results))
+            return self.shard_results
+        shards = plan_shards(self.param_grid, self.cv, self.n_shards)
+        logger.info("Running %d cv shards in a local process pool.", len(shards))
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(run_shard, shard, X, y, 1) for shard in shards]
+            return [result for future in futures for result in future.result()]
+
+
+def make_search(rf_params: dict, k_cv: int = 5, search: typing.Optional[dict] = None,
+                shard_results: typing.Optional[typing.List[dict]] = None):
+    """
+    Build the hyperparameter search over the random forest grid.
+
+    Args:
+        rf_params: Grid of random forest parameters, each key mapped to a list of values.
+        k_cv: Number of cross-validation folds. Defaults to 5.
+        search: Search settings from the model config. Keys:
+            - strategy: "grid" (exhaustive, the default), "random" (n_iter combinations sampled
+              from the grid) or "halving" (successive halving: every combination starts with
+              a small budget and only the best 1/factor of them move on to a larger one).
+            - n_iter: Combinations sampled by the random search. Defaults to 8.
+            - resource: Budget grown by the halving search, "n_samples" (training rows, the
+              default) or "n_estimators" (trees; the candidate values in rf_params give the
+              smallest and largest budget).
+            - factor: Halving factor. Defaults to 3.
+            - random_state: Seed of the random and halving searches. Defaults to 42.
+            "warm_start" is an exhaustive grid search that grows each forest with warm_start
+            instead of refitting it for every n_estimators value (`WarmStartForestSearch`).
+            "distributed" is the warm_start search split into n_shards shards (defaults to 4)
+            for separate workers (`DistributedForestSearch`).
+        shard_results: Results of the distributed search's workers. Defaults to None (the
+                       shards are run locally).
+
+    Returns:
+        The unfitted search object.
+    """
+    search = search or {}
+    strategy = search.get("strategy", "grid")
+    random_state = search.get("random_state", 42)
+    mod = RandomForestRegressor()
+
+    if strategy == "grid":
+        return GridSearchCV(mod, param_grid = rf_params, cv = k_cv, n_jobs = -1, verbose = 1)
+    if strategy == "random":
+        return RandomizedSearchCV(mod, param_distributions = rf_params,
+                                  n_iter = search.get("n_iter", 8), cv = k_cv, n_jobs = -1,
+                                  random_state = random_state, verbose = 1)
+    if strategy == "halving":
+        resource = search.get("resource", "n_samples")
+        param_grid = dict(rf_params)
+        budget = {}
+        if resource != "n_samples":
+            # The budget replaces the parameter's values in the grid
+            values = param_grid.pop(resource)
+            budget = {"min_resources": min(values), "max_resources": max(values)}
+        return HalvingGridSearchCV(mod, param_grid = param_grid, cv = k_cv,
+                                   resource = resource, factor = search.get("factor", 3),
+                                   n_jobs = -1, random_state = random_state, verbose = 1,
+                                   **budget)
+    if strategy == "warm_start":
+        return WarmStartForestSearch(rf_params, cv = k_cv, n_jobs = -1)
+    if strategy == "distributed":
+        return DistributedForestSearch(rf_params, cv = k_cv, n_shards = search.get("n_shards", 4),
+                                       shard_results = shard_results)
+    raise ValueError(f"Unknown search strategy {strategy}, expected one of {SEARCH_STRATEGIES}")
+
+
+def feature_names(initial_features: typing.List[str],
+                  encoder: typing.Optional[OneHotEncoder]) -> typing.List[str]:
+    """
+    Names of the model features built by `make_features`: the numeric features in the order
+    of initial_features, then the one-hot encoded columns.
+    """
+    if encoder is None:
+        return list(initial_features)
+    categorical = set(encoder.feature_names_in_)
+    return ([name for name in initial_features if name not in categorical] +
+            encoder.get_feature_names_out().tolist())
+
+
+def _encode_split(df: pd.DataFrame, numeric_features: typing.List[str],
+                  cat_features: typing.List[str], encoder: typing.Optional[OneHotEncoder],
+                  sparse: bool) -> typing.Union[pd.DataFrame, scipy.sparse.csr_matrix]:
+    """
+    Build the model features of one split with the fitted encoder: the numeric features, then
+    the one-hot encoded columns. Sparse features are a float32 CSR matrix, stacked without a
+    DataFrame.
+    """
+    if sparse:
+        blocks = [scipy.sparse.csr_matrix(df[numeric_features].to_numpy(dtype=np.float32))]
+        if encoder is not None:
+            blocks.append(encoder.transform(df[cat_features]))
+        return scipy.sparse.hstack(blocks, format="csr", dtype=np.float32)
+
+    features = df[numeric_features]
+    if encoder is None:
+        return features
+    encoded = pd.DataFrame(encoder.transform(df[cat_features]), index=df.index,
+                           columns=encoder.get_feature_names_out())
+    return pd.concat([features, encoded], axis=1, copy=False)
+
+
+def make_features(train: pd.DataFrame, test: typing.Optional[pd.DataFrame], target_var: str,
+                  initial_features: typing.List[str], sparse: bool = False) -> typing.Tuple[
+                      typing.Optional[OneHotEncoder], typing.Union[pd.DataFrame, scipy.sparse.csr_matrix],
+                      typing.Union[pd.DataFrame, scipy.sparse.csr_matrix],
+                      pd.DataFrame, pd.DataFrame]:
+    """
+    One-hot encode the categorical features of train and test, with the encoder fitted on
+    train, and extract the features and target of each. The input frames are not modified.
+
+    Args:
+        train: The pandas DataFrame with the training data.
+        test: The pandas DataFrame with the test data. None to encode train only (e.g. for the
+              cross-validation of a cv shard); x_test and y_test are then None.
         target_var: Name of the target variable.
         initial_features: The list of feature names to use for training the model.
-        rf_params: dictionary with the parameters used for defining the model. The keys 
-                   should include n_estim (number of trees) and depth (maximum depth of 
-                   each tree).
-        k_cv: number of corss-validation folds. Defaults to 5.
+        sparse: If True, the features are float32 CSR matrices, with the encoder's sparse
+                output stacked next to the numeric features. Defaults to False (DataFrames).
 
     Returns:
-        Tuple: A tuple containing:
-            - The best trained random forest classifier from cross-validation.
-            - A pandas DataFrame containing the training data used to train the model.
-            - A pandas DataFrame containing the test data used to evaluate the trained model.
-            - A pandas DataFrame containing the cross-validation results.
+        Tuple: The fitted encoder (None without categorical features), x_train, x_test,
+        y_train and y_test. The columns of the features are `feature_names`.
     """
-    # --- Bind the two datasets to then do OHE on categoricals ---
-
-    # Add dummy to identify entries in each dataset.
-    train["train"] = 1
-    test["train"] = 0
-    logger.debug("train identifier added to train and test dataframes.")
-    
     #  Check if train and test have the same columns 
-    if set(train.columns) != set(test.columns):
+    if test is not None and set(train.columns) != set(test.columns):
         logger.error("Error. Train and test dataframe columns differ. Can't continue with training.")
         sys.exit(1)
 
-    # Concat the two dataframes
-    data = pd.concat([train, test], ignore_index=True)
-    logger.info("Train and test dataframes binded together.")
-
-    # --- Split data into features & target ---
-    logger.info("Splitting data in train and test...")    
-    target = data[[target_var,"train"]]
-    initial_features.append("train")
-    features = data[initial_features]
-    logger.debug("Features and target extracted.")
-    
     # --- OHE Categorical Features ---
     # Identify categorical variables
     logger.info("Identifying categorical features...")
-    cat_features = features.select_dtypes(include=['object', 'category']).columns.tolist()
+    dtypes = train.dtypes
+    cat_features = [name for name in initial_features
+                    if dtypes[name] == object or isinstance(dtypes[name], pd.CategoricalDtype)]
+    numeric_features = [name for name in initial_features if name not in cat_features]
     logger.info("Categorical features identified: %s", cat_features)
 
-    # OneHot Encoding for Selected Categorical Variables
+    # Fit the encoder on train only, so the test categories don't leak into its vocabulary;
+    # categories only seen in test are encoded as all zeros
+    encoder = None
     if cat_features:
-        logger.info("OHE categorical features...")
-        encoder = OneHotEncoder(sparse=False, handle_unknown='ignore')
-        encoded_cats = encoder.fit_transform(features[cat_features])
-
-
-        # Drop original categorical columns and concatenate encoded ones
-        logger.info("Replacing categorical variables with OHE version.")
-        features = features.drop(cat_features, axis=1)
-        encoded_cats_df = pd.DataFrame(encoded_cats, columns=encoder.get_feature_names_out(cat_features))
-        features = pd.concat([features, encoded_cats_df], axis=1)
-        logger.info("Finished OHE of categorical features.")
-  
-    # --- Split data into train & test ---
-    logger.info("Starting splitting of train and test...")
-
-	# Split into train & test
-    try:
-        #x_train, x_test, y_train, y_test = train_test_split(features, target, 
-        #                                                    test_size = test_size,
-        #                                                    random_state = seed)
-        x_train = features[features["train"] == 1].drop("train", axis = 1)
-        x_test = features[features["train"] == 0].drop("train", axis = 1)
-        y_train = target[target["train"] == 1].drop("train", axis = 1)
-        y_test = target[target["train"] == 0].drop("train", axis = 1)
-    except ValueError as err:
-        logger.error("ValueError while splitting data intro train & test. The process can't "+
-                     "continue. Error: ", err)
-        sys.exit(1)
-    except Exception as err:
-        logger.error("Unexpected error while splitting data intro train & test. The process " +
-                     "can't continue. Error: ", err)
-        sys.exit(1)
-    else:
-        logger.info("Splitted features and target into train and test again.")
-        logger.debug("Train features shape: %s", x_train.shape)
+        logger.info("Fitting OHE on the train categorical features...")
+        encoder = OneHotEncoder(sparse_output=sparse, handle_unknown='ignore')
+        encoder.fit(train[cat_features])
+
+    # --- Encode each split ---
+    logger.info("Encoding train and test features...")
+    x_train = _encode_split(train, numeric_features, cat_features, encoder, sparse)
+    y_train = train[[target_var]]
+    x_test = y_test = None
+    if test is not None:
+        x_test = _encode_split(test, numeric_features, cat_features, encoder, sparse)
+        y_test = test[[target_var]]
+    logger.info("Features encoded. Peak memory: %.0f MB", instr.peak_rss_mb())
+    logger.debug("Train features shape: %s", x_train.shape)
+    if x_test is not None:
         logger.debug("Test features shape: %s", x_test.shape)
 
-	
+    return encoder, x_train, x_test, y_train, y_test
+
+
+def train_model(train: pd.DataFrame, test:pd.DataFrame, target_var: str, initial_features: typing.List[str],
+                rf_params: dict, k_cv: int = 5, search: typing.Optional[dict] = None,
+                shard_results: typing.Optional[typing.List[dict]] = None,
+                sparse: bool = False) -> typing.Tuple[
+                    typing.Optional[OneHotEncoder], RandomForestRegressor, pd.DataFrame,
+                    pd.DataFrame, pd.DataFrame]:
+    """
+    Train a random forest regressor using the specified input features.
+
+    Args:
+        train: The pandas DataFrame with the training data.
+        test: The pandas DataFrame with the test data.
+        target_var: Name of the target variable.
+        initial_features: The list of feature names to use for training the model.
+        rf_params: dictionary with the parameters used for defining the model. The keys 
+                   should include n_estim (number of trees) and depth (maximum depth of 
+                   each tree).
+        k_cv: number of corss-validation folds. Defaults to 5.
+        search: search strategy settings, see `make_search`. Defaults to None (exhaustive
+                grid search).
+        shard_results: cv results of the distributed search's workers, see `make_search`.
+        sparse: Fit on sparse CSR features, see `make_features`. The returned train and test
+                DataFrames then have sparse columns. Defaults to False.
+
+    Returns:
+        Tuple: A tuple containing:
+            - The encoder fitted on the train categorical features (None without them).
+            - The best trained random forest regressor from cross-validation.
+            - A pandas DataFrame containing the training data used to train the model.
+            - A pandas DataFrame containing the test data used to evaluate the trained model.
+            - A pandas DataFrame containing the cross-validation results.
+    """
+    with instr.span("encode"):
+        encoder, x_train, x_test, y_train, y_test = make_features(train, test, target_var,
+                                                                  initial_features, sparse)
+
     # --- CV and hyperparameter tuning ---
 
     # Define a Random Forest object & grid search 
     logger.info("Starting modeling with cv for train data...")
-    mod = RandomForestRegressor()
-    grid_search = GridSearchCV(mod, param_grid = rf_params, cv = k_cv, n_jobs = -1, verbose = 1)
+    strategy = (search or {}).get("strategy", "grid")
+    grid_search = make_search(rf_params, k_cv, search, shard_results)
 
     # Fit model 
     try: 
-        logger.info("Starting grid search fit:")
+        logger.info("Starting %s search fit:", strategy)
         #grid_search.fit(x_train[initial_features], y_train)
-        grid_search.fit(x_train, y_train)
+        start = time.perf_counter()
+        with instr.span("fit"):
+            grid_search.fit(x_train, y_train)
+        search_time = time.perf_counter() - start
     except Exception as err:
         logger.error("Unexpected error occured during cross-validation. The process can't continue. " +
               "Error: %s", err)
         sys.exit(1)
     else:
         logger.info("Cross-validation completed. Best parameters found: %s ", grid_search.best_params_)
+        logger.info("%s search: %d fits in %.1f s, best cv score %.4f", strategy,
+                    len(grid_search.cv_results_["params"]) * k_cv, search_time,
+                    grid_search.best_score_)
         
         # Get best model & cv results
         best_model = grid_search.best_estimator_
         cv_results = pd.DataFrame(grid_search.cv_results_)
         logger.info("Best model and cv results extracted.")
 
-    # Bind x_train and y_train
-    train = x_train.copy()
-    train = train.assign(**{target_var: y_train})
-    logger.debug("Train data extracted.")
+    if sparse:
+        # The model was fitted without column names; the exports and scoring need them
+        names = feature_names(initial_features, encoder)
+        best_model.feature_names_in_ = np.asarray(names, dtype=object)
+        x_train = pd.DataFrame.sparse.from_spmatrix(x_train, columns=names)
+        x_test = pd.DataFrame.sparse.from_spmatrix(x_test, columns=names)
 
-	# Bind x_test and y_test
-    test = x_test.copy()
-    test = test.assign(**{target_var: y_test})
-    logger.debug("Test data extracted.")
+    # Add the target to the feature frames in place, without copying the features
+    x_train.insert(x_train.shape[1], target_var, y_train[target_var].to_numpy())
+    x_test.insert(x_test.shape[1], target_var, y_test[target_var].to_numpy())
+    train, test = x_train, x_test
+    logger.debug("Train and test data extracted.")
+    logger.info("Peak memory after training: %.0f MB", instr.peak_rss_mb())
 
 	# Function output
     logger.info("Modeling done. Returning best model, train set, test set and cv results.")
-    return encoded_cats, best_model, train, test, cv_results
+    return encoder, best_model, train, test, cv_results
 
 
-def save_data(train: pd.DataFrame, test: pd.DataFrame, cv_results: pd.DataFrame, save_dir: Path) -> None:
+def read_data(source: typing.Union[Path, str, typing.BinaryIO],
+              columns: typing.Optional[typing.List[str]] = None,
+              file_format: typing.Optional[str] = None) -> pd.DataFrame:
     """
-    Save train and test data as CSV files to a specified directory.
+    Read a clean data file, CSV or Parquet.
+
+    Args:
+        source: Path to the file, or a binary file object (e.g. an S3 object read into memory).
+        columns: Columns to read. Defaults to None (all columns). With Parquet, only these
+                 columns are decoded.
+        file_format: "csv" or "parquet". Defaults to None, in which case it is taken from the
+                     extension of `source`.
+
+    Returns:
+        Pandas DataFrame with the requested columns.
+    """
+    if file_format is None:
+        file_format = Path(source).suffix.lstrip(".")
+    if file_format == "parquet":
+        return pd.read_parquet(source, columns=columns)
+    return pd.read_csv(source, usecols=columns)
+
+
+def _write_frame(df: pd.DataFrame, file_path: Path, file_format: str) -> None:
+    """
+    Write a DataFrame as CSV or compressed Parquet. Parquet has no sparse columns, so frames
+    with sparse columns are densified and written a block of rows at a time.
+    """
+    sparse_columns = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+    if file_format == "parquet" and sparse_columns:
+        block_rows = max(1, SPARSE_WRITE_CELLS // len(df.columns))
+        dense_types = {col: df[col].dtype.subtype for col in sparse_columns}
+        writer = None
+        try:
+            for start in range(0, len(df), block_rows):
+                block = pa.Table.from_pandas(df.iloc[start:start + block_rows].astype(dense_types),
+                                             preserve_index = False)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_path, block.schema, compression = "zstd")
+                writer.write_table(block)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif file_format == "parquet":
+        df.to_parquet(file_path, index = False, compression = "zstd")
+    else:
+        df.to_csv(file_path, index = False)
+
+
+def save_data(train: pd.DataFrame, test: pd.DataFrame, cv_results: pd.DataFrame, save_dir: Path,
+              file_format: str = "csv") -> None:
+    """
+    Save train and test data as CSV or Parquet files to a specified directory.
 
     Args:
         train: Pandas DataFrame containing the training data.
         test: Pandas DataFrame containing the test data.
         cv_results: Pandas DataFrame containing the cv results.
         save_dir: Local directory where train and test data will be saved.
+        file_format: "csv" or "parquet". Defaults to "csv".
     """
     # Save train
     try:
-        train_file = save_dir / "train.csv"
+        train_file = save_dir / f"train.{file_format}"
         logger.info("Saving training data to %s", train_file)
-        train.to_csv(train_file, index = False)
+        _write_frame(train, train_file, file_format)
     except FileNotFoundError:
         logger.warning("File %s not found. The process will continue without saving the train " +
                        "data to csv. Please provide a valid directory to save train data to.", 
@@ -180,9 +545,9 @@ def save_data(train: pd.DataFrame, test: pd.DataFrame, cv_results: pd.DataFrame,
 
 	# Save test
     try:
-        test_file = save_dir / "test.csv"
+        test_file = save_dir / f"test.{file_format}"
         logger.info("Saving test data to %s", test_file)
-        test.to_csv(test_file, index = False)
+        _write_frame(test, test_file, file_format)
     except FileNotFoundError:
         logger.warning("File %s not found. The process will continue without saving the test " +
                        "data to csv. Please provide a valid directory to save test data to.", 
@@ -199,9 +564,9 @@ def save_data(train: pd.DataFrame, test: pd.DataFrame, cv_results: pd.DataFrame,
 
     # Save cv results
     try:
-        cv_file = save_dir / "cv_results.csv"
-        logger.info("Saving cv results to %s", train_file)
-        cv_results.to_csv(cv_file, index = False)
+        cv_file = save_dir / f"cv_results.{file_format}"
+        logger.info("Saving cv results to %s", cv_file)
+        _write_frame(cv_results, cv_file, file_format)
     except FileNotFoundError:
         logger.warning("File %s not found. The process will continue without saving the cv " +
                        "results to csv. Please provide a valid directory to save cv results to.", 
@@ -246,6 +611,171 @@ def save_model(tmo: RandomForestRegressor, save_path: Path) -> None:
     else:
         logger.info("Model saved as pickle file at %s", save_path)
 
+def export_forest(tmo: RandomForestRegressor) -> typing.Dict[str, np.ndarray]:
+    """
+    Flattens the fitted trees of a random forest into contiguous NumPy arrays. The nodes of
+    all trees are concatenated; child indices point into the concatenated arrays and leaves
+    have -1 as children. Leaves have no split, so their prediction is stored in the threshold
+    array instead of a separate value array.
+
+    Args:
+        tmo (RandomForestRegressor): The trained random forest model (single output).
+
+    Returns:
+        Dictionary of arrays: tree_starts (root node of each tree), feature (-2 for leaves),
+        threshold (leaf value for leaves), children_left, children_right, feature_names and
+        left_child_next (True if every left child directly follows its parent, as in trees
+        built depth-first, so the predictor can skip the children_left lookup).
+    """
+    trees = [estimator.tree_ for estimator in tmo.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+
+    def global_children(children, offset):
+        return np.where(children == -1, -1, children + offset)
+
+    children_left = np.concatenate([global_children(tree.children_left, offset)
+                                    for tree, offset in zip(trees, offsets)]).astype(np.int32)
+    threshold = np.concatenate([tree.threshold for tree in trees])
+    value = np.concatenate([tree.value[:, 0, 0] for tree in trees])
+    leaf = children_left == -1
+    split_nodes = np.flatnonzero(~leaf)
+    # int16 feature indices halve the array, unless they do not fit (e.g. sparse one-hot
+    # features of high-cardinality columns)
+    feature_dtype = np.int16 if tmo.n_features_in_ <= np.iinfo(np.int16).max else np.int32
+
+    return {
+        "tree_starts": offsets.astype(np.int64),
+        "feature": np.concatenate([tree.feature for tree in trees]).astype(feature_dtype),
+        "threshold": np.where(leaf, value, threshold),
+        "children_left": children_left,
+        "children_right": np.concatenate([global_children(tree.children_right, offset)
+                                          for tree, offset in zip(trees, offsets)]).astype(np.int32),
+        "feature_names": np.asarray(tmo.feature_names_in_, dtype=str),
+        "left_child_next": np.array(np.array_equal(children_left[split_nodes], split_nodes + 1)),
+    }
+
+
+def save_model_arrays(tmo: RandomForestRegressor, save_path: Path) -> None:
+    """
+    Saves a trained random forest as flat node arrays in one compressed .npz file, a smaller
+    and faster to load alternative to the pickled model.
+
+    Args:
+        tmo (RandomForestRegressor): The trained random forest model to be saved.
+        save_path (Path): The path where the .npz file will be saved.
+    """
+    try:
+        logger.info("Saving flattened tmo arrays to %s", save_path)
+        np.savez_compressed(save_path, **export_forest(tmo))
+    except (FileNotFoundError, PermissionError) as err:
+        logger.warning("Unable to write %s. The process will continue without saving the model " +
+                       "arrays. Error: %s", save_path, err)
+    except Exception as err:
+        logger.warning("An error occurred while exporting the model arrays. The process will " +
+                       "continue without saving them. Error: %s", err)
+    else:
+        logger.info("Model arrays saved to %s", save_path)
+
+def save_model_mmap(tmo: RandomForestRegressor, save_path: Path) -> None:
+    """
+    Saves a trained random forest as flat node arrays in an uncompressed joblib file, so the
+    predictor can memory-map the arrays with `joblib.load(mmap_mode='r')` instead of copying
+    them onto the heap.
+
+    Args:
+        tmo (RandomForestRegressor): The trained random forest model to be saved.
+        save_path (Path): The path where the file will be saved.
+    """
+    try:
+        logger.info("Saving memory-mappable tmo arrays to %s", save_path)
+        dump(export_forest(tmo), save_path)
+    except (FileNotFoundError, PermissionError) as err:
+        logger.warning("Unable to write %s. The process will continue without saving the model " +
+                       "arrays. Error: %s", save_path, err)
+    except Exception as err:
+        logger.warning("An error occurred while exporting the model arrays. The process will " +
+                       "continue without saving them. Error: %s", err)
+    else:
+        logger.info("Memory-mappable model arrays saved to %s", save_path)
+
+def export_pipeline(tmo: RandomForestRegressor, encoder: OneHotEncoder) -> typing.Dict:
+    """
+    Fuses the fitted encoder and the random forest into one inference artifact. Next to the
+    flat node arrays of `export_forest`, it stores how each raw listing field fills the
+    model's feature vector: the column of each numeric field, a category -> column lookup
+    table for each one-hot encoded field and the column of n_amenities (computed from the
+    amenities list). The predictor then builds the feature vector without the encoder.
+
+    Args:
+        tmo (RandomForestRegressor): The trained random forest model (single output).
+        encoder (OneHotEncoder): The encoder fitted on the categorical features, without
+                                 dropped categories. None if the model has no categorical
+                                 features (see `make_features`).
+
+    Returns:
+        Dictionary with the arrays of `export_forest` plus numeric_fields, numeric_columns,
+        categorical_fields, category_columns (one dict per categorical field) and
+        amenities_column (-1 if n_amenities is not a model feature).
+    """
+    if encoder is not None and encoder.drop_idx_ is not None:
+        raise ValueError("Encoders with dropped categories can't be exported as a pipeline")
+
+    columns = {name: idx for idx, name in enumerate(tmo.feature_names_in_)}
+    categorical_fields, encoded_names = [], []
+    if encoder is not None:
+        categorical_fields = encoder.feature_names_in_.tolist()
+        encoded_names = encoder.get_feature_names_out().tolist()
+
+    # The encoder outputs one column per category, field by field, in categories_ order.
+    # Missing values never reach the pipeline (they fail validation), so NaN is left out.
+    category_columns = []
+    names = iter(encoded_names)
+    for categories in (encoder.categories_ if encoder is not None else []):
+        lookup = {}
+        for category in categories:
+            name = next(names)
+            if not pd.isna(category) and name in columns:
+                lookup[str(category)] = columns[name]
+        category_columns.append(lookup)
+
+    encoded = set(encoded_names) | {"n_amenities"}
+    numeric_fields = [name for name in tmo.feature_names_in_ if name not in encoded]
+
+    pipeline = export_forest(tmo)
+    pipeline.update({
+        "numeric_fields": np.asarray(numeric_fields, dtype=str),
+        "numeric_columns": np.asarray([columns[name] for name in numeric_fields], dtype=np.int64),
+        "categorical_fields": np.asarray(categorical_fields, dtype=str),
+        "category_columns": category_columns,
+        "amenities_column": columns.get("n_amenities", -1),
+    })
+    return pipeline
+
+
+def save_pipeline(tmo: RandomForestRegressor, encoder: OneHotEncoder, save_path: Path) -> None:
+    """
+    Saves the fused encoder + random forest inference artifact (`export_pipeline`) in an
+    uncompressed joblib file, so the predictor can memory-map its node arrays.
+
+    Args:
+        tmo (RandomForestRegressor): The trained random forest model to be saved.
+        encoder (OneHotEncoder): The fitted encoder of the categorical features.
+        save_path (Path): The path where the file will be saved.
+    """
+    try:
+        logger.info("Saving fused inference pipeline to %s", save_path)
+        dump(export_pipeline(tmo, encoder), save_path)
+    except (FileNotFoundError, PermissionError) as err:
+        logger.warning("Unable to write %s. The process will continue without saving the " +
+                       "inference pipeline. Error: %s", save_path, err)
+    except Exception as err:
+        logger.warning("An error occurred while exporting the inference pipeline. The process " +
+                       "will continue without saving it. Error: %s", err)
+        # A partly written file must not be published as the pipeline
+        Path(save_path).unlink(missing_ok=True)
+    else:
+        logger.info("Fused inference pipeline saved to %s", save_path)
+
 def save_encoder(encoder, filepath):
     """
     Save the One-Hot Encoder object to a file using joblib.
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# The Lambda imports its modules as `src.*` from the Lambda folder; the predictor module
+# is read from the prediction Lambda next to it
+LAMBDA_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(LAMBDA_DIR))
+# appended: the prediction Lambda also has a lambda_function module
+sys.path.append(str(LAMBDA_DIR.parent / "lambda_data_predict_price_docker"))
@@ -0,0 +1,58 @@
+import io
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+
+import prediction_utils as pu
+from src import train_model as tm
+
+
+def test_sklearn_model_is_loaded_once_for_the_cached_version(monkeypatch):
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.random((200, 4)), columns=["a", "b", "c", "d"])
+    y = X["a"] * 3 + X["c"]
+    estimator = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, y)
+    forest = pu.CompactForest(tm.export_forest(estimator))
+
+    reads = []
+
+    def read_s3_object(s3_client, bucket_name, key):
+        reads.append(key)
+        return io.BytesIO(pickle.dumps(estimator))
+
+    monkeypatch.setattr(pu, "read_s3_object", read_s3_object)
+    cache = pu.ArtifactCache()
+    cache._entry = pu.CachedArtifacts("v1", "etag", forest, None, "models/v1/tmo.pkl")
+
+    # another version's model gets no sklearn model
+    assert cache.sklearn_model("bucket", object()) is None
+    sklearn_model = cache.sklearn_model("bucket", forest)
+    assert cache.sklearn_model("bucket", forest) is sklearn_model
+    assert reads == ["models/v1/tmo.pkl"]
+    np.testing.assert_array_equal(sklearn_model.predict(X), forest.predict(X))
+
+    # a version without a pickle model keeps the NumPy engine
+    cache._entry = pu.CachedArtifacts("v2", "etag", forest, None)
+    assert cache.sklearn_model("bucket", forest) is None
+
+
+def test_version_without_encoder_loads_no_encoder(monkeypatch, tmp_path):
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.random((100, 3)), columns=["a", "b", "c"])
+    estimator = RandomForestRegressor(n_estimators=3, random_state=0).fit(X, X["a"])
+    tm.save_model_arrays(estimator, tmp_path / "tmo.npz")
+
+    reads = []
+
+    def read_s3_object(s3_client, bucket_name, key):
+        reads.append(key)
+        return io.BytesIO((tmp_path / "tmo.npz").read_bytes())
+
+    monkeypatch.setattr(pu, "read_s3_object", read_s3_object)
+    manifest = {"version": "v1", "models": {"npz": "models/v1/tmo.npz"}, "encoder_key": None}
+    entry = pu.ArtifactCache()._load("bucket", manifest, "etag", {"model_format": "npz"})
+    assert entry.encoder is None
+    assert reads == ["models/v1/tmo.npz"]
+    np.testing.assert_array_equal(entry.model.predict(X), estimator.predict(X))
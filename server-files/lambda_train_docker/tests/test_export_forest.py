@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+import prediction_utils as pu
+from src import train_model as tm
+
+
+def fit_forest(n_features, informative, n_rows=200, seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.zeros((n_rows, n_features), dtype=np.float32)
+    X[:, informative] = rng.random((n_rows, len(informative)))
+    y = X[:, informative] @ np.arange(1, len(informative) + 1) + rng.normal(0, 0.1, n_rows)
+    X = pd.DataFrame(X, columns=[f"f{i}" for i in range(n_features)])
+    model = RandomForestRegressor(n_estimators=5, max_depth=6, random_state=seed).fit(X, y)
+    return model, X
+
+
+def test_compact_forest_matches_sklearn():
+    model, X = fit_forest(20, [0, 7, 19])
+    forest = pu.CompactForest(tm.export_forest(model))
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+
+
+def test_compact_forest_matches_sklearn_beyond_int16_features():
+    # e.g. one-hot encoded high-cardinality columns: split features past index 32767
+    n_features = np.iinfo(np.int16).max + 1000
+    model, X = fit_forest(n_features, [5, 32767, 32768, n_features - 1])
+    arrays = tm.export_forest(model)
+    assert arrays["feature"].max() > np.iinfo(np.int16).max
+
+    forest = pu.CompactForest(arrays)
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+
+
+def listings(n_rows=120, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "bedrooms": rng.integers(0, 5, n_rows).astype(float),
+        "square_feet": rng.integers(300, 2000, n_rows).astype(float),
+        "state": rng.choice(["ca", "ny", "tx"], n_rows),
+        "amenities": [["gym"] * k for k in rng.integers(0, 4, n_rows)],
+        "price": rng.normal(1500, 300, n_rows),
+    })
+
+
+@pytest.mark.parametrize("features", [["bedrooms", "square_feet", "state"],
+                                      ["bedrooms", "square_feet"]],
+                         ids=["categorical", "numeric_only"])
+def test_pipeline_matches_encoder_and_forest(features):
+    df = listings()
+    encoder, x_train, _, y_train, _ = tm.make_features(df, df, "price", features)
+    assert (encoder is None) == ("state" not in features)
+    model = RandomForestRegressor(n_estimators=5, max_depth=6, random_state=0)
+    model.fit(x_train, y_train["price"])
+
+    pipeline = pu.InferencePipeline(tm.export_pipeline(model, encoder))
+    np.testing.assert_array_equal(pipeline.predict(pipeline.transform(df)), model.predict(x_train))
+    # the model + encoder formats build the same features
+    assert set(pu.required_fields(model, encoder)) == set(features)
+    np.testing.assert_array_equal(model.predict(pu.make_features(df, model, encoder)),
+                                  model.predict(x_train))
+
+
+def test_missing_model_format_raises():
+    cache = pu.ArtifactCache()
+    manifest = {"version": "v1", "models": {"npz": "models/v1/tmo.npz"}}
+    with pytest.raises(ValueError, match="has no pipeline model"):
+        cache._load("bucket", manifest, "etag", {"model_format": "pipeline"})
+
+
+def test_make_features_without_test_split():
+    # cv shards encode the train split only
+    train, test = listings(seed=0), listings(seed=1)
+    features = ["bedrooms", "square_feet", "state"]
+    encoder, x_train, x_test, y_train, y_test = tm.make_features(train, None, "price", features)
+    assert x_test is None and y_test is None
+    _, expected, _, expected_y, _ = tm.make_features(train, test, "price", features)
+    pd.testing.assert_frame_equal(x_train, expected)
+    pd.testing.assert_frame_equal(y_train, expected_y)
@@ -0,0 +1,79 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from src import instrumentation
+
+SERVER_FILES = Path(__file__).resolve().parents[2]
+COPIES = ["lambda_get_data_docker/instrumentation.py",
+          "lambda_data_clean_docker/instrumentation.py",
+          "lambda_data_predict_price_docker/instrumentation.py"]
+
+
+@pytest.mark.parametrize("copy", COPIES)
+def test_lambda_copies_match_the_train_lambda(copy):
+    # Each image has its own copy; edit them together
+    expected = (SERVER_FILES / "lambda_train_docker/src/instrumentation.py").read_bytes()
+    assert (SERVER_FILES / copy).read_bytes() == expected
+
+
+def test_span_prints_one_emf_record(capsys):
+    run = instrumentation.Run("train_model", run_id="run-1")
+    with run.span("download") as stage:
+        stage.bytes_in += 1024
+
+    record = json.loads(capsys.readouterr().out)
+    metrics = record["_aws"]["CloudWatchMetrics"][0]
+    assert metrics["Namespace"] == instrumentation.NAMESPACE
+    assert metrics["Dimensions"] == [["Function", "Stage"]]
+    assert {metric["Name"]: metric["Unit"] for metric in metrics["Metrics"]} == \
+        instrumentation.METRIC_UNITS
+    assert isinstance(record["_aws"]["Timestamp"], int)
+    assert (record["Function"], record["Stage"], record["RunId"]) == \
+        ("train_model", "download", "run-1")
+    assert record["Error"] is None
+    assert record["BytesIn"] == 1024 and record["BytesOut"] == 0
+    # every declared metric has a value in the record
+    assert all(isinstance(record[name], (int, float)) for name in instrumentation.METRIC_UNITS)
+    assert record["PeakRss"] > 0
+
+
+def test_failed_span_is_kept_with_its_error(capsys):
+    run = instrumentation.Run("clean", run_id="run-1")
+    with pytest.raises(KeyError):
+        with run.span("parse"):
+            raise KeyError("price")
+
+    assert json.loads(capsys.readouterr().out)["Error"] == "KeyError"
+    assert [(stage.name, stage.error) for stage in run.spans] == [("parse", "KeyError")]
+
+
+def test_silent_run_saves_timings_json(capsys, tmp_path):
+    run = instrumentation.Run("local", run_id="run-1", emit=False)
+    with run.span("fit") as stage:
+        stage.bytes_out = 10
+    with run.span("upload"):
+        pass
+    run.save(tmp_path / "timings.json")
+
+    assert capsys.readouterr().out == ""
+    timings = json.loads((tmp_path / "timings.json").read_text())
+    assert (timings["function"], timings["run_id"]) == ("local", "run-1")
+    assert timings["total_wall_ms"] >= sum(span["wall_ms"] for span in timings["spans"])
+    assert [span["stage"] for span in timings["spans"]] == ["fit", "upload"]
+    assert set(timings["spans"][0]) == {"stage", "wall_ms", "cpu_ms", "peak_rss_mb",
+                                        "rss_growth_mb", "bytes_in", "bytes_out", "error"}
+    assert timings["spans"][0]["bytes_out"] == 10
+    assert timings["peak_rss_mb"] >= timings["spans"][0]["peak_rss_mb"]
+
+
+def test_module_span_uses_the_current_run(capsys, monkeypatch):
+    monkeypatch.setattr(instrumentation, "_current_run", None)
+    run = instrumentation.start_run("predict", run_id="run-1")
+    with instrumentation.span("score"):
+        pass
+
+    assert instrumentation.current_run() is run
+    assert [stage.name for stage in run.spans] == ["score"]
+    assert json.loads(capsys.readouterr().out)["Function"] == "predict"
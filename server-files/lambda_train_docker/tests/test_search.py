@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_regression
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import GridSearchCV
+
+from src import train_model as tm
+
+RF_PARAMS = {"n_estimators": [4, 8, 12], "max_depth": [3, None], "max_features": [0.5, 1.0],
+             "random_state": [0]}
+K_CV = 3
+
+
+@pytest.fixture(scope="module")
+def data():
+    return make_regression(n_samples=150, n_features=6, noise=5.0, random_state=0)
+
+
+@pytest.fixture(scope="module")
+def grid_search(data):
+    return GridSearchCV(RandomForestRegressor(), RF_PARAMS, cv=K_CV, n_jobs=1).fit(*data)
+
+
+@pytest.mark.parametrize("search", [
+    tm.WarmStartForestSearch(RF_PARAMS, K_CV, n_jobs=1),
+    tm.DistributedForestSearch(RF_PARAMS, K_CV, n_shards=3, max_workers=2),
+], ids=["warm_start", "distributed"])
+def test_search_matches_grid_search(search, data, grid_search):
+    search.fit(*data)
+    expected = grid_search.cv_results_
+
+    assert search.best_params_ == grid_search.best_params_
+    assert search.cv_results_["params"] == expected["params"]
+    np.testing.assert_array_equal(search.cv_results_["rank_test_score"],
+                                  expected["rank_test_score"])
+    for key in [f"split{fold}_test_score" for fold in range(K_CV)] + ["mean_test_score",
+                                                                        "std_test_score"]:
+        np.testing.assert_allclose(search.cv_results_[key], expected[key], rtol=1e-12)
+    np.testing.assert_array_equal(search.best_estimator_.predict(data[0]),
+                                  grid_search.best_estimator_.predict(data[0]))
@@ -0,0 +1,29 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# The clean Lambda also has a lambda_function module, so the predictor's is loaded by path
+PREDICT_DIR = Path(__file__).resolve().parents[2] / "lambda_data_predict_price_docker"
+spec = importlib.util.spec_from_file_location("predict_lambda_function",
+                                              PREDICT_DIR / "lambda_function.py")
+plf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(plf)
+
+
+def test_amenity_items_are_cast_to_str():
+    listings = [{"amenities": ["Gym", 1, None]}, {"amenities": np.nan},
+                {"amenities": "Gym,Pool"}, {"amenities": ("AC", 2.5)}]
+    df, error_mask, messages = plf.validate_listings(pd.DataFrame(listings))
+
+    assert df.amenities[0] == ["Gym", "1", "None"]
+    assert pd.isna(df.amenities[1])
+    assert df.amenities[3] == ["AC", "2.5"]
+    np.testing.assert_array_equal(error_mask, [False, False, True, False])
+    assert messages[2] == "Invalid type for amenities: expected a list; "
+
+    # the one-row path coerces the same way
+    assert plf.validate_listing(listings[0]) == ({"amenities": ["Gym", "1", "None"]}, "")
+    assert plf.validate_listing(listings[2])[1] == "Invalid type for amenities: expected a list"
+    assert plf.validate_listing(listings[3]) == ({"amenities": ["AC", "2.5"]}, "")
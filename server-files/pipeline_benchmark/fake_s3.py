@@ -0,0 +1,72 @@
+"""
+Local stand-in for S3, so the Lambdas can run offline against a bucket that lives in the
+benchmark process.
+
+It is a moto server on localhost. The Lambdas are pointed at it with the AWS_ENDPOINT_URL
+environment variable, which boto3 clients pick up without code changes, so every call the
+Lambdas make (download_fileobj, multipart uploads, conditional GETs, ...) goes through the
+same boto3 code paths as on AWS. moto keeps large objects in temporary files, not in memory.
+"""
+import logging
+import socket
+from typing import Dict
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+REGION = "us-east-1"
+ACCESS_KEY_ID = "benchmark"
+SECRET_ACCESS_KEY = "benchmark"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeS3:
+    """
+    A moto S3 server with one bucket, started and stopped with `with`.
+
+        with FakeS3("aws-mlops-benchmark") as s3:
+            subprocess.run(..., env={**os.environ, **s3.env()})
+    """
+
+    def __init__(self, bucket_name: str, port: int = None):
+        self.bucket_name = bucket_name
+        self.port = port or _free_port()
+        self.endpoint_url = f"http://127.0.0.1:{self.port}"
+        self._server = ThreadedMotoServer(ip_address="127.0.0.1", port=self.port, verbose=False)
+        # No access log line per request
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    def __enter__(self) -> "FakeS3":
+        self._server.start()
+        self.client().create_bucket(Bucket=self.bucket_name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.stop()
+
+    def env(self) -> Dict[str, str]:
+        """Environment variables that point boto3 at the fake S3."""
+        return {"AWS_ENDPOINT_URL": self.endpoint_url, "AWS_ACCESS_KEY_ID": ACCESS_KEY_ID,
+                "AWS_SECRET_ACCESS_KEY": SECRET_ACCESS_KEY, "AWS_DEFAULT_REGION": REGION}
+
+    def config_ini(self) -> str:
+        """
+        The config.ini the Lambdas read: the bucket name and the credential profiles. The
+        credentials are fake; moto accepts any.
+        """
+        profile = (f"aws_access_key_id = {ACCESS_KEY_ID}\n"
+                   f"aws_secret_access_key = {SECRET_ACCESS_KEY}\n"
+                   f"region_name = {REGION}\n")
+        return (f"[s3]\nbucket_name = {self.bucket_name}\n\n"
+                f"[aws-mlops-s3readwrite]\n{profile}\n"
+                f"[aws-mlops-s3readonly]\n{profile}")
+
+    def client(self):
+        return boto3.client("s3", endpoint_url=self.endpoint_url, region_name=REGION,
+                            aws_access_key_id=ACCESS_KEY_ID,
+                            aws_secret_access_key=SECRET_ACCESS_KEY)
@@ -0,0 +1,99 @@
+"""
+Runs the handler of one Lambda on a list of events, in a fresh process whose working directory
+is the Lambda's task root (see `run_benchmark.build_task_root`). Started by run_benchmark.py:
+
+    python invoke_lambda.py --task-root roots/clean --handler lambda_function.lambda_handler \
+        --events events.json --out result.json
+
+The first event is the cold invocation: the import of the handler module is timed separately
+as init, like the init phase of a Lambda. The result file has, per event, the wall time, the
+status code, the error (if any) and the stage spans the Lambda recorded with its
+instrumentation module, and the peak RSS of the process.
+"""
+import argparse
+import importlib
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+import uuid
+
+
+class Context:
+    """The attributes of the Lambda context object that the handlers use."""
+
+    def __init__(self):
+        self.aws_request_id = uuid.uuid4().hex
+
+
+def status_of(response) -> int:
+    # The clean Lambda returns nothing on success
+    if isinstance(response, dict):
+        return int(response.get("statusCode", 200))
+    return 200
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak RSS of this process in MB, from VmHWM: ru_maxrss survives the fork/exec from
+    run_benchmark.py and would report the peak of the benchmark process instead.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_spans() -> list:
+    """Spans of the run started by the last invocation, from the Lambda's own module."""
+    module = sys.modules.get("instrumentation") or sys.modules.get("src.instrumentation")
+    if module is None or module._current_run is None:
+        return []
+    return module._current_run.summary()["spans"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Invoke a Lambda handler on a list of events")
+    parser.add_argument("--task-root", required=True)
+    parser.add_argument("--handler", required=True, help="module.function, as in the Dockerfile CMD")
+    parser.add_argument("--events", required=True, help="JSON file with the list of events")
+    parser.add_argument("--out", required=True, help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    with open(args.events) as file:
+        events = json.load(file)
+    out = os.path.abspath(args.out)
+    os.chdir(args.task_root)
+    sys.path.insert(0, os.getcwd())
+
+    module_name, function_name = args.handler.rsplit(".", 1)
+    start = time.perf_counter()
+    handler = getattr(importlib.import_module(module_name), function_name)
+    init_ms = (time.perf_counter() - start) * 1e3
+
+    invocations = []
+    for event in events:
+        start = time.perf_counter()
+        try:
+            response = handler(event, Context())
+            status, error = status_of(response), None
+            body = response.get("body") if isinstance(response, dict) else None
+        except Exception as err:
+            traceback.print_exc()
+            response, status, error, body = None, 500, f"{type(err).__name__}: {err}", None
+        wall_ms = (time.perf_counter() - start) * 1e3
+        if status != 200 and error is None:
+            error = body
+        invocations.append({"status": status, "error": error, "wall_ms": round(wall_ms, 3),
+                            "body": body if status == 200 else None, "spans": current_spans()})
+
+    with open(out, "w") as file:
+        json.dump({"init_ms": round(init_ms, 3),
+                   "peak_rss_mb": round(peak_rss_mb(), 1),
+                   "invocations": invocations}, file)
@@ -0,0 +1,410 @@
+"""
+End-to-end benchmark of the pipeline (ingest -> clean -> train, score, evaluate -> predict),
+run offline on synthetic listings against a local fake S3.
+
+    python run_benchmark.py --rows 10000 100000 1000000 --out report.json
+    python run_benchmark.py --rows 100000 --out new.json --baseline report.json
+
+For each number of rows it writes raw files with `synthetic_listings`, serves them as a zip of
+7z archives like the UCI download, and runs the Lambdas in order, each in a fresh process
+whose working directory is a copy of the Lambda's image content (the "task root"). The
+Lambdas run unchanged: their boto3 calls go to the fake S3 (see `fake_s3`).
+
+The report has, per number of rows and stage, the status, the init and handler wall time, the
+throughput in input rows per second, the peak RSS of the Lambda process, and the spans the
+Lambda recorded for its own stages (download, parse, fit, score, ...) with their bytes read
+and written. With the ingest stage, ingest and clean are run a second time on the same source
+(ingest_unchanged, clean_unchanged), which measures the incremental path with nothing to do.
+With --baseline, the wall time and peak RSS of each stage are compared with an
+earlier report and the command fails if any got worse by more than --threshold.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pyarrow.parquet as pq
+import py7zr
+import yaml
+
+import synthetic_listings as sl
+from fake_s3 import FakeS3
+
+HERE = Path(__file__).resolve().parent
+SERVER_FILES = HERE.parent
+
+# Lambda of each stage: source folder, handler (the Dockerfile CMD) and where it reads config.ini
+LAMBDAS = {
+    "ingest": {"dir": "lambda_get_data_docker", "handler": "get_data.lambda_handler",
+               "config_ini": "config/config.ini"},
+    "clean": {"dir": "lambda_data_clean_docker", "handler": "lambda_function.lambda_handler",
+              "config_ini": "config.ini"},
+    "train": {"dir": "lambda_train_docker", "handler": "main.lambda_handler",
+              "config_ini": "config/config.ini"},
+    "predict": {"dir": "lambda_data_predict_price_docker",
+                "handler": "lambda_function.lambda_handler", "config_ini": "config.ini"},
+}
+STAGES = list(LAMBDAS)
+
+# Names of the files in the UCI zip; get_data renames the 100K one to raw_1 and the 10K one to raw_2
+SOURCE_FILES = {"raw_1": "apartments_for_rent_classified_100K",
+                "raw_2": "apartments_for_rent_classified_10K"}
+# Share of the rows in raw_1, as in the UCI data
+RAW_1_SHARE = 0.9
+
+MODEL_CONFIG_KEY = "benchmark.yaml"
+LISTINGS_KEY = "benchmark/listings.parquet"
+# Stages faster than this are too noisy for a wall time regression
+MIN_WALL_S = 1.0
+
+
+def build_task_root(stage: str, root: Path, s3: FakeS3, scratch: Path,
+                    clean_chunk_rows: Optional[int] = None) -> Path:
+    """
+    Copy the files of a Lambda's image into root/<stage> with a config.ini for the fake S3.
+    Settings that would reach the internet or /tmp are changed in the copied configs. With
+    clean_chunk_rows, the clean Lambda runs in its chunked mode.
+    """
+    spec = LAMBDAS[stage]
+    task_root = root / stage
+    shutil.rmtree(task_root, ignore_errors=True)
+    shutil.copytree(SERVER_FILES / spec["dir"], task_root,
+                    ignore=shutil.ignore_patterns("benchmark_*.py", "Dockerfile", "README.md",
+                                                  "requirements*.txt", "__pycache__"))
+    config_ini = task_root / spec["config_ini"]
+    config_ini.parent.mkdir(parents=True, exist_ok=True)
+    config_ini.write_text(s3.config_ini())
+
+    if stage == "clean":
+        # Offline: no Nominatim calls for listings without a neighbour
+        path = task_root / "data_clean_config.yaml"
+        dc_config = yaml.safe_load(path.read_text())
+        dc_config["geocode"]["nominatim_fallback"] = False
+        if clean_chunk_rows:
+            dc_config["chunked"] = {"enabled": True, "chunk_rows": clean_chunk_rows}
+        path.write_text(yaml.safe_dump(dc_config, sort_keys=False))
+    if stage == "predict":
+        path = task_root / "inference_config.yaml"
+        inf_config = yaml.safe_load(path.read_text())
+        inf_config["mmap_dir"] = str(scratch)
+        path.write_text(yaml.safe_dump(inf_config, sort_keys=False))
+    return task_root
+
+
+def write_raw_data(data_dir: Path, n_rows: int, seed: int, profile: dict = None,
+                   workers: int = 1) -> Dict[str, Path]:
+    """Write (or reuse) the two raw CSV files of n_rows listings."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    n_raw_1 = int(n_rows * RAW_1_SHARE)
+    rows = {"raw_1": n_raw_1, "raw_2": n_rows - n_raw_1}
+    paths = {}
+    for idx, (name, n) in enumerate(rows.items()):
+        path = data_dir / f"{SOURCE_FILES[name]}.csv"
+        done = path.with_suffix(".done")
+        if not done.exists():
+            # Disjoint ids and different cities in the two files
+            sl.write_raw_csv(path, n, seed=seed + idx, first_id=5_000_000_000 + idx * n_raw_1,
+                             profile=profile, workers=workers)
+            done.touch()
+        paths[name] = path
+    return paths
+
+
+def write_source_zip(raw_files: Dict[str, Path], zip_path: Path) -> Path:
+    """Pack the raw files like the UCI download: a zip holding one 7z archive per CSV."""
+    if zip_path.exists():
+        return zip_path
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as archive:
+        for path in raw_files.values():
+            seven_zip = path.with_suffix(".7z")
+            # Fast LZMA2 preset, the archives are rebuilt for every number of rows
+            with py7zr.SevenZipFile(seven_zip, "w",
+                                    filters=[{"id": py7zr.FILTER_LZMA2, "preset": 1}]) as z:
+                z.write(path, path.name)
+            archive.write(seven_zip, seven_zip.name)
+            seven_zip.unlink()
+    return zip_path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_directory(directory: Path) -> ThreadingHTTPServer:
+    """Serve the files of a directory over HTTP on localhost, in a background thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                 functools.partial(QuietHandler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def invoke(stage: str, name: str, task_root: Path, events: List[dict], work_dir: Path,
+           s3: FakeS3, scratch: Path, timeout: Optional[float]) -> dict:
+    """
+    Run the handler of a stage's Lambda on events in a fresh process, see invoke_lambda.py.
+    The events, result and log files are named after `name`.
+    """
+    events_file = work_dir / f"{name}-events.json"
+    out_file = work_dir / f"{name}-result.json"
+    events_file.write_text(json.dumps(events))
+    out_file.unlink(missing_ok=True)
+    env = {**os.environ, **s3.env(), "TMPDIR": str(scratch)}
+    command = [sys.executable, str(HERE / "invoke_lambda.py"), "--task-root", str(task_root),
+               "--handler", LAMBDAS[stage]["handler"], "--events", str(events_file),
+               "--out", str(out_file)]
+    with open(work_dir / f"{name}.log", "w") as log:
+        try:
+            process = subprocess.run(command, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                     timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return {"error": f"timed out after {timeout} s"}
+    if process.returncode != 0 or not out_file.exists():
+        # e.g. killed by the OOM killer; the log has the details
+        return {"error": f"process exited with code {process.returncode}"}
+    return json.loads(out_file.read_text())
+
+
+def stage_report(result: dict, rows: int) -> dict:
+    """Summarize the invocations of a stage; spans of the same name are added up."""
+    if "invocations" not in result:
+        return {"status": "failed", "error": result["error"], "rows": rows}
+    invocations = result["invocations"]
+    errors = [inv["error"] for inv in invocations if inv["status"] != 200]
+    wall_s = sum(inv["wall_ms"] for inv in invocations) / 1e3
+    spans = {}
+    for inv in invocations:
+        for span in inv["spans"]:
+            total = spans.setdefault(span["stage"], {"wall_ms": 0.0, "cpu_ms": 0.0,
+                                                     "peak_rss_mb": 0.0, "bytes_in": 0,
+                                                     "bytes_out": 0})
+            for key in ("wall_ms", "cpu_ms", "bytes_in", "bytes_out"):
+                total[key] += span[key]
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], span["peak_rss_mb"])
+    return {
+        "status": "failed" if errors else "ok",
+        "error": errors[0] if errors else None,
+        "rows": rows,
+        "invocations": len(invocations),
+        "init_s": round(result["init_ms"] / 1e3, 3),
+        "wall_s": round(wall_s, 3),
+        "rows_per_s": round(rows / wall_s, 1) if wall_s else None,
+        "peak_rss_mb": result["peak_rss_mb"],
+        "spans": {name: {key: round(value, 3) for key, value in span.items()}
+                  for name, span in spans.items()},
+    }
+
+
+def body_of(result: dict, idx: int = -1) -> dict:
+    return json.loads(result["invocations"][idx]["body"])
+
+
+def parquet_rows(s3: FakeS3, key: str, scratch: Path) -> int:
+    path = scratch / Path(key).name
+    s3.client().download_file(s3.bucket_name, key, str(path))
+    n_rows = pq.read_metadata(path).num_rows
+    path.unlink()
+    return n_rows
+
+
+def prediction_listings(s3: FakeS3, key: str, n_rows: int, scratch: Path):
+    """The first n_rows clean test listings, without the price."""
+    path = scratch / Path(key).name
+    s3.client().download_file(s3.bucket_name, key, str(path))
+    batch = next(pq.ParquetFile(path).iter_batches(batch_size=n_rows))
+    path.unlink()
+    return batch.to_pandas().drop(columns="price")
+
+
+def run_scale(n_rows: int, args: argparse.Namespace, s3: FakeS3, roots: Dict[str, Path],
+              data_root: Path, scratch: Path) -> Dict[str, dict]:
+    """Run the stages on n_rows listings; stages after a failed one are skipped."""
+    work_dir = Path(args.workdir) / "runs" / str(n_rows)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    report = {}
+
+    start = time.perf_counter()
+    profile_name = Path(args.profile).stem if args.profile else "default"
+    raw_files = write_raw_data(data_root / f"{n_rows}-{args.seed}-{profile_name}", n_rows,
+                               args.seed, sl.load_profile(args.profile), args.generate_workers)
+    report["generate"] = {"status": "ok", "rows": n_rows,
+                          "wall_s": round(time.perf_counter() - start, 3),
+                          "bytes_out": sum(path.stat().st_size for path in raw_files.values())}
+
+    def run(stage, events, rows, name=None):
+        name = name or stage
+        result = invoke(stage, name, roots[stage], events, work_dir, s3, scratch, args.timeout)
+        report[name] = stage_report(result, rows)
+        print(json.dumps({"rows": n_rows, "stage": name,
+                          **{key: report[name].get(key)
+                             for key in ("status", "wall_s", "peak_rss_mb", "error")}}),
+              flush=True)
+        return result if report[name]["status"] == "ok" else None
+
+    if "ingest" in args.stages:
+        zip_path = write_source_zip(raw_files, raw_files["raw_1"].parent / "apartments.zip")
+        server = serve_directory(zip_path.parent)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/{zip_path.name}"
+            if not run("ingest", [{"source_url": url}], n_rows):
+                return report
+            if "clean" in args.stages and not run("clean", [{}], n_rows):
+                return report
+            # Same source again: the incremental ingestion and the clean stage skip their work
+            if not run("ingest", [{"source_url": url}], n_rows, "ingest_unchanged"):
+                return report
+            if "clean" in args.stages and not run("clean", [{}], n_rows, "clean_unchanged"):
+                return report
+        finally:
+            server.shutdown()
+    else:
+        for name, path in raw_files.items():
+            s3.client().upload_file(str(path), s3.bucket_name, f"data/raw/{name}.csv")
+        if "clean" in args.stages and not run("clean", [{}], n_rows):
+            return report
+
+    model_config = yaml.safe_load(Path(args.model_config).read_text())
+    run_config = model_config["run_config"]
+    if "train" in args.stages:
+        model_config["aws"]["bucket_name"] = s3.bucket_name
+        s3.client().put_object(Bucket=s3.bucket_name, Key=f"config/{MODEL_CONFIG_KEY}",
+                               Body=yaml.safe_dump(model_config).encode())
+        train_rows = parquet_rows(s3, run_config["clean_train_key"], scratch)
+        event = {"modelConfigKey": MODEL_CONFIG_KEY}
+
+        # Same flow as the Step Functions pipeline: plan, cv shards, then train
+        result = run("train", [{**event, "mode": "plan"}], 0, "train_plan")
+        if not result:
+            return report
+        plan = body_of(result)
+        shard_results = []
+        if plan["distributed"]:
+            result = run("train", [{**event, "mode": "cv_shard", "shard": shard}
+                                   for shard in plan["shards"]], train_rows, "train_cv_shards")
+            if not result:
+                return report
+            shard_results = [body_of(result, idx) for idx in range(len(plan["shards"]))]
+        if not run("train", [{**event, "shardResults": shard_results}], train_rows):
+            return report
+
+    if "predict" in args.stages:
+        listings = prediction_listings(s3, run_config["clean_test_key"], args.predict_rows,
+                                       scratch)
+        path = scratch / "listings.parquet"
+        listings.to_parquet(path, index=False)
+        s3.client().upload_file(str(path), s3.bucket_name, LISTINGS_KEY)
+        singles = json.loads(listings.head(args.predict_single).to_json(orient="records"))
+
+        # One process: the first single prediction is the cold one, the others are warm
+        result = run("predict", singles, len(singles), "predict_single")
+        if result:
+            latencies = np.array([inv["wall_ms"] for inv in result["invocations"]])
+            report["predict_single"].update({
+                "cold_ms": round(float(latencies[0]), 3),
+                "warm_p50_ms": round(float(np.percentile(latencies[1:], 50)), 3),
+                "warm_p95_ms": round(float(np.percentile(latencies[1:], 95)), 3),
+            })
+        run("predict", [{"listings_s3_key": LISTINGS_KEY}], len(listings), "predict_batch")
+    return report
+
+
+def compare(baseline: dict, report: dict, threshold: float) -> List[dict]:
+    """Wall time and peak RSS of each stage against the baseline report."""
+    rows = []
+    for n_rows, stages in report["runs"].items():
+        for stage, new in stages.items():
+            old = baseline["runs"].get(n_rows, {}).get(stage)
+            if not old or old["status"] != "ok" or new["status"] != "ok" or stage == "generate":
+                continue
+            row = {"rows": int(n_rows), "stage": stage}
+            for key in ("wall_s", "peak_rss_mb"):
+                if old.get(key) and new.get(key) is not None:
+                    row[key] = [old[key], new[key]]
+                    row[f"{key}_ratio"] = round(new[key] / old[key], 3)
+            row["regression"] = (row.get("peak_rss_mb_ratio", 0) > threshold or
+                                 (row.get("wall_s_ratio", 0) > threshold and
+                                  new["wall_s"] >= MIN_WALL_S))
+            rows.append(row)
+    return rows
+
+
+def host_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"platform": platform.platform(), "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "memory_mb": round(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20),
+            "git_commit": commit or None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000],
+                        help="Numbers of listings to run the pipeline on, e.g. 10000 ... 10000000")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES,
+                        help="Stages to run. Without ingest, the raw files are put in S3 directly")
+    parser.add_argument("--out", default="pipeline_benchmark.json", help="Report file")
+    # outside the checkout by default: the generated data can take gigabytes
+    parser.add_argument("--workdir", default=str(Path(tempfile.gettempdir()) / "pipeline_benchmark"),
+                        help="Folder for the task roots, data and logs (data is reused)")
+    parser.add_argument("--model-config", default=str(HERE / "benchmark-model-config.yaml"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", help="Profile JSON of the synthetic data, from "
+                                          "`synthetic_listings.py learn`")
+    parser.add_argument("--generate-workers", type=int, default=1,
+                        help="Processes writing the synthetic data")
+    parser.add_argument("--clean-chunk-rows", type=int, default=None,
+                        help="Run the clean Lambda in chunked mode with chunks of this many rows")
+    parser.add_argument("--predict-rows", type=int, default=10_000,
+                        help="Listings in the batch prediction")
+    parser.add_argument("--predict-single", type=int, default=50,
+                        help="Single-listing predictions (the first one is cold)")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds per Lambda process")
+    parser.add_argument("--bucket", default="aws-mlops-benchmark")
+    parser.add_argument("--baseline", help="Earlier report to compare with")
+    parser.add_argument("--threshold", type=float, default=1.1,
+                        help="Ratio to the baseline above which a stage counts as a regression")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir).resolve()
+    args.workdir = str(workdir)
+    scratch = workdir / "tmp"
+    scratch.mkdir(parents=True, exist_ok=True)
+
+    report = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "host": host_info(), "seed": args.seed, "profile": args.profile,
+              "clean_chunk_rows": args.clean_chunk_rows,
+              "stages": args.stages,
+              "model_config": yaml.safe_load(Path(args.model_config).read_text())["train_model"],
+              "runs": {}}
+    for n_rows in args.rows:
+        # A new bucket per number of rows, so no stage sees the output of another run
+        with FakeS3(args.bucket) as s3:
+            roots = {stage: build_task_root(stage, workdir / "roots", s3, scratch,
+                                            args.clean_chunk_rows)
+                     for stage in STAGES}
+            report["runs"][str(n_rows)] = run_scale(n_rows, args, s3, roots, workdir / "data",
+                                                    scratch)
+        Path(args.out).write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        rows = compare(json.loads(Path(args.baseline).read_text()), report, args.threshold)
+        for row in rows:
+            print(json.dumps(row))
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
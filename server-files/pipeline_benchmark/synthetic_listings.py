@@ -0,0 +1,599 @@
+"""
+Synthetic apartment listings in the schema of the UCI "apartment for rent classified" files,
+for running the pipeline on more rows than the real data has.
+
+    python synthetic_listings.py learn raw_1.csv raw_2.csv --out profile.json
+    python synthetic_listings.py generate --rows 50000000 --out raw_1.csv --profile profile.json
+
+The rows are drawn from a profile: the marginal and missing rate of each column, the states
+and cities with their locations, a log-linear price model on the square feet, the bedrooms and
+the state, the bedrooms given the square feet, the bathrooms given the bedrooms, and the
+amenity sets, so amenities that go together stay together. `learn` estimates a profile from
+real raw files in one streaming pass; without one, the hand-set `DEFAULT_PROFILE` is used.
+
+Both commands work chunk by chunk, so files of any size are read and written with bounded
+memory. The files are semicolon-separated, ISO-8859-1 encoded and use "null" for missing
+values, like the files fetched by the get_data Lambda. Each chunk is drawn from its own random
+stream, so --workers processes can draw and format chunks in parallel and the file is the same
+for any number of workers.
+"""
+import argparse
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+# Columns of the raw files, in file order
+COLUMNS = ["id", "category", "title", "body", "amenities", "bathrooms", "bedrooms", "currency",
+           "fee", "has_photo", "pets_allowed", "price", "price_display", "price_type",
+           "square_feet", "address", "cityname", "state", "latitude", "longitude", "source",
+           "time"]
+CATEGORICAL_COLUMNS = ["category", "fee", "has_photo", "pets_allowed", "price_type", "source"]
+MISSING_COLUMNS = ["amenities", "bathrooms", "bedrooms", "pets_allowed", "price", "address",
+                   "cityname", "state", "latitude"]
+
+ENCODING = "ISO-8859-1"
+SEP = ";"
+NA_REP = "null"
+
+# Square feet cut points of the bedrooms table of a learned profile
+SQ_FEET_EDGES = [400, 550, 700, 850, 1000, 1200, 1450, 1800, 2500]
+# Bedrooms cut points of the bathrooms table of a learned profile
+BEDROOM_EDGES = [0.5, 1.5, 2.5, 3.5, 4.5, 5.5]
+# Histogram of log square feet, for the quantiles of a learned profile
+LOG_SQ_FEET_BINS = np.linspace(np.log(50), np.log(100_000), 1001)
+
+# Distributions of the generated data. Categorical columns are {value: weight}; missing rates
+# are the share of rows with a null in the column. A conditional table has the inner cut
+# points of the conditioning column, the values and a probability row per interval.
+DEFAULT_PROFILE = {
+    # state: [weight, latitude, longitude, price multiplier]
+    "states": {
+        "TX": [0.115, 31.0, -97.5, 0.85], "CA": [0.09, 36.5, -119.5, 1.7],
+        "VA": [0.043, 37.8, -78.2, 1.1], "NC": [0.07, 35.6, -79.4, 0.8],
+        "CO": [0.056, 39.0, -105.5, 1.1], "FL": [0.055, 28.5, -82.0, 1.05],
+        "WA": [0.045, 47.4, -120.5, 1.3], "GA": [0.048, 33.0, -83.6, 0.85],
+        "MD": [0.037, 39.0, -76.8, 1.15], "OH": [0.035, 40.3, -82.8, 0.75],
+        "IL": [0.034, 40.0, -89.2, 1.0], "NJ": [0.033, 40.2, -74.6, 1.35],
+        "PA": [0.031, 40.9, -77.8, 0.95], "MA": [0.028, 42.3, -71.8, 1.6],
+        "NY": [0.027, 42.9, -75.5, 1.5], "AZ": [0.026, 34.2, -111.7, 0.95],
+        "MN": [0.025, 46.3, -94.3, 0.95], "TN": [0.024, 35.9, -86.4, 0.8],
+        "WI": [0.022, 44.6, -89.9, 0.8], "MO": [0.021, 38.4, -92.5, 0.75],
+        "OR": [0.02, 43.9, -120.6, 1.15], "MI": [0.02, 44.3, -85.4, 0.8],
+        "IN": [0.018, 39.9, -86.3, 0.75], "SC": [0.017, 33.9, -80.9, 0.8],
+        "NV": [0.016, 39.3, -116.6, 1.0], "OK": [0.016, 35.6, -97.5, 0.7],
+        "DC": [0.015, 38.9, -77.0, 1.6], "UT": [0.015, 39.3, -111.7, 0.95],
+        "NE": [0.014, 41.5, -99.8, 0.75], "KS": [0.013, 38.5, -98.4, 0.7],
+        "KY": [0.012, 37.5, -85.3, 0.7], "AL": [0.011, 32.8, -86.8, 0.7],
+        "LA": [0.011, 31.1, -92.0, 0.75], "IA": [0.01, 42.1, -93.5, 0.7],
+        "CT": [0.009, 41.6, -72.7, 1.2], "NM": [0.008, 34.4, -106.1, 0.75],
+        "AR": [0.007, 34.9, -92.4, 0.65], "ID": [0.006, 44.4, -114.6, 0.85],
+        "NH": [0.006, 43.7, -71.6, 1.1], "MS": [0.005, 32.7, -89.7, 0.65],
+        "RI": [0.005, 41.7, -71.5, 1.15], "ND": [0.005, 47.5, -100.5, 0.7],
+        "SD": [0.004, 44.4, -100.2, 0.7], "DE": [0.004, 39.0, -75.5, 1.0],
+        "AK": [0.004, 61.4, -150.0, 1.1], "HI": [0.004, 21.3, -157.8, 1.8],
+        "MT": [0.003, 46.9, -110.4, 0.8], "ME": [0.003, 45.3, -69.2, 0.9],
+        "WV": [0.002, 38.6, -80.6, 0.65], "VT": [0.002, 44.0, -72.7, 1.0],
+        "WY": [0.002, 43.0, -107.5, 0.75],
+    },
+    # States missing from "cities" ({state: {"names", "p", "lat", "lon"}}) get synthetic cities
+    # with Zipf-like popularity, spread around the state center, deg
+    "cities": {},
+    "cities_per_state": 160,
+    "city_spread_deg": 2.0,
+    # Spread of the listings around their city, deg
+    "listing_spread_deg": 0.05,
+    # Log-normal
+    "square_feet": {"median": 900, "sigma": 0.38, "min": 100, "max": 12000},
+    # log(price) = intercept + log_sq_feet * log(square_feet) + per_bedroom * bedrooms
+    #              + standing * standing factor + normal(0, sigma), times the state multiplier
+    "price": {"intercept": 2.93, "log_sq_feet": 0.6, "per_bedroom": 0.03, "standing": 0.05,
+              "sigma": 0.28, "min": 100, "max": 50000},
+    "bedrooms_by_sq_feet": {
+        "edges": [550, 750, 950, 1200, 1600], "values": [0, 1, 2, 3, 4, 5],
+        "p": [[0.12, 0.83, 0.05, 0, 0, 0], [0.02, 0.85, 0.12, 0.01, 0, 0],
+              [0, 0.45, 0.5, 0.05, 0, 0], [0, 0.1, 0.75, 0.14, 0.01, 0],
+              [0, 0.02, 0.45, 0.48, 0.05, 0], [0, 0, 0.1, 0.5, 0.3, 0.1]],
+    },
+    "bathrooms_by_bedrooms": {
+        "edges": [0.5, 1.5, 2.5, 3.5, 4.5], "values": [1, 1.5, 2, 2.5, 3, 3.5, 4],
+        "p": [[0.97, 0.01, 0.02, 0, 0, 0, 0], [0.93, 0.03, 0.04, 0, 0, 0, 0],
+              [0.35, 0.1, 0.53, 0.01, 0.01, 0, 0], [0.08, 0.05, 0.67, 0.12, 0.07, 0.01, 0],
+              [0.02, 0.02, 0.35, 0.2, 0.3, 0.08, 0.03], [0, 0.01, 0.15, 0.15, 0.35, 0.2, 0.14]],
+    },
+    # Share of the listings with amenities that have each amenity
+    "amenities": {
+        "Parking": 0.42, "Pool": 0.38, "Gym": 0.36, "Dishwasher": 0.35, "Refrigerator": 0.33,
+        "Patio/Deck": 0.32, "Washer Dryer": 0.28, "Storage": 0.22, "Clubhouse": 0.2,
+        "Cable or Satellite": 0.19, "Fireplace": 0.17, "Internet Access": 0.16, "Playground": 0.14,
+        "AC": 0.14, "Elevator": 0.1, "Garbage Disposal": 0.1, "Wood Floors": 0.09,
+        "Basketball": 0.06, "Gated": 0.06, "Tennis": 0.05, "Hot Tub": 0.04, "Doorman": 0.02,
+        "TV": 0.02, "Alarm": 0.02, "View": 0.02, "Luxury": 0.02, "Golf": 0.01,
+    },
+    # A share amenity_sets_share of the listings draw a whole set ("Gym,Pool": weight); the
+    # others draw each amenity on its own, with odds scaled by exp(amenity_standing * standing
+    # factor) so that amenities go together
+    "amenity_sets": {},
+    "amenity_sets_share": 0.0,
+    "amenity_standing": 0.35,
+    "category": {"housing/rent/apartment": 0.997, "housing/rent/home": 0.001,
+                 "housing/rent/short_term": 0.001, "housing/rent/condo": 0.001},
+    "fee": {"No": 0.998, "Yes": 0.002},
+    "has_photo": {"Thumbnail": 0.6, "Yes": 0.34, "No": 0.06},
+    "pets_allowed": {"Cats,Dogs": 0.85, "Cats": 0.1, "Dogs": 0.04, "Cats,Dogs,None": 0.01},
+    "price_type": {"Monthly": 0.999, "Weekly": 0.0007, "Monthly|Weekly": 0.0003},
+    "source": {"RentLingo": 0.5, "RentDigs.com": 0.15, "ListedBuy": 0.14, "GoSection8": 0.08,
+               "RealRentals": 0.05, "RentableApartments": 0.04, "Listanza": 0.02,
+               "tenantcloud": 0.02},
+    "missing": {"amenities": 0.16, "bathrooms": 0.001, "bedrooms": 0.001, "pets_allowed": 0.6,
+                "price": 0.0001, "address": 0.9, "cityname": 0.003, "state": 0.003,
+                "latitude": 0.0001},
+    # Posting time, Unix seconds
+    "time": {"min": 1544000000, "max": 1577000000},
+}
+
+_STREETS = np.array(["Main St", "Oak Ave", "Maple Dr", "Park Blvd", "Cedar Ln", "Pine St",
+                     "Elm St", "Lake Rd", "Hill St", "2nd St", "Washington Ave", "Sunset Blvd"],
+                    dtype=object)
+_BODY_WORDS = ("This unit is located in a quiet community close to shopping, dining and "
+               "public transportation. Spacious floor plan with plenty of natural light, "
+               "updated kitchen and large closets. Contact us today to schedule a tour. ")
+
+
+def _categorical(rng: np.random.Generator, weights: Dict[str, float], n: int) -> np.ndarray:
+    """Draw n values of a categorical column from its {value: weight} marginal."""
+    values = np.array(list(weights), dtype=object)
+    p = np.array(list(weights.values()), dtype=float)
+    return values[rng.choice(len(values), size=n, p=p / p.sum())]
+
+
+def _conditional(rng: np.random.Generator, table: Dict, given: np.ndarray) -> np.ndarray:
+    """Draw a value per row from the probability row of the interval `given` falls in."""
+    interval = np.digitize(given, table["edges"])
+    values = np.asarray(table["values"], dtype=float)
+    out = np.empty(len(given))
+    for idx, p in enumerate(table["p"]):
+        rows = interval == idx
+        p = np.asarray(p, dtype=float)
+        out[rows] = values[rng.choice(len(values), size=rows.sum(), p=p / p.sum())]
+    return out
+
+
+def _compose(keys: np.ndarray, build) -> np.ndarray:
+    """Build a text column from integer keys, calling `build(key)` once per distinct key."""
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    return np.array([build(key) for key in uniques.tolist()], dtype=object)[inverse]
+
+
+def _with_missing(rng: np.random.Generator, values: np.ndarray, rate: float) -> np.ndarray:
+    """Null out a share `rate` of the values."""
+    values = values.astype(object)
+    values[rng.random(len(values)) < rate] = None
+    return values
+
+
+class ListingGenerator:
+    """
+    Draws chunks of synthetic listings from a profile (see `DEFAULT_PROFILE`). The cities and
+    their locations are fixed by the seed, so the chunks of one generator share them.
+    """
+
+    def __init__(self, profile: Dict = None, seed: int = 0):
+        self.profile = profile or DEFAULT_PROFILE
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        states = self.profile["states"]
+        self.state_names = np.array(list(states), dtype=object)
+        weights = np.array([state[0] for state in states.values()])
+        self.state_p = weights / weights.sum()
+        self.state_multiplier = np.array([state[3] for state in states.values()])
+
+        # The cities of all states in flat arrays; state k has the slice starting at
+        # state_cities[k][0] and the popularity state_cities[k][1]
+        names, lat, lon, self.state_cities = [], [], [], []
+        cities = self.profile.get("cities") or {}
+        for state, (_, state_lat, state_lon, _) in states.items():
+            if state in cities:
+                city_names, city_p = cities[state]["names"], cities[state]["p"]
+                city_lat, city_lon = cities[state]["lat"], cities[state]["lon"]
+            else:
+                n_cities = self.profile["cities_per_state"]
+                city_names = [f"{state} City {idx}" for idx in range(n_cities)]
+                city_p = 1 / np.arange(1, n_cities + 1)
+                city_lat = state_lat + rng.normal(0, self.profile["city_spread_deg"], n_cities)
+                city_lon = state_lon + rng.normal(0, self.profile["city_spread_deg"], n_cities)
+            city_p = np.asarray(city_p, dtype=float)
+            self.state_cities.append((len(names), city_p / city_p.sum()))
+            names.extend(city_names)
+            lat.extend(city_lat)
+            lon.extend(city_lon)
+        self.city_names = np.array(names, dtype=object)
+        self.city_location = np.column_stack([lat, lon])
+        self.city_state = np.repeat(np.arange(len(states)), [len(p) for _, p in self.state_cities])
+
+        amenity_sets = self.profile.get("amenity_sets") or {}
+        self.amenity_sets = np.array(list(amenity_sets), dtype=object)
+        set_p = np.array(list(amenity_sets.values()), dtype=float)
+        self.amenity_set_p = set_p / set_p.sum() if len(set_p) else set_p
+
+        bodies = [_BODY_WORDS[:len(_BODY_WORDS) * (k + 4) // 8] for k in range(16)]
+        self.bodies = np.array(bodies, dtype=object)
+
+    def _cities(self, rng: np.random.Generator, state_idx: np.ndarray) -> np.ndarray:
+        """Draw a city in each listing's state, as an index into the flat city arrays."""
+        city_idx = np.empty(len(state_idx), dtype=np.int64)
+        for state in np.unique(state_idx):
+            rows = state_idx == state
+            start, p = self.state_cities[state]
+            city_idx[rows] = start + rng.choice(len(p), size=rows.sum(), p=p)
+        return city_idx
+
+    def _amenities(self, rng: np.random.Generator, standing: np.ndarray) -> np.ndarray:
+        """Draw the amenities of each listing: a whole set, or each amenity on its own."""
+        profile = self.profile
+        n = len(standing)
+        # Bit k of a listing's mask is set if it has amenity k; the lists are built per mask
+        names = list(profile["amenities"])
+        rates = np.array(list(profile["amenities"].values()))
+        has = rng.random((n, len(names))) < (
+            rates * np.exp(profile["amenity_standing"] * standing)[:, None])
+        mask = has.astype(np.int64) @ (1 << np.arange(len(names), dtype=np.int64))
+        amenities = _compose(mask, lambda key: ",".join(
+            name for bit, name in enumerate(names) if key >> bit & 1) or None)
+
+        from_sets = rng.random(n) < profile.get("amenity_sets_share", 0.0)
+        if len(self.amenity_sets) and from_sets.any():
+            amenities[from_sets] = self.amenity_sets[rng.choice(
+                len(self.amenity_sets), size=from_sets.sum(), p=self.amenity_set_p)]
+        return _with_missing(rng, amenities, profile["missing"]["amenities"])
+
+    def chunk(self, n: int, first_id: int, chunk_idx: int = 0) -> pd.DataFrame:
+        """Draw n listings with ids first_id, first_id + 1, ... from the stream of chunk_idx."""
+        rng = np.random.default_rng([self.seed, chunk_idx])
+        profile = self.profile
+        missing = profile["missing"]
+
+        state_idx = rng.choice(len(self.state_names), size=n, p=self.state_p)
+        city_idx = self._cities(rng, state_idx)
+        location = (self.city_location[city_idx] +
+                    rng.normal(0, profile["listing_spread_deg"], (n, 2)))
+
+        sq = profile["square_feet"]
+        square_feet = np.clip(np.exp(rng.normal(np.log(sq["median"]), sq["sigma"], n)),
+                              sq["min"], sq["max"]).astype(np.int64)
+        bedrooms = _conditional(rng, profile["bedrooms_by_sq_feet"], square_feet)
+        bathrooms = _conditional(rng, profile["bathrooms_by_bedrooms"], bedrooms)
+
+        # A shared "standing" factor raises both the price and the amenities of a listing
+        standing = rng.normal(0, 1, n)
+        pr = profile["price"]
+        log_price = (pr["intercept"] + pr["log_sq_feet"] * np.log(square_feet) +
+                     pr["per_bedroom"] * bedrooms + pr["standing"] * standing +
+                     rng.normal(0, pr["sigma"], n))
+        price = np.clip(np.round(np.exp(log_price) * self.state_multiplier[state_idx]),
+                        pr["min"], pr["max"]).astype(np.int64)
+        amenities = self._amenities(rng, standing)
+
+        price_type = _categorical(rng, profile["price_type"], n)
+        # Weekly prices are a quarter of the monthly ones
+        price = np.where(price_type == "Weekly", price // 4, price)
+
+        # Title and body only take a few distinct values per city
+        n_cities = len(self.city_names)
+        place = bedrooms.astype(np.int64) * n_cities + city_idx
+        body_idx = rng.integers(0, len(self.bodies), n)
+
+        def title_of(key):
+            beds, city = divmod(key, n_cities)
+            return f"{beds} BR apartment in {self.city_names[city]}, " \
+                   f"{self.state_names[self.city_state[city]]}"
+
+        title = _compose(place, title_of)
+        body = _compose(place * len(self.bodies) + body_idx, lambda key: (
+            f"{title_of(key // len(self.bodies))}. {self.bodies[key % len(self.bodies)]}"))
+        address = np.array([f"{number} {street}" for number, street in zip(
+            rng.integers(1, 9999, n).tolist(), _STREETS[rng.integers(0, len(_STREETS), n)])],
+            dtype=object)
+        price_display = _compose(price, "${:,}".format)
+
+        df = pd.DataFrame({
+            "id": np.arange(first_id, first_id + n, dtype=np.int64),
+            "category": _categorical(rng, profile["category"], n),
+            "title": title,
+            "body": body,
+            "amenities": amenities,
+            "bathrooms": _with_missing(rng, bathrooms, missing["bathrooms"]),
+            "bedrooms": _with_missing(rng, bedrooms, missing["bedrooms"]),
+            "currency": "USD",
+            "fee": _categorical(rng, profile["fee"], n),
+            "has_photo": _categorical(rng, profile["has_photo"], n),
+            "pets_allowed": _with_missing(rng, _categorical(rng, profile["pets_allowed"], n),
+                                          missing["pets_allowed"]),
+            "price": _with_missing(rng, price, missing["price"]),
+            "price_display": price_display,
+            "price_type": price_type,
+            "square_feet": square_feet,
+            "address": _with_missing(rng, address, missing["address"]),
+            "cityname": _with_missing(rng, self.city_names[city_idx], missing["cityname"]),
+            "state": _with_missing(rng, self.state_names[state_idx], missing["state"]),
+            "latitude": np.round(location[:, 0], 4),
+            "longitude": np.round(location[:, 1], 4),
+            "source": _categorical(rng, profile["source"], n),
+            "time": rng.integers(profile["time"]["min"], profile["time"]["max"], n),
+        }, columns=COLUMNS)
+        # Listings without a location have neither latitude nor longitude
+        no_location = rng.random(n) < missing["latitude"]
+        df.loc[no_location, ["latitude", "longitude"]] = np.nan
+        return df
+
+    def chunks(self, n_rows: int, chunk_rows: int = 100_000,
+               first_id: int = 5_000_000_000) -> Iterator[pd.DataFrame]:
+        """Draw n_rows listings, chunk_rows at a time."""
+        for idx, start in enumerate(range(0, n_rows, chunk_rows)):
+            yield self.chunk(min(chunk_rows, n_rows - start), first_id + start, idx)
+
+    def csv_chunk(self, n: int, first_id: int, chunk_idx: int) -> bytes:
+        """Draw a chunk as raw file lines, with the header line for the first chunk."""
+        text = self.chunk(n, first_id, chunk_idx).to_csv(
+            sep=SEP, index=False, header=chunk_idx == 0, na_rep=NA_REP)
+        return text.encode(ENCODING, errors="replace")
+
+
+# Generator of a --workers process, built once per process
+_worker_generator: Optional[ListingGenerator] = None
+
+
+def _init_worker(profile: Optional[Dict], seed: int) -> None:
+    global _worker_generator
+    _worker_generator = ListingGenerator(profile, seed)
+
+
+def _worker_csv_chunk(task: tuple) -> bytes:
+    return _worker_generator.csv_chunk(*task)
+
+
+def write_raw_csv(path: Union[Path, str], n_rows: int, seed: int = 0, chunk_rows: int = 100_000,
+                  first_id: int = 5_000_000_000, profile: Dict = None, workers: int = 1) -> int:
+    """
+    Write n_rows synthetic listings to a raw CSV file, one chunk at a time.
+
+    Args:
+        path: Output file.
+        n_rows: Number of listings.
+        seed: Random seed. Files written with different seeds have different cities.
+        chunk_rows: Listings drawn and written at a time.
+        first_id: Id of the first listing; the ids are consecutive.
+        profile: Distributions of the data. Defaults to `DEFAULT_PROFILE`.
+        workers: Processes drawing chunks. The chunks are written in order, so the file does
+            not depend on the number of workers.
+
+    Returns:
+        Size of the written file in bytes.
+    """
+    tasks = [(min(chunk_rows, n_rows - start), first_id + start, idx)
+             for idx, start in enumerate(range(0, n_rows, chunk_rows))]
+    with open(path, "wb") as file:
+        if workers > 1:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(profile, seed)) as pool:
+                for data in pool.map(_worker_csv_chunk, tasks):
+                    file.write(data)
+        else:
+            generator = ListingGenerator(profile, seed)
+            for task in tasks:
+                file.write(generator.csv_chunk(*task))
+    return Path(path).stat().st_size
+
+
+def _add(total: Optional[pd.DataFrame], part: pd.DataFrame) -> pd.DataFrame:
+    return part if total is None else total.add(part, fill_value=0)
+
+
+def _shares(counts: Counter, total: float = None, digits: int = 6) -> Dict[str, float]:
+    total = total or sum(counts.values())
+    return {str(key): round(count / total, digits) for key, count in counts.most_common()}
+
+
+def _table(counts: pd.Series, edges: List[float]) -> Dict:
+    """A conditional table from (interval, value) counts; empty intervals get the marginal."""
+    counts = counts.unstack(fill_value=0)
+    marginal = counts.sum() / counts.values.sum()
+    rows = [counts.loc[idx] / counts.loc[idx].sum() if idx in counts.index else marginal
+            for idx in range(len(edges) + 1)]
+    return {"edges": edges, "values": [float(value) for value in counts.columns],
+            "p": [[round(float(p), 6) for p in row] for row in rows]}
+
+
+class ProfileLearner:
+    """
+    Estimates a profile from chunks of raw listings, keeping only counts and sums between
+    chunks. The price model is a least squares fit of log(price) on log(square_feet) and the
+    bedrooms with an intercept per state, solved from per-state sums of the regressors.
+    """
+
+    def __init__(self, max_cities_per_state: int = 400, max_amenity_sets: int = 2000):
+        self.max_cities_per_state = max_cities_per_state
+        self.max_amenity_sets = max_amenity_sets
+        self.n = 0
+        self.missing = pd.Series(0, index=MISSING_COLUMNS)
+        self.counts = {column: Counter() for column in CATEGORICAL_COLUMNS}
+        self.cities = None
+        self.price_sums = None
+        self.bedrooms = None
+        self.bathrooms = None
+        self.log_sq_feet = np.zeros(len(LOG_SQ_FEET_BINS) - 1)
+        self.amenities = Counter()
+        self.amenity_sets = Counter()
+        self.amenity_rows = 0
+        self.time = [np.inf, -np.inf]
+
+    def update(self, df: pd.DataFrame) -> None:
+        """Add a chunk of raw listings."""
+        self.n += len(df)
+        self.missing += df[MISSING_COLUMNS].isna().sum()
+        for column in CATEGORICAL_COLUMNS:
+            self.counts[column].update(df[column].value_counts().to_dict())
+
+        located = df.dropna(subset=["state", "cityname", "latitude", "longitude"])
+        located = located.assign(lat2=located.latitude ** 2, lon2=located.longitude ** 2)
+        self.cities = _add(self.cities, located.groupby(["state", "cityname"]).agg(
+            n=("state", "size"), lat=("latitude", "sum"), lon=("longitude", "sum"),
+            lat2=("lat2", "sum"), lon2=("lon2", "sum")))
+
+        self.log_sq_feet += np.histogram(np.log(df.square_feet[df.square_feet > 0]),
+                                         LOG_SQ_FEET_BINS)[0]
+        rooms = df.dropna(subset=["square_feet", "bedrooms"])
+        self.bedrooms = _add(self.bedrooms, rooms.groupby(
+            [np.digitize(rooms.square_feet, SQ_FEET_EDGES), rooms.bedrooms]).size().to_frame("n"))
+        rooms = rooms.dropna(subset=["bathrooms"])
+        self.bathrooms = _add(self.bathrooms, rooms.groupby(
+            [np.digitize(rooms.bedrooms, BEDROOM_EDGES), rooms.bathrooms]).size().to_frame("n"))
+
+        # Per-state sums of the price model terms, on monthly prices
+        priced = df[(df.price_type == "Monthly") & (df.price > 0) & (df.square_feet > 0)]
+        priced = priced.dropna(subset=["bedrooms", "state"])
+        x1, x2, y = np.log(priced.square_feet), priced.bedrooms, np.log(priced.price)
+        terms = pd.DataFrame({"n": 1.0, "x1": x1, "x2": x2, "y": y, "x1x1": x1 * x1,
+                              "x1x2": x1 * x2, "x2x2": x2 * x2, "x1y": x1 * y, "x2y": x2 * y,
+                              "yy": y * y})
+        self.price_sums = _add(self.price_sums, terms.groupby(priced.state).sum())
+
+        amenities = df.amenities.dropna()
+        self.amenity_rows += len(amenities)
+        self.amenity_sets.update(amenities.value_counts().to_dict())
+        self.amenities.update(amenities.str.split(",").explode().value_counts().to_dict())
+
+        self.time = [min(self.time[0], df.time.min()), max(self.time[1], df.time.max())]
+
+    def _price_model(self) -> Dict:
+        """Slopes pooled within the states, the state intercepts and the residual spread."""
+        s = self.price_sums
+        n = s["n"]
+        x1, x2, y = s["x1"] / n, s["x2"] / n, s["y"] / n
+        # Sums of squares and products around the state means
+        s11 = (s["x1x1"] - n * x1 * x1).sum()
+        s12 = (s["x1x2"] - n * x1 * x2).sum()
+        s22 = (s["x2x2"] - n * x2 * x2).sum()
+        s1y = (s["x1y"] - n * x1 * y).sum()
+        s2y = (s["x2y"] - n * x2 * y).sum()
+        syy = (s["yy"] - n * y * y).sum()
+        beta = np.linalg.lstsq(np.array([[s11, s12], [s12, s22]]), np.array([s1y, s2y]),
+                               rcond=None)[0]
+        sigma = np.sqrt(max(syy - beta @ [s1y, s2y], 0) / max(n.sum() - len(n) - 2, 1))
+        state_intercepts = y - beta[0] * x1 - beta[1] * x2
+        intercept = (state_intercepts * n).sum() / n.sum()
+        return {"slopes": beta, "sigma": float(sigma), "intercept": float(intercept),
+                "multiplier": np.exp(state_intercepts - intercept)}
+
+    def profile(self) -> Dict:
+        """The profile of the listings added so far."""
+        model = self._price_model()
+
+        states, cities, spread = {}, {}, 0.0
+        total = self.cities.n.sum()
+        for state, group in self.cities.groupby(level="state"):
+            group = group.droplevel("state").sort_values("n", ascending=False)
+            # Squared deviations of the listings from their city center
+            spread += ((group.lat2 - group.lat ** 2 / group.n) +
+                       (group.lon2 - group.lon ** 2 / group.n)).sum()
+            states[state] = [round(group.n.sum() / total, 6),
+                             round(group.lat.sum() / group.n.sum(), 4),
+                             round(group.lon.sum() / group.n.sum(), 4),
+                             round(float(model["multiplier"].get(state, 1.0)), 4)]
+            group = group.head(self.max_cities_per_state)
+            cities[state] = {"names": group.index.tolist(),
+                             "p": (group.n / group.n.sum()).round(6).tolist(),
+                             "lat": (group.lat / group.n).round(4).tolist(),
+                             "lon": (group.lon / group.n).round(4).tolist()}
+
+        cdf = np.cumsum(self.log_sq_feet) / self.log_sq_feet.sum()
+
+        def sq_feet_quantile(q):
+            return float(np.exp(LOG_SQ_FEET_BINS[1 + np.searchsorted(cdf, q)]))
+
+        # The listings not drawing a set draw each amenity from the shares among themselves
+        sets = Counter(dict(self.amenity_sets.most_common(self.max_amenity_sets)))
+        other = self.amenities.copy()
+        for amenity_set, count in sets.items():
+            other.subtract(Counter({name: count for name in amenity_set.split(",")}))
+        other_rows = self.amenity_rows - sum(sets.values())
+        return {
+            "states": states,
+            "cities": cities,
+            "listing_spread_deg": round(float(np.sqrt(spread / 2 / max(total, 1))), 4),
+            "square_feet": {
+                "median": round(sq_feet_quantile(0.5)),
+                "sigma": round(np.log(sq_feet_quantile(0.8413) / sq_feet_quantile(0.1587)) / 2, 4),
+                "min": round(sq_feet_quantile(0.001)), "max": round(sq_feet_quantile(0.999))},
+            "price": {"intercept": round(model["intercept"], 4),
+                      "log_sq_feet": round(float(model["slopes"][0]), 4),
+                      "per_bedroom": round(float(model["slopes"][1]), 4), "standing": 0.0,
+                      "sigma": round(model["sigma"], 4), "min": 50, "max": 50000},
+            "bedrooms_by_sq_feet": _table(self.bedrooms.n, SQ_FEET_EDGES),
+            "bathrooms_by_bedrooms": _table(self.bathrooms.n, BEDROOM_EDGES),
+            "amenities": _shares(+other, max(other_rows, 1)),
+            "amenity_sets": _shares(sets, digits=8),
+            "amenity_sets_share": round(sum(sets.values()) / max(self.amenity_rows, 1), 4),
+            "amenity_standing": 0.0,
+            **{column: _shares(self.counts[column]) for column in CATEGORICAL_COLUMNS},
+            "missing": (self.missing / self.n).round(6).to_dict(),
+            "time": {"min": int(self.time[0]), "max": int(self.time[1])},
+            "learned_from_rows": self.n,
+        }
+
+
+def read_raw_chunks(path: Union[Path, str], chunk_rows: int = 200_000) -> Iterator[pd.DataFrame]:
+    """Stream a raw listings file in chunks, parsed as train_test_split of the clean Lambda does."""
+    yield from pd.read_csv(path, sep=SEP, encoding=ENCODING, dtype={"address": str},
+                           chunksize=chunk_rows)
+
+
+def learn_profile(paths: List[Union[Path, str]], chunk_rows: int = 200_000, **kwargs) -> Dict:
+    """Learn a profile from raw listings files in one streaming pass, see `ProfileLearner`."""
+    learner = ProfileLearner(**kwargs)
+    for path in paths:
+        for chunk in read_raw_chunks(path, chunk_rows):
+            learner.update(chunk)
+    return learner.profile()
+
+
+def load_profile(path: Optional[Union[Path, str]]) -> Optional[Dict]:
+    return json.loads(Path(path).read_text()) if path else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic listings in the raw UCI format")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    learn = commands.add_parser("learn", help="Learn a profile from real raw files")
+    learn.add_argument("raw_files", nargs="+", help="Raw CSV files, e.g. the two UCI files")
+    learn.add_argument("--out", required=True, help="Profile JSON file")
+    learn.add_argument("--chunk-rows", type=int, default=200_000)
+    learn.add_argument("--max-cities-per-state", type=int, default=400)
+    learn.add_argument("--max-amenity-sets", type=int, default=2000)
+
+    generate = commands.add_parser("generate", help="Write a raw file of synthetic listings")
+    generate.add_argument("--rows", type=int, required=True, help="Number of listings")
+    generate.add_argument("--out", required=True, help="Output CSV file")
+    generate.add_argument("--profile", help="Profile JSON file; DEFAULT_PROFILE if not given")
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--chunk-rows", type=int, default=100_000)
+    generate.add_argument("--first-id", type=int, default=5_000_000_000)
+    generate.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "learn":
+        profile = learn_profile(args.raw_files, args.chunk_rows,
+                                max_cities_per_state=args.max_cities_per_state,
+                                max_amenity_sets=args.max_amenity_sets)
+        Path(args.out).write_text(json.dumps(profile, indent=1))
+        print(f"Learned a profile from {profile['learned_from_rows']} listings: {args.out}")
+    else:
+        size = write_raw_csv(args.out, args.rows, args.seed, args.chunk_rows, args.first_id,
+                             load_profile(args.profile), args.workers)
+        print(f"Wrote {args.rows} listings to {args.out} ({size / 2**20:.1f} MB)")
@@ -0,0 +1,39 @@
+import json
+import resource
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import invoke_lambda
+
+HANDLER = """
+def lambda_handler(event, context):
+    data = b"\\x01" * (event["mb"] << 20)
+    return {"statusCode": 200, "body": str(len(data))}
+"""
+
+
+def invoke(tmp_path: Path, name: str, mb: int) -> dict:
+    task_root = tmp_path / name
+    task_root.mkdir()
+    (task_root / "handler.py").write_text(textwrap.dedent(HANDLER))
+    events, out = tmp_path / f"{name}-events.json", tmp_path / f"{name}-result.json"
+    events.write_text(json.dumps([{"mb": mb}]))
+    subprocess.run([sys.executable, invoke_lambda.__file__, "--task-root", str(task_root),
+                    "--handler", "handler.lambda_handler", "--events", str(events),
+                    "--out", str(out)], check=True)
+    return json.loads(out.read_text())
+
+
+def test_stage_peak_rss_is_not_inherited_from_the_benchmark(tmp_path):
+    # Raise the peak RSS of this process well above what either stage needs
+    blob = b"\x01" * (512 << 20)
+    del blob
+    parent_peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    small = invoke(tmp_path, "small", 1)
+    large = invoke(tmp_path, "large", 256)
+
+    assert small["peak_rss_mb"] < parent_peak_mb - 256
+    assert large["peak_rss_mb"] - small["peak_rss_mb"] > 200